@@ -0,0 +1,63 @@
+import time
+import numpy as np
+from compiled_forest import load_compiled_forests
+from prediction import predict_consumption, predict_batch
+from utils import load_models, load_dataset
+
+
+def benchmark_forecasts(df, models, scaler, compiled=None):
+    """Times the per-EAN predict_consumption loop against the batch forecast of the same EANs.
+
+    With compiled forests, the batch forecast evaluated by them is timed too.
+    """
+    eans = [ean for ean in df.eans if ean in models]
+
+    start = time.perf_counter()
+    loop_predictions = {}
+    for ean in eans:
+        _, future_predictions, _ = predict_consumption(ean, df, models, scaler)
+        loop_predictions[ean] = future_predictions
+    loop_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    forecasts = predict_batch(df, models, scaler, eans)
+    batch_seconds = time.perf_counter() - start
+
+    # Both paths must produce the same forecasts
+    batch_predictions = forecasts.groupby("EAN")["Predicted_Consumption"].apply(np.asarray)
+    mismatches = sum(not np.array_equal(loop_predictions[ean], batch_predictions[ean]) for ean in eans)
+
+    results = {
+        "eans": len(eans),
+        "loop_seconds": loop_seconds,
+        "batch_seconds": batch_seconds,
+        "speedup": loop_seconds / batch_seconds if batch_seconds else float("inf"),
+        "mismatches": mismatches,
+    }
+
+    if compiled is not None:
+        start = time.perf_counter()
+        forecasts = predict_batch(df, models, scaler, eans, compiled=compiled)
+        results["compiled_seconds"] = time.perf_counter() - start
+
+        compiled_predictions = forecasts.groupby("EAN")["Predicted_Consumption"].apply(np.asarray)
+        results["compiled_mismatches"] = sum(not np.array_equal(loop_predictions[ean], compiled_predictions[ean])
+                                             for ean in eans)
+        results["compiled_bytes"] = compiled.nbytes
+    return results
+
+
+if __name__ == "__main__":
+    models, scaler = load_models()
+    df = load_dataset()
+
+    results = benchmark_forecasts(df, models, scaler, load_compiled_forests())
+    print(f"EANs forecast: {results['eans']}")
+    print(f"Per-EAN loop:  {results['loop_seconds']:.3f} s")
+    print(f"Batch:         {results['batch_seconds']:.3f} s ({results['speedup']:.1f}x faster)")
+    print(f"Mismatching forecasts: {results['mismatches']}")
+    if "compiled_seconds" in results:
+        print(f"Compiled:      {results['compiled_seconds']:.3f} s "
+              f"({results['loop_seconds'] / results['compiled_seconds']:.1f}x faster than the loop, "
+              f"{results['compiled_bytes'] / 1e6:.1f} MB of node arrays)")
+        print(f"Mismatching compiled forecasts: {results['compiled_mismatches']}")
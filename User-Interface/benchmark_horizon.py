@@ -0,0 +1,102 @@
+import argparse
+import contextlib
+import sys
+import time
+import numpy as np
+from features import N_LAGS, lag_windows
+from model_training import train_models
+from prediction import FORECAST_HORIZON, predict_batch, predict_consumption
+from utils import load_dataset, load_scaler
+
+
+def _test_windows(values, horizon):
+    """Returns the lag vectors and next `horizon` weeks of the windows that neither model saw in training.
+
+    Both the recursive and the direct models keep the last 20% of their own
+    rows for testing; only the windows whose target weeks come after the
+    training targets of both are kept.
+    """
+    X, Y = lag_windows(values, horizon)
+    recursive_split = int((len(values) - N_LAGS) * 0.8)
+    direct_split = int(len(X) * 0.8)
+    first = max(recursive_split, direct_split + horizon - 1)
+    if Y.ndim == 1:
+        Y = Y.reshape(-1, 1)
+    return X[first:], Y[first:]
+
+
+def _forecast_weeks(model, X, horizon):
+    """Forecasts `horizon` weeks from every lag vector of X, like predict_consumption."""
+    forecasts = np.empty((len(X), horizon))
+    lags = X.copy()
+    step = 0
+    while step < horizon:
+        predicted = model.predict(lags).reshape(len(X), -1)[:, :horizon - step]
+        forecasts[:, step:step + predicted.shape[1]] = predicted
+        for week in range(predicted.shape[1]):
+            lags[:, 1:] = lags[:, :-1]
+            lags[:, 0] = predicted[:, week]
+        step += predicted.shape[1]
+    return forecasts
+
+
+def benchmark_horizon(dataset, scaler, horizon=FORECAST_HORIZON, n_jobs=None):
+    """Trains recursive (one-week) and direct (multi-week) models and compares their forecasts.
+
+    Reports the training time, the latency of a single-EAN forecast and of
+    the batch forecast of every EAN, and the RMSE of each forecast week on
+    held-out windows (scaled units).
+    """
+    results = []
+    for mode, outputs in (("recursive", 1), ("direct", horizon)):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(sys.stderr):
+            models, _ = train_models(dataset, n_jobs=n_jobs, horizon=outputs)
+        train_seconds = time.perf_counter() - start
+
+        squared_errors, n_windows = np.zeros(horizon), 0
+        for ean, model in models.items():
+            X, Y = _test_windows(dataset.series(ean)[1], horizon)
+            if len(X):
+                squared_errors += ((_forecast_weeks(model, X, horizon) - Y) ** 2).sum(axis=0)
+                n_windows += len(X)
+
+        latencies = []
+        for ean in models:
+            start = time.perf_counter()
+            predict_consumption(ean, dataset, models, scaler, horizon)
+            latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        predict_batch(dataset, models, scaler, horizon=horizon)
+        batch_seconds = time.perf_counter() - start
+
+        weekly_rmse = np.sqrt(squared_errors / n_windows) if n_windows else np.full(horizon, np.nan)
+        results.append({
+            "mode": mode,
+            "eans": len(models),
+            "train_seconds": train_seconds,
+            "single_ms": float(np.median(latencies)) * 1000,
+            "batch_seconds": batch_seconds,
+            "test_windows": n_windows,
+            "weekly_rmse": weekly_rmse.tolist(),
+            "mean_rmse": float(np.sqrt(np.mean(weekly_rmse ** 2))),
+        })
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare recursive and direct multi-week forecasts.")
+    parser.add_argument("--horizon", type=int, default=FORECAST_HORIZON, help="Number of weeks to forecast")
+    parser.add_argument("--jobs", type=int, default=None, help="Number of worker processes")
+    args = parser.parse_args()
+
+    results = benchmark_horizon(load_dataset(), load_scaler(), args.horizon, args.jobs)
+
+    weeks = " ".join(f"{f'RMSE w{week}':>9}" for week in range(1, args.horizon + 1))
+    print(f"{'Mode':<10} {'Train (s)':>10} {'Single (ms)':>12} {'Batch (s)':>10} {weeks} {'RMSE':>9}")
+    for result in results:
+        weekly = " ".join(f"{rmse:>9.4f}" for rmse in result["weekly_rmse"])
+        print(f"{result['mode']:<10} {result['train_seconds']:>10.2f} {result['single_ms']:>12.2f} "
+              f"{result['batch_seconds']:>10.3f} {weekly} {result['mean_rmse']:>9.4f}")
+    print(f"{results[0]['test_windows']} held-out windows of {results[0]['eans']} EANs")
@@ -0,0 +1,189 @@
+import argparse
+import contextlib
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+from model_store import save_models
+from model_training import train_models
+from prediction import predict_consumption, predict_batch
+from preprocessing import preprocess_data
+from snapshots import new_snapshot
+from synthetic_data import generate_transactions
+from utils import load_models, load_dataset
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# (SKUs, weeks, sparsity) of the predefined scales
+SCALES = {
+    "small": (100, 52, 0.5),
+    "medium": (1000, 104, 0.5),
+    "large": (5000, 156, 0.6),
+}
+
+# Number of single-EAN forecasts timed by the predict_consumption stage
+N_SINGLE_PREDICTIONS = 50
+
+
+def _reset_peak_rss():
+    """Resets the peak resident memory of this process, if the OS allows it (Linux). Returns whether it did."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _status_bytes(field):
+    """Reads a memory field of /proc/self/status (Linux), or returns None."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def _peak_rss_bytes():
+    """Returns the peak resident memory of this process."""
+    peak = _status_bytes("VmHWM")
+    if peak is not None:
+        return peak
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024  # kB on Linux
+
+
+def _measure(stage, function, trace_memory=False):
+    """Runs function() and returns its result with the stage's wall time and peak memory.
+
+    The peak resident memory covers the stage alone where it can be reset
+    (Linux), else the whole run so far. With trace_memory the peak of the
+    Python allocations is traced too, which slows allocation-heavy stages
+    down a lot: their times are then not comparable with untraced runs.
+    """
+    start_rss_bytes = _status_bytes("VmRSS")
+    stage_scope = _reset_peak_rss()
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        result = function()
+    finally:
+        seconds = time.perf_counter() - start
+        peak_traced_bytes = None
+        if trace_memory:
+            peak_traced_bytes = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+    return result, {"stage": stage, "seconds": seconds, "start_rss_bytes": start_rss_bytes,
+                    "peak_rss_bytes": _peak_rss_bytes(),
+                    "peak_rss_scope": "stage" if stage_scope else "process",
+                    "peak_traced_bytes": peak_traced_bytes}
+
+
+def benchmark_scale(n_skus, n_weeks, sparsity, seed=0, n_jobs=None, trace_memory=False):
+    """Runs every pipeline stage on a synthetic dataset in a scratch workspace and returns one record per stage.
+
+    The workspace mirrors the application layout (Dataset/, Models/,
+    Snapshots/ and a working folder next to them), so the stages use their
+    usual paths.
+    """
+    workspace = tempfile.mkdtemp(prefix="benchmark_")
+    previous_cwd = os.getcwd()
+    for folder in ("Dataset", "Models", "run"):
+        os.makedirs(os.path.join(workspace, folder))
+    os.chdir(os.path.join(workspace, "run"))
+
+    records = []
+
+    def publish_models(models, rmse_values):
+        with new_snapshot() as snapshot:
+            save_models(models, rmse_values, snapshot.models_dir)
+
+    def measure(stage, function):
+        # The stages' own messages go to stderr, keeping stdout for the results
+        with contextlib.redirect_stdout(sys.stderr):
+            result, record = _measure(stage, function, trace_memory)
+        records.append(record)
+        return result
+
+    try:
+        n_rows = measure("generate", lambda: generate_transactions(os.path.join("../Dataset", "transactions.csv"),
+                                                                   n_skus, n_weeks, sparsity, seed))
+        measure("preprocess_data", lambda: preprocess_data("transactions.csv"))
+        dataset = measure("load_dataset", load_dataset)
+        models, rmse_values = measure("train_models", lambda: train_models(dataset, n_jobs=n_jobs))
+        measure("save_models", lambda: publish_models(models, rmse_values))
+        models, scaler = measure("load_models", load_models)
+
+        rng = np.random.default_rng(seed)
+        eans = [ean for ean in dataset.eans if ean in models]
+        sample = rng.choice(eans, min(N_SINGLE_PREDICTIONS, len(eans)), replace=False)
+        measure("predict_consumption", lambda: [predict_consumption(ean, dataset, models, scaler) for ean in sample])
+        measure("predict_batch", lambda: predict_batch(dataset, models, scaler))
+    finally:
+        os.chdir(previous_cwd)
+        shutil.rmtree(workspace, ignore_errors=True)
+
+    for record in records:
+        record.update({"skus": n_skus, "weeks": n_weeks, "sparsity": sparsity, "transactions": n_rows})
+        if record["stage"] == "predict_consumption":
+            record["calls"] = len(sample)
+    return records
+
+
+def run_benchmarks(scales, seed=0, n_jobs=None, trace_memory=False):
+    """Benchmarks several (SKUs, weeks, sparsity) scales and returns the results with the environment."""
+    results = []
+    for n_skus, n_weeks, sparsity in scales:
+        print(f"Benchmarking {n_skus} SKUs x {n_weeks} weeks (sparsity {sparsity})...", file=sys.stderr)
+        results.extend(benchmark_scale(n_skus, n_weeks, sparsity, seed, n_jobs, trace_memory))
+    return {
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "numpy": np.__version__,
+        },
+        "results": results,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time and memory-profile every pipeline stage on synthetic data.")
+    parser.add_argument("--scales", nargs="+", choices=SCALES, default=["small"], help="Predefined scales to run")
+    parser.add_argument("--skus", type=int, default=None, help="Custom scale: number of SKUs")
+    parser.add_argument("--weeks", type=int, default=52, help="Custom scale: number of weeks")
+    parser.add_argument("--sparsity", type=float, default=0.5, help="Custom scale: share of weeks without sales")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic data")
+    parser.add_argument("--jobs", type=int, default=None, help="Training worker processes")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="Also trace the peak of Python allocations (slows the stages down a lot)")
+    parser.add_argument("--output", default=None, help="JSON file to write (default: print to stdout)")
+    args = parser.parse_args()
+
+    scales = [(args.skus, args.weeks, args.sparsity)] if args.skus else [SCALES[name] for name in args.scales]
+    report = run_benchmarks(scales, args.seed, args.jobs, args.trace_memory)
+
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        for record in report["results"]:
+            peak = record["peak_rss_bytes"]
+            print(f"{record['skus']:>6} SKUs x {record['weeks']:>4} weeks  {record['stage']:<20} "
+                  f"{record['seconds']:>8.3f} s" + (f"  {peak / 1e6:>8.1f} MB RSS" if peak is not None else ""))
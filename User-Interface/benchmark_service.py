@@ -0,0 +1,102 @@
+import argparse
+import http.client
+import json
+import threading
+import time
+import numpy as np
+from urllib.parse import urlparse
+from compiled_forest import load_compiled_forests
+from forecast_table import load_forecast_table
+from service import BATCH_WINDOW, create_server, warm_models
+from utils import load_models, load_dataset
+
+
+def _client(host, port, eans, n_requests, bulk_size, latencies, errors, barrier):
+    """Sends n_requests requests over one keep-alive connection, recording each latency."""
+    connection = http.client.HTTPConnection(host, port)
+    rng = np.random.default_rng()
+    barrier.wait()
+    for _ in range(n_requests):
+        start = time.perf_counter()
+        if bulk_size > 1:
+            body = json.dumps({"eans": [int(ean) for ean in rng.choice(eans, bulk_size)]})
+            connection.request("POST", "/forecast", body, {"Content-Type": "application/json"})
+        else:
+            connection.request("GET", f"/forecast?ean={rng.choice(eans)}")
+        response = connection.getresponse()
+        response.read()
+        latencies.append(time.perf_counter() - start)
+        if response.status != 200:
+            errors.append(response.status)
+    connection.close()
+
+
+def benchmark_service(host, port, eans, clients=16, requests_per_client=100, bulk_size=1):
+    """Hammers a running forecast service from concurrent clients and reports latency and throughput."""
+    latencies, errors = [], []
+    barrier = threading.Barrier(clients + 1)
+    threads = [threading.Thread(target=_client, args=(host, port, eans, requests_per_client, bulk_size,
+                                                      latencies, errors, barrier))
+               for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - start
+
+    latencies = np.asarray(latencies)
+    return {
+        "requests": len(latencies),
+        "errors": len(errors),
+        "seconds": seconds,
+        "throughput": len(latencies) / seconds,
+        "p50_ms": np.percentile(latencies, 50) * 1000,
+        "p99_ms": np.percentile(latencies, 99) * 1000,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the forecast HTTP service.")
+    parser.add_argument("--url", default=None,
+                        help="URL of a running service (default: start one in this process)")
+    parser.add_argument("--clients", type=int, default=16, help="Number of concurrent clients")
+    parser.add_argument("--requests", type=int, default=100, help="Requests sent by each client")
+    parser.add_argument("--bulk-size", type=int, default=1,
+                        help="EANs per request (1 uses the single-EAN endpoint)")
+    parser.add_argument("--window", type=float, default=BATCH_WINDOW * 1000,
+                        help="Batch window of the in-process service, in milliseconds")
+    args = parser.parse_args()
+
+    models, scaler = load_models()
+    df = load_dataset()
+    eans = np.asarray([ean for ean in df.eans if ean in models])
+
+    server = None
+    if args.url is None:
+        warm_models(df, models)
+        server = create_server(df, models, scaler, port=0, window=args.window / 1000,
+                               table=load_forecast_table(), compiled=load_compiled_forests())
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        host, port = server.server_address[:2]
+    else:
+        url = urlparse(args.url)
+        host, port = url.hostname, url.port or 80
+
+    try:
+        results = benchmark_service(host, port, eans, args.clients, args.requests, args.bulk_size)
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+            server.batcher.close()
+
+    print(f"Requests:   {results['requests']} ({results['errors']} errors) in {results['seconds']:.2f} s")
+    print(f"Throughput: {results['throughput']:.1f} requests/s")
+    print(f"Latency:    p50 {results['p50_ms']:.2f} ms, p99 {results['p99_ms']:.2f} ms")
+    if server is not None:
+        batcher = server.batcher
+        print(f"Batches:    {batcher.batches} for {batcher.requests} requests "
+              f"({batcher.requests / max(batcher.batches, 1):.1f} requests per batch)")
@@ -0,0 +1,63 @@
+import argparse
+import os
+import shutil
+import tempfile
+import time
+import joblib
+import numpy as np
+from model_store import RMSE_FILE
+from model_training import STRATEGIES, retrain_models
+from global_model import DEFAULT_GLOBAL_ESTIMATOR, GLOBAL_ESTIMATORS, MIN_SALES_WEEKS
+from utils import load_dataset, load_scaler
+
+
+def _store_bytes(models_dir):
+    return sum(os.path.getsize(os.path.join(models_dir, filename)) for filename in os.listdir(models_dir)
+               if filename.endswith(".joblib"))
+
+
+def benchmark_strategies(dataset, scaler, strategies=STRATEGIES, n_jobs=None, global_estimator=DEFAULT_GLOBAL_ESTIMATOR,
+                         min_sales_weeks=MIN_SALES_WEEKS):
+    """Trains every strategy into a scratch model store and reports its training time, store size and RMSE."""
+    results = []
+    for strategy in strategies:
+        models_dir = tempfile.mkdtemp(prefix=f"models_{strategy}_")
+        try:
+            start = time.perf_counter()
+            # Not checkpointed: the benchmark writes nothing outside its scratch model store
+            retrain_models(dataset, scaler, models_dir, n_jobs=n_jobs, strategy=strategy,
+                           global_estimator=global_estimator, min_sales_weeks=min_sales_weeks, checkpoint_dir=None)
+            seconds = time.perf_counter() - start
+
+            rmse_values = np.array(list(joblib.load(os.path.join(models_dir, RMSE_FILE)).values()), dtype=float)
+            results.append({
+                "strategy": strategy,
+                "train_seconds": seconds,
+                "artifacts": sum(filename.endswith(".joblib") for filename in os.listdir(models_dir)),
+                "store_bytes": _store_bytes(models_dir),
+                "mean_rmse": float(np.nanmean(rmse_values)),
+                "median_rmse": float(np.nanmedian(rmse_values)),
+            })
+        finally:
+            shutil.rmtree(models_dir, ignore_errors=True)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the training strategies on the preprocessed dataset.")
+    parser.add_argument("--strategies", nargs="+", choices=STRATEGIES, default=list(STRATEGIES),
+                        help="Strategies to compare")
+    parser.add_argument("--jobs", type=int, default=None, help="Number of worker processes")
+    parser.add_argument("--global-estimator", choices=GLOBAL_ESTIMATORS, default=DEFAULT_GLOBAL_ESTIMATOR,
+                        help="Model shared by the EANs of the global and hybrid strategies")
+    parser.add_argument("--min-sales-weeks", type=int, default=MIN_SALES_WEEKS,
+                        help="Hybrid strategy: EANs with fewer weeks with sales use the global model")
+    args = parser.parse_args()
+
+    results = benchmark_strategies(load_dataset(), load_scaler(), args.strategies, args.jobs, args.global_estimator,
+                                   args.min_sales_weeks)
+
+    print(f"{'Strategy':<10} {'Train (s)':>10} {'Artifacts':>10} {'Store (MB)':>11} {'Mean RMSE':>10} {'Median RMSE':>12}")
+    for result in results:
+        print(f"{result['strategy']:<10} {result['train_seconds']:>10.2f} {result['artifacts']:>10} "
+              f"{result['store_bytes'] / 1e6:>11.2f} {result['mean_rmse']:>10.4f} {result['median_rmse']:>12.4f}")
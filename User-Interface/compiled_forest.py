@@ -0,0 +1,283 @@
+import os
+import numpy as np
+from sklearn.ensemble import RandomForestRegressor
+from ean_index import EanIndex, ean_key
+from model_store import MODELS_DIR
+from snapshots import current_snapshot
+
+COMPILED_DIR_NAME = "compiled_forests"
+
+# The forests of every EAN flattened into one set of node arrays, one .npy file each:
+#   eans            sorted EAN keys
+#   tree_offsets    trees of the EAN at position i: roots[tree_offsets[i]:tree_offsets[i + 1]]
+#   roots           node index of the root of each tree
+#   feature         lag compared at each node, -1 for leaves
+#   threshold       split threshold of each node, or the predicted value for leaves
+#   left, right     node index of the children of each node (unused for leaves)
+#   model_versions  ModelStore.version of each EAN when compiled
+#   leaf_values     multi-week forests only: (n_leaves, n_outputs) values of the leaves, whose threshold
+#                   holds their row in this array
+_ARRAYS = ("eans", "tree_offsets", "roots", "feature", "threshold", "left", "right", "model_versions")
+_OPTIONAL_ARRAYS = ("leaf_values",)
+
+
+def compile_forest(model):
+    """Flattens a fitted RandomForestRegressor into (roots, feature, threshold, left, right, leaf_values) arrays.
+
+    Node indices are local to the returned arrays. leaf_values is None for
+    single-output forests, whose leaves store their value in place of the
+    threshold; leaves of multi-week forests store their row in leaf_values.
+    """
+    roots, features, thresholds, lefts, rights, leaf_values = [], [], [], [], [], []
+    n_nodes = n_leaves = 0
+    for estimator in model.estimators_:
+        tree = estimator.tree_
+        leaves = tree.children_left == -1
+
+        roots.append(n_nodes)
+        features.append(np.where(leaves, -1, tree.feature).astype("int8"))
+        if model.n_outputs_ == 1:
+            # Leaves store their value in place of the threshold
+            thresholds.append(np.where(leaves, tree.value[:, 0, 0], tree.threshold))
+        else:
+            thresholds.append(np.where(leaves, n_leaves + np.cumsum(leaves) - 1, tree.threshold))
+            leaf_values.append(tree.value[leaves, :, 0])
+            n_leaves += int(leaves.sum())
+        lefts.append(np.where(leaves, 0, tree.children_left + n_nodes).astype("int32"))
+        rights.append(np.where(leaves, 0, tree.children_right + n_nodes).astype("int32"))
+        n_nodes += tree.node_count
+
+    return (np.array(roots, dtype="int32"), np.concatenate(features), np.concatenate(thresholds),
+            np.concatenate(lefts), np.concatenate(rights), np.concatenate(leaf_values) if leaf_values else None)
+
+
+def compile_models(models, eans, model_versions):
+    """Flattens the forests of the given EANs into the arrays of a CompiledForests.
+
+    EANs whose model is not a Random Forest (e.g. a shared global model) are left out,
+    and so are the forests predicting a different number of weeks than the first one.
+    """
+    compiled_eans = []
+    tree_offsets = [0]
+    parts = {name: [] for name in ("roots", "feature", "threshold", "left", "right", "leaf_values")}
+    n_nodes = n_leaves = 0
+    n_outputs = None
+    for ean in np.unique(np.asarray([ean_key(ean) for ean in eans], dtype="int64")):
+        model = models[ean]
+        if not isinstance(model, RandomForestRegressor):
+            continue
+        if n_outputs is None:
+            n_outputs = model.n_outputs_
+        if model.n_outputs_ != n_outputs:
+            continue
+
+        compiled_eans.append(ean)
+        roots, feature, threshold, left, right, leaf_values = compile_forest(model)
+        parts["roots"].append(roots + n_nodes)
+        parts["feature"].append(feature)
+        if leaf_values is not None:
+            # Leaf rows become indices into the leaf values of every forest
+            threshold = np.where(feature < 0, threshold + n_leaves, threshold)
+            parts["leaf_values"].append(leaf_values)
+            n_leaves += len(leaf_values)
+        parts["threshold"].append(threshold)
+        # Leaves keep 0 as children, pointing at a node that is never visited from them
+        parts["left"].append(np.where(feature < 0, 0, left + n_nodes).astype("int32"))
+        parts["right"].append(np.where(feature < 0, 0, right + n_nodes).astype("int32"))
+        n_nodes += len(feature)
+        tree_offsets.append(tree_offsets[-1] + len(roots))
+
+    leaf_values = parts.pop("leaf_values")
+    arrays = {name: np.concatenate(values) if values else np.empty(0) for name, values in parts.items()}
+    if leaf_values:
+        arrays["leaf_values"] = np.concatenate(leaf_values)
+    arrays["roots"] = arrays["roots"].astype("int32")
+    arrays["feature"] = arrays["feature"].astype("int8")
+    arrays["left"] = arrays["left"].astype("int32")
+    arrays["right"] = arrays["right"].astype("int32")
+    eans = np.array(compiled_eans, dtype="int64")
+    arrays["eans"] = eans
+    arrays["tree_offsets"] = np.array(tree_offsets, dtype="int64")
+    arrays["model_versions"] = np.array([model_versions(ean) for ean in eans], dtype="U32")
+    return arrays
+
+
+def _ranges(starts, counts):
+    """Returns the concatenation of the ranges starts[i]:starts[i] + counts[i]."""
+    counts = np.asarray(counts, dtype=np.int64)
+    offsets = np.repeat(np.asarray(starts, dtype=np.int64) - np.cumsum(counts) + counts, counts)
+    return offsets + np.arange(counts.sum())
+
+
+def merge_compiled_forests(base, update, removed=()):
+    """Returns the arrays of the base CompiledForests with the forests of update added or replacing theirs.
+
+    The forests of the removed EANs are dropped. The nodes of replaced and
+    dropped forests are left out, so the result is laid out like
+    compile_models would lay out the same forests. base and update must
+    predict the same number of weeks.
+    """
+    if len(base) and len(update) and base.n_outputs != update.n_outputs:
+        raise ValueError(f"Can't merge forests of {update.n_outputs} weeks into forests of {base.n_outputs}")
+    multi_output = base.leaf_values is not None or update.leaf_values is not None
+    dropped = np.union1d(np.asarray(update.eans), np.asarray(list(removed), dtype="int64"))
+
+    # Pool the nodes of both, then gather the forests of each EAN in EAN order
+    pool = {name: [] for name in ("eans", "model_versions", "roots", "feature", "threshold", "left", "right",
+                                  "leaf_values", "tree_starts", "tree_counts", "node_starts", "node_counts",
+                                  "leaf_starts", "leaf_counts")}
+    n_trees = n_nodes = n_leaves = 0
+    for forests, positions in ((base, np.flatnonzero(~np.isin(np.asarray(base.eans), dropped))),
+                               (update, np.arange(len(update)))):
+        tree_offsets = np.asarray(forests.tree_offsets, dtype=np.int64)
+        roots = np.asarray(forests.roots, dtype=np.int64)
+        feature = np.asarray(forests.feature)
+        threshold = np.array(forests.threshold, dtype=np.float64)
+        # compile_models lays out the nodes and leaf values of the forests in EAN order
+        node_starts = np.append(roots[tree_offsets[:-1]], len(feature))
+        leaf_starts = np.concatenate(([0], np.cumsum(feature < 0)))[node_starts]
+        if forests.leaf_values is not None:
+            threshold[feature < 0] += n_leaves
+            pool["leaf_values"].append(np.asarray(forests.leaf_values))
+
+        pool["eans"].append(np.asarray(forests.eans)[positions])
+        pool["model_versions"].append(np.asarray(forests.model_versions)[positions])
+        pool["roots"].append(roots + n_nodes)
+        pool["feature"].append(feature)
+        pool["threshold"].append(threshold)
+        pool["left"].append(np.asarray(forests.left, dtype=np.int64) + n_nodes)
+        pool["right"].append(np.asarray(forests.right, dtype=np.int64) + n_nodes)
+        for name, starts, base_offset in (("tree", tree_offsets, n_trees), ("node", node_starts, n_nodes),
+                                          ("leaf", leaf_starts, n_leaves)):
+            pool[f"{name}_starts"].append(starts[positions] + base_offset)
+            pool[f"{name}_counts"].append(np.diff(starts)[positions])
+        n_trees += len(roots)
+        n_nodes += len(feature)
+        n_leaves += len(forests.leaf_values) if forests.leaf_values is not None else 0
+
+    pool = {name: np.concatenate(values) if values else None for name, values in pool.items()}
+    order = np.argsort(pool["eans"], kind="stable")
+    trees = _ranges(pool["tree_starts"][order], pool["tree_counts"][order])
+    nodes = _ranges(pool["node_starts"][order], pool["node_counts"][order])
+
+    # Position of each kept pool node in the merged arrays
+    new_nodes = np.zeros(n_nodes, dtype=np.int64)
+    new_nodes[nodes] = np.arange(len(nodes))
+
+    feature = pool["feature"][nodes]
+    leaves = feature < 0
+    threshold = pool["threshold"][nodes]
+    arrays = {
+        "eans": pool["eans"][order].astype("int64"),
+        "tree_offsets": np.concatenate(([0], np.cumsum(pool["tree_counts"][order]))).astype("int64"),
+        "roots": new_nodes[pool["roots"][trees]].astype("int32"),
+        "feature": feature.astype("int8"),
+        "threshold": threshold,
+        # Leaves keep 0 as children, like in compile_models
+        "left": np.where(leaves, 0, new_nodes[pool["left"][nodes]]).astype("int32"),
+        "right": np.where(leaves, 0, new_nodes[pool["right"][nodes]]).astype("int32"),
+        "model_versions": pool["model_versions"][order].astype("U32"),
+    }
+    if multi_output:
+        leaf_rows = _ranges(pool["leaf_starts"][order], pool["leaf_counts"][order])
+        new_leaves = np.zeros(n_leaves, dtype=np.int64)
+        new_leaves[leaf_rows] = np.arange(len(leaf_rows))
+        threshold[leaves] = new_leaves[threshold[leaves].astype(np.int64)]
+        arrays["leaf_values"] = pool["leaf_values"][leaf_rows]
+    return arrays
+
+
+def save_compiled_forests(arrays, models_dir=MODELS_DIR):
+    """Saves compiled forests next to the models, one .npy file per array."""
+    compiled_dir = os.path.join(models_dir, COMPILED_DIR_NAME)
+    os.makedirs(compiled_dir, exist_ok=True)
+    for name in _ARRAYS + _OPTIONAL_ARRAYS:
+        path = os.path.join(compiled_dir, f"{name}.npy")
+        if name in arrays:
+            with open(path + ".tmp", "wb") as f:
+                np.save(f, arrays[name])
+            os.replace(path + ".tmp", path)
+        elif os.path.exists(path):
+            os.remove(path)  # Left by forests of another number of outputs
+
+
+def load_compiled_forests(models_dir=None):
+    """Opens the compiled forests saved with the models (default: of the current snapshot, memory-mapped),
+    or returns None if there are none."""
+    if models_dir is None:
+        models_dir = current_snapshot().models_dir
+    compiled_dir = os.path.join(models_dir, COMPILED_DIR_NAME)
+    if not all(os.path.exists(os.path.join(compiled_dir, f"{name}.npy")) for name in _ARRAYS):
+        return None
+    return CompiledForests({name: np.load(os.path.join(compiled_dir, f"{name}.npy"), mmap_mode="r")
+                            for name in _ARRAYS + _OPTIONAL_ARRAYS
+                            if os.path.exists(os.path.join(compiled_dir, f"{name}.npy"))})
+
+
+class CompiledForests:
+    """Vectorized evaluator of the flattened per-EAN forests.
+
+    Rows of many EANs are evaluated together: every (row, tree) pair walks
+    down its tree one level per iteration, then the leaf values of each row
+    are averaged in tree order, giving the same result as
+    RandomForestRegressor.predict.
+    """
+
+    def __init__(self, arrays):
+        for name in _ARRAYS + _OPTIONAL_ARRAYS:
+            setattr(self, name, arrays.get(name))
+        self.index = EanIndex(self.eans, is_sorted=True)
+
+    def __len__(self):
+        return len(self.eans)
+
+    @property
+    def nbytes(self):
+        return sum(np.asarray(getattr(self, name)).nbytes for name in _ARRAYS + _OPTIONAL_ARRAYS
+                   if getattr(self, name) is not None)
+
+    @property
+    def n_outputs(self):
+        """Number of consecutive weeks predicted by the compiled forests."""
+        return 1 if self.leaf_values is None else self.leaf_values.shape[1]
+
+    def covers(self, eans, models):
+        """Returns a mask of the EANs whose compiled forest is the one of their current model."""
+        keys = np.asarray(eans, dtype="int64")
+        positions = self.index.find_many(keys)
+        found = positions >= 0
+        if hasattr(models, "version"):
+            for i in np.flatnonzero(found):
+                found[i] = self.model_versions[positions[i]] == models.version(int(keys[i]))
+        return found
+
+    def predict(self, eans, X):
+        """Predicts row X[i] with the forest of eans[i]. Every EAN must be compiled.
+
+        Returns one value per row, or a (rows, n_outputs) array for multi-week forests.
+        """
+        positions = self.index.find_many(eans).astype(np.int64)
+        # Same input conversion as the trees: float32 values compared with float64 thresholds
+        X = np.asarray(X, dtype=np.float32).astype(np.float64)
+
+        tree_offsets = np.asarray(self.tree_offsets)
+        n_trees = tree_offsets[positions + 1] - tree_offsets[positions]
+        rows = np.repeat(np.arange(len(positions)), n_trees)
+        trees = np.repeat(tree_offsets[positions] - np.cumsum(n_trees) + n_trees, n_trees) + np.arange(n_trees.sum())
+        nodes = np.asarray(self.roots)[trees].astype(np.int64)
+
+        feature, threshold = np.asarray(self.feature), np.asarray(self.threshold)
+        left, right = np.asarray(self.left), np.asarray(self.right)
+        active = np.flatnonzero(feature[nodes] >= 0)
+        while len(active):
+            current = nodes[active]
+            go_left = X[rows[active], feature[current]] <= threshold[current]
+            nodes[active] = np.where(go_left, left[current], right[current])
+            active = active[feature[nodes[active]] >= 0]
+
+        # bincount adds the leaf values of each row in tree order, like the forest's running sum
+        if self.leaf_values is None:
+            return np.bincount(rows, weights=threshold[nodes], minlength=len(positions)) / n_trees
+        leaf_values = np.asarray(self.leaf_values)[threshold[nodes].astype(np.int64)]
+        return np.column_stack([np.bincount(rows, weights=leaf_values[:, output], minlength=len(positions))
+                                for output in range(leaf_values.shape[1])]) / n_trees[:, None]
@@ -0,0 +1,305 @@
+import hashlib
+import os
+import numpy as np
+import pandas as pd
+from ean_index import EanIndex
+
+STORE_DIR = "../Dataset/weekly_consumption_store"
+
+# One .npy file per array, memory-mapped when the store is opened.
+# Only the weeks with sales are stored, as (EAN, week, quantity) triples sorted by EAN and week:
+#   weeks        calendar of all the weeks of the dataset (datetime64)
+#   eans         sorted EAN keys, with offsets/lengths locating their triples
+#   week_range   [first, last + 1) calendar index of the series of each EAN
+#   week_index   calendar index of each stored week
+#   quantity     unscaled quantity of each stored week
+#   scaling      mean and scale used to standardize the consumption
+_ARRAYS = ("weeks", "eans", "offsets", "lengths", "week_range", "week_index", "quantity", "scaling")
+# Optional arrays, missing from stores written by older versions:
+#   fingerprints  per-EAN content hashes
+#   ean_scaling   (n_eans, 2) mean and scale of each EAN, replacing the global scaling when present
+_OPTIONAL_ARRAYS = ("fingerprints", "ean_scaling")
+
+
+def series_fingerprints(weekly_consumption):
+    """Hashes the (week, quantity) pairs of the weeks with sales of each EAN.
+
+    Must be computed on unscaled quantities. Weeks without sales are ignored,
+    so zero-filled weeks added to the calendar don't change a fingerprint.
+    """
+    sales = weekly_consumption[weekly_consumption["Total_Weekly_Consumption"] != 0]
+    sales = pd.DataFrame({
+        "EAN": pd.to_numeric(sales["EAN"]).astype("int64"),
+        "Week_Start": pd.to_datetime(sales["Week_Start"]).astype("int64"),
+        "Total_Weekly_Consumption": sales["Total_Weekly_Consumption"].astype(float),
+    }).sort_values(["EAN", "Week_Start"], kind="stable")
+
+    fingerprints = {}
+    for ean, rows in sales.groupby("EAN", sort=False):
+        digest = hashlib.blake2b(digest_size=8)
+        digest.update(rows["Week_Start"].to_numpy().tobytes())
+        digest.update(rows["Total_Weekly_Consumption"].to_numpy().tobytes())
+        fingerprints[ean] = int.from_bytes(digest.digest(), "little")
+    return fingerprints
+
+
+def build_store_arrays(weekly_sales, weeks, products, scaler, fingerprints=None):
+    """Builds the arrays of the store: the weeks with sales of every product, indexed by EAN.
+
+    weekly_sales holds the unscaled EAN / Week_Start / Total_Weekly_Consumption
+    of the weeks with sales. The series of each product covers the whole
+    `weeks` calendar; the missing weeks are zero-filled when read.
+    """
+    weeks = np.sort(np.asarray(weeks, dtype="datetime64[ns]"))
+    eans = np.unique(pd.to_numeric(pd.Series(products)).astype("int64").to_numpy())
+
+    sales = weekly_sales[weekly_sales["Total_Weekly_Consumption"] != 0]
+    sales = pd.DataFrame({
+        "EAN": pd.to_numeric(sales["EAN"]).astype("int64"),
+        "week_index": np.searchsorted(weeks, pd.to_datetime(sales["Week_Start"]).to_numpy(dtype="datetime64[ns]")),
+        "quantity": sales["Total_Weekly_Consumption"].astype(float),
+    }).sort_values(["EAN", "week_index"], kind="stable")
+
+    # Each EAN is a contiguous block of triples: EAN -> (offset, length)
+    lengths = pd.Series(sales.groupby("EAN").size()).reindex(eans, fill_value=0).to_numpy()
+    offsets = np.r_[0, np.cumsum(lengths)[:-1]]
+
+    arrays = {
+        "weeks": weeks,
+        "eans": eans,
+        "offsets": offsets.astype("int64"),
+        "lengths": lengths.astype("int64"),
+        "week_range": np.tile(np.array([0, len(weeks)], dtype="int32"), (len(eans), 1)),
+        "week_index": sales["week_index"].to_numpy(dtype="int32"),
+        "quantity": sales["quantity"].to_numpy(),
+        "scaling": np.array([scaler.mean_[0], scaler.scale_[0]]),
+    }
+    if fingerprints is not None:
+        arrays["fingerprints"] = np.array([fingerprints.get(ean, 0) for ean in eans], dtype="uint64")
+    return arrays
+
+
+def fit_ean_scaling(arrays, previous=None):
+    """Returns the (n_eans, 2) mean and scale of each EAN's zero-filled series, for the ean_scaling array.
+
+    Same values as a StandardScaler fitted on each series alone, computed
+    for every EAN at once from the weeks with sales. With the previous store
+    given, EANs whose sales are unchanged (same fingerprint) keep their
+    previous scaling, so that their trained models stay valid.
+    """
+    lengths = np.asarray(arrays["lengths"])
+    week_range = np.asarray(arrays["week_range"])
+    n_weeks = (week_range[:, 1] - week_range[:, 0]).astype(float)
+    quantity = np.asarray(arrays["quantity"], dtype=float)
+
+    # Sums over the weeks with sales; the zero-filled weeks only add to the counts
+    codes = np.repeat(np.arange(len(lengths)), lengths)
+    counts = np.maximum(n_weeks, 1)
+    mean = np.bincount(codes, quantity, minlength=len(lengths)) / counts
+    var = (np.bincount(codes, (quantity - mean[codes]) ** 2, minlength=len(lengths))
+           + (n_weeks - lengths) * mean ** 2) / counts
+    scaling = np.column_stack([mean, np.where(var > 0, np.sqrt(var), 1.0)])
+
+    if previous is not None and previous.ean_scaling is not None and previous.fingerprints is not None \
+            and "fingerprints" in arrays:
+        positions = previous.index.find_many(arrays["eans"])
+        found = positions >= 0
+        found[found] = np.asarray(previous.fingerprints)[positions[found]] == np.asarray(arrays["fingerprints"])[found]
+        scaling[found] = np.asarray(previous.ean_scaling)[positions[found]]
+    return scaling
+
+
+def save_store_arrays(arrays, store_dir=STORE_DIR):
+    """Saves the store arrays, one .npy file each."""
+    os.makedirs(store_dir, exist_ok=True)
+    for name in _ARRAYS + _OPTIONAL_ARRAYS:
+        path = os.path.join(store_dir, f"{name}.npy")
+        if name in arrays:
+            # Write a new file and swap it in: open memory maps keep reading the previous one
+            with open(path + ".tmp", "wb") as f:
+                np.save(f, arrays[name])
+            os.replace(path + ".tmp", path)
+        elif os.path.exists(path):
+            # An optional array of a previous store, which doesn't describe this one
+            os.remove(path)
+
+
+def write_store(weekly_sales, weeks, products, scaler, store_dir=STORE_DIR, fingerprints=None):
+    """Builds and saves the store of the weeks with sales of every product."""
+    save_store_arrays(build_store_arrays(weekly_sales, weeks, products, scaler, fingerprints), store_dir)
+
+
+class WeeklyConsumptionStore:
+    """Read-only, memory-mapped view of the preprocessed weekly consumption.
+
+    Consumption values are returned standardized, with the weeks without
+    sales zero-filled on the fly. Stores with an ean_scaling array
+    standardize each EAN with its own mean and scale, the others with the
+    global scaling.
+    """
+
+    def __init__(self, store_dir=STORE_DIR, arrays=None):
+        # Folder the store was opened from, None when served from memory
+        self.store_dir = store_dir if arrays is None else None
+        if arrays is None:
+            arrays = {}
+            for name in _ARRAYS:
+                arrays[name] = np.load(os.path.join(store_dir, f"{name}.npy"), mmap_mode="r")
+            for name in _OPTIONAL_ARRAYS:
+                path = os.path.join(store_dir, f"{name}.npy")
+                if os.path.exists(path):
+                    arrays[name] = np.load(path, mmap_mode="r")
+
+        # arrays given directly (from build_store_arrays) serve the data from memory
+        for name in _ARRAYS + _OPTIONAL_ARRAYS:
+            setattr(self, name, arrays.get(name))
+
+        self.index = EanIndex(self.eans, is_sorted=True)
+        self.mean, self.scale = (float(value) for value in self.scaling)
+        if self.ean_scaling is not None:
+            # Small enough to keep in memory as contiguous columns for the broadcasts
+            self.ean_mean = np.ascontiguousarray(self.ean_scaling[:, 0], dtype=float)
+            self.ean_scale = np.ascontiguousarray(self.ean_scaling[:, 1], dtype=float)
+
+    def __len__(self):
+        return len(self.eans)
+
+    def __contains__(self, ean):
+        return self._locate(ean) is not None
+
+    def _locate(self, ean):
+        """Returns the index position of an EAN with a binary search, or None if it is unknown."""
+        return self.index.find(ean)
+
+    def _scaled(self, quantity, positions):
+        # Same operations as StandardScaler.transform, with the scaling of the EANs at these positions if any
+        if self.ean_scaling is None:
+            return (quantity - self.mean) / self.scale
+        return (quantity - self.ean_mean[positions]) / self.ean_scale[positions]
+
+    def scaling_of(self, ean):
+        """Returns the (mean, scale) of an EAN when the store scales each EAN separately, else None."""
+        position = self._locate(ean)
+        if self.ean_scaling is None or position is None:
+            return None
+        return float(self.ean_mean[position]), float(self.ean_scale[position])
+
+    def scaled_zero(self, ean):
+        """Returns the scaled value of the weeks without sales of an EAN of the store."""
+        return float(self._scaled(0.0, self._locate(ean)))
+
+    def unscale(self, values, eans):
+        """Inverse-transforms scaled values in place and returns them.
+
+        values holds one row per EAN of eans, or the 1-D series of a single
+        EAN. Raises KeyError if an EAN is not in the store.
+        """
+        if self.ean_scaling is None:
+            mean, scale = self.mean, self.scale
+        else:
+            positions = self.index.find_many(eans)
+            if np.any(positions < 0):
+                raise KeyError(f"EAN not in the dataset store: {np.atleast_1d(eans)[np.atleast_1d(positions) < 0][0]}")
+            mean, scale = self.ean_mean[positions], self.ean_scale[positions]
+            if np.ndim(values) == 2:
+                mean, scale = mean[:, None], scale[:, None]
+
+        # Same operations as StandardScaler.inverse_transform, without the reshaped copies
+        values *= scale
+        values += mean
+        return values
+
+    def series(self, ean):
+        """Returns the week start dates and the zero-filled, scaled consumption of an EAN."""
+        position = self._locate(ean)
+        if position is None:
+            return None
+
+        start, end = (int(value) for value in self.week_range[position])
+        offset, length = int(self.offsets[position]), int(self.lengths[position])
+
+        # Zero-fill the series, then scatter the weeks with sales (only this EAN's triples are read)
+        values = np.full(end - start, self._scaled(0.0, position))
+        values[np.asarray(self.week_index[offset:offset + length]) - start] = \
+            self._scaled(np.asarray(self.quantity[offset:offset + length]), position)
+        return np.asarray(self.weeks[start:end]), values
+
+    def version(self, ean):
+        """Returns a hash of everything the forecast of an EAN depends on, or None if the EAN is unknown.
+
+        Covers the weeks with sales, the last week of the series and the scaling of the EAN.
+        """
+        position = self._locate(ean)
+        if position is None:
+            return None
+
+        offset, length = int(self.offsets[position]), int(self.lengths[position])
+        end = int(self.week_range[position][1])
+        digest = hashlib.blake2b(digest_size=8)
+        digest.update(np.asarray(self.weeks)[np.asarray(self.week_index[offset:offset + length])].tobytes())
+        digest.update(np.asarray(self.quantity[offset:offset + length]).tobytes())
+        digest.update(np.asarray(self.weeks[end - 1:end]).tobytes())
+        if self.ean_scaling is None:
+            digest.update(np.asarray(self.scaling).tobytes())
+        else:
+            digest.update(np.asarray(self.ean_scaling[position]).tobytes())
+        return digest.hexdigest()
+
+    def last_weeks(self, eans):
+        """Returns the start of the last week of the series of each EAN, NaT for the EANs not in the store."""
+        positions = self.index.find_many(eans)
+        ends = np.asarray(self.week_range)[positions, 1]
+        last_weeks = np.asarray(self.weeks)[ends - 1]
+        last_weeks[positions < 0] = np.datetime64("NaT")
+        return last_weeks
+
+    def history(self, ean):
+        """Returns the weekly consumption of a single EAN as a DataFrame."""
+        series = self.series(ean)
+        if series is None:
+            return None
+
+        week_start, values = series
+        return pd.DataFrame({
+            "EAN": np.full(len(values), self.eans[self._locate(ean)]),
+            "Week_Start": week_start,
+            "Total_Weekly_Consumption": values,
+        })
+
+    def tail_matrix(self, n, eans=None):
+        """Returns the EANs, their last week start and their last n values (most recent first).
+
+        EANs with fewer than n weeks are left out.
+        """
+        positions = np.arange(len(self.eans))
+        if eans is not None:
+            # Binary search of all the requested EANs at once, dropping the unknown ones
+            positions = self.index.find_many(list(eans))
+            positions = np.unique(positions[positions >= 0]).astype(np.int64)
+
+        week_range = np.asarray(self.week_range)[positions]
+        positions = positions[week_range[:, 1] - week_range[:, 0] >= n]
+        ends = np.asarray(self.week_range)[positions, 1]
+
+        # Zero-filled matrix, then the stored weeks that fall in the last n weeks of each EAN
+        matrix = np.empty((len(positions), n))
+        matrix[:] = np.reshape(self._scaled(np.zeros(len(positions)), positions), (-1, 1))
+        lengths = np.asarray(self.lengths)[positions]
+        rows = np.repeat(np.arange(len(positions)), lengths)
+        entries = (np.repeat(np.asarray(self.offsets)[positions], lengths)
+                   + np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths))
+        weeks_from_end = ends[rows] - 1 - np.asarray(self.week_index)[entries]
+        recent = (weeks_from_end >= 0) & (weeks_from_end < n)
+        matrix[rows[recent], weeks_from_end[recent]] = self._scaled(np.asarray(self.quantity)[entries[recent]],
+                                                                    positions[rows[recent]])
+
+        return (np.asarray(self.eans)[positions], pd.to_datetime(np.asarray(self.weeks)[ends - 1]), matrix)
+
+    def to_frame(self, eans=None):
+        """Returns the zero-filled dataset (or only the given EANs) as a DataFrame sorted by EAN and week."""
+        keys = self.eans if eans is None else sorted(eans)
+        histories = [self.history(ean) for ean in keys]
+        histories = [history for history in histories if history is not None]
+        if not histories:
+            return pd.DataFrame(columns=["EAN", "Week_Start", "Total_Weekly_Consumption"])
+        return pd.concat(histories, ignore_index=True)
@@ -0,0 +1,108 @@
+import numpy as np
+
+# Longest EAN key held by an int64, in decimal digits
+MAX_KEY_DIGITS = 19
+_MAX_KEY = np.iinfo(np.int64).max
+
+# EANs are written with at least this many digits (EAN-13), the integer keys losing their leading zeros
+EAN_DIGITS = 13
+
+
+def ean_key(ean):
+    """Returns the integer key of an EAN given as int, float or string, or None if it is not a valid EAN."""
+    try:
+        key = int(ean)
+    except (TypeError, ValueError):
+        return None
+    if key != ean and not isinstance(ean, str):
+        return None  # e.g. a float EAN with a fractional part
+    if not 0 <= key <= _MAX_KEY:
+        return None
+    return key
+
+
+def format_ean(key):
+    """Writes an EAN key with its leading zeros, zero-padded to EAN_DIGITS digits."""
+    return str(int(key)).zfill(EAN_DIGITS)
+
+
+class EanIndex:
+    """Sorted EAN keys, giving each EAN a dense int32 id: its position among the keys.
+
+    The dataset store, the model store, the compiled forests and the
+    forecast table all keep their EANs as such a sorted int64 array. Exact
+    lookups are binary searches; prefix searches need one binary search per
+    key length, since the keys of a given length starting with given digits
+    form a contiguous range of integers.
+    """
+
+    def __init__(self, keys, is_sorted=False):
+        # Sorted arrays (possibly memory-mapped) are used as they are
+        if not is_sorted:
+            keys = np.unique(np.asarray(keys, dtype="int64"))
+        self.keys = keys
+
+    @classmethod
+    def from_eans(cls, eans):
+        """Builds the index of EANs given in any form ean_key accepts, skipping the invalid ones."""
+        keys = [ean_key(ean) for ean in eans]
+        return cls(np.array([key for key in keys if key is not None], dtype="int64"))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, ean):
+        return self.find(ean) is not None
+
+    def find(self, ean):
+        """Returns the id of an EAN, or None if it is not in the index."""
+        key = ean_key(ean)
+        if key is None:
+            return None
+
+        position = int(np.searchsorted(self.keys, key))
+        if position == len(self.keys) or self.keys[position] != key:
+            return None
+        return position
+
+    def find_many(self, keys):
+        """Returns the ids of many integer keys at once (same shape), -1 for the keys not in the index."""
+        keys = np.asarray(keys, dtype="int64")
+        flat_keys = keys.ravel()
+        positions = np.searchsorted(self.keys, flat_keys)
+        found = positions < len(self.keys)
+        found[found] = np.asarray(self.keys)[positions[found]] == flat_keys[found]
+        return np.where(found, positions, -1).astype("int32").reshape(keys.shape)
+
+    def search_prefix(self, prefix, limit=10):
+        """Returns up to `limit` keys whose written form (see format_ean) starts with `prefix`, shortest first.
+
+        Leading zeros of the prefix count: "0012" matches the keys written
+        0012..., i.e. the keys below 10 ** EAN_DIGITS padded with zeros.
+        """
+        digits = str(prefix).strip()
+        if not digits.isdigit() or limit <= 0:
+            return np.empty(0, dtype="int64")
+
+        start = int(digits)
+        matches = []
+        n_matches = 0
+        # Keys of up to EAN_DIGITS digits are written with EAN_DIGITS digits, the longer ones without leading
+        # zeros: a prefix starting with a zero only matches the padded keys
+        last_length = EAN_DIGITS if digits[0] == "0" else MAX_KEY_DIGITS
+        for n_digits in range(max(len(digits), EAN_DIGITS), last_length + 1):
+            low = start * 10 ** (n_digits - len(digits))
+            if low > _MAX_KEY:
+                break
+            high = (start + 1) * 10 ** (n_digits - len(digits))
+
+            # Keys of n_digits digits starting with the prefix: [low, high)
+            first = int(np.searchsorted(self.keys, low))
+            last = len(self.keys) if high > _MAX_KEY else int(np.searchsorted(self.keys, high))
+            if last > first:
+                matches.append(np.asarray(self.keys[first:min(last, first + limit - n_matches)]))
+                n_matches += len(matches[-1])
+                if n_matches == limit:
+                    break
+
+        return np.concatenate(matches) if matches else np.empty(0, dtype="int64")
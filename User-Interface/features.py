@@ -0,0 +1,62 @@
+import numpy as np
+
+# Number of past weeks used as features, shared by training and prediction
+N_LAGS = 4
+LAG_COLUMNS = [f"Lag_{lag}" for lag in range(1, N_LAGS + 1)]
+
+
+def add_lag_features(df, value_column="Total_Weekly_Consumption"):
+    """Adds the Lag_1..Lag_4 columns for every EAN in a single sorted pass."""
+    # Sort once so that each EAN is a contiguous block of consecutive weeks
+    df = df.sort_values(["EAN", "Week_Start"], kind="stable").reset_index(drop=True)
+
+    values = df[value_column].to_numpy(dtype=float)
+    eans = df["EAN"].to_numpy()
+
+    # Position of each row inside its EAN block (0 for the first week of an EAN)
+    block_start = np.flatnonzero(np.r_[True, eans[1:] != eans[:-1]])
+    block_lengths = np.diff(np.r_[block_start, len(df)])
+    position = np.arange(len(df)) - np.repeat(block_start, block_lengths)
+
+    # Shift the whole column at once and blank the values that would cross into the previous EAN
+    for lag, column in enumerate(LAG_COLUMNS, start=1):
+        lagged = np.full(len(df), np.nan)
+        lagged[lag:] = values[:-lag]
+        lagged[position < lag] = np.nan
+        df[column] = lagged
+
+    return df
+
+
+def lag_windows(values, horizon=1):
+    """Returns the lag vectors (X) and targets (y) of a single weekly series.
+
+    Same rows as add_lag_features followed by dropping the weeks without a
+    full lag history, built from a strided view of the series. With
+    horizon > 1, y holds the next `horizon` weeks of each lag vector, one
+    column per week, and the last weeks without a full horizon are dropped.
+    """
+    values = np.asarray(values, dtype=float)
+    if len(values) < N_LAGS + horizon:
+        return np.empty((0, N_LAGS)), (np.empty(0) if horizon == 1 else np.empty((0, horizon)))
+
+    # Each window holds N_LAGS past weeks followed by the target week(s)
+    windows = np.lib.stride_tricks.sliding_window_view(values, N_LAGS + horizon)
+    targets = windows[:, N_LAGS] if horizon == 1 else windows[:, N_LAGS:]
+    return windows[:, N_LAGS - 1::-1].copy(), targets.copy()
+
+
+def next_lag_features(values):
+    """Returns the lag vector used to predict the week following `values`."""
+    # Most recent week first, matching Lag_1..Lag_4
+    return np.asarray(values, dtype=float)[:-N_LAGS - 1:-1]
+
+
+def roll_lag_features(lags, new_value):
+    """Shifts the lag vector by one week, making `new_value` the new Lag_1."""
+    return np.concatenate(([new_value], lags[:-1]))
+
+
+def model_outputs(model):
+    """Returns the number of consecutive weeks a model predicts from one lag vector."""
+    return getattr(model, "n_outputs_", 1)
@@ -0,0 +1,54 @@
+import argparse
+import os
+from compiled_forest import load_compiled_forests
+from instrumentation import add_instrumentation_arguments, configure_from_args, stage
+from prediction import iter_batch_forecasts
+from snapshots import current_snapshot
+from utils import load_models, load_dataset
+
+
+def write_forecasts(batches, output_path):
+    """Streams forecast batches to a CSV or Parquet file without holding them all in memory."""
+    if output_path.endswith(".parquet"):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError("Writing Parquet files requires pyarrow (pip install pyarrow)")
+
+        writer = None
+        try:
+            for batch in batches:
+                table = pa.Table.from_pandas(batch, preserve_index=False)
+                if writer is None:
+                    writer = pq.ParquetWriter(output_path, table.schema)
+                writer.write_table(table)
+        finally:
+            if writer is not None:
+                writer.close()
+    else:
+        # Write the header with the first batch, then append
+        for i, batch in enumerate(batches):
+            batch.to_csv(output_path, mode="w" if i == 0 else "a", header=(i == 0), index=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Forecast the weekly consumption of many EANs at once.")
+    parser.add_argument("output", help="Output file (.csv or .parquet)")
+    parser.add_argument("--eans", nargs="+", type=int, default=None,
+                        help="EANs to forecast (default: every EAN with a trained model)")
+    parser.add_argument("--horizon", type=int, default=None,
+                        help="Number of weeks to forecast (default: the one set by the training of the models)")
+    parser.add_argument("--batch-size", type=int, default=1000, help="Number of EANs written at once")
+    add_instrumentation_arguments(parser)
+    args = parser.parse_args()
+    configure_from_args(args)
+
+    snapshot = current_snapshot()
+    models, scaler = load_models(snapshot=snapshot)
+    df = load_dataset(snapshot)
+
+    with stage("forecast.write", horizon=args.horizon):
+        write_forecasts(iter_batch_forecasts(df, models, scaler, args.eans, args.horizon, args.batch_size,
+                                             load_compiled_forests(snapshot.models_dir)), args.output)
+    print(f"Forecasts saved to {os.path.abspath(args.output)}")
@@ -0,0 +1,153 @@
+import os
+import threading
+from collections import OrderedDict
+import joblib
+from dataset_store import WeeklyConsumptionStore
+from ean_index import ean_key
+from prediction import forecast_horizon, predict_consumption
+
+FORECAST_CACHE_DIR = "../Models/forecast_cache"
+
+# Default number of forecasts kept in memory
+MAX_CACHED_FORECASTS = 1024
+
+
+class ForecastCache:
+    """Caches the results of predict_consumption.
+
+    Entries are keyed by (EAN, dataset version of the EAN, model version of
+    the EAN, forecast horizon), so a new dataset, a retrained model or a new
+    horizon never serves a stale forecast. Recent forecasts are kept in a
+    bounded in-memory LRU; with a cache_dir, every forecast is also saved to
+    disk (one file per EAN) and survives restarts.
+
+    With a forecast table (see forecast_table.py), misses are served from
+    the table while it is valid for the EAN, the model only runs otherwise.
+
+    The cached (dates, predictions, history) tuples are shared between
+    callers and must not be modified.
+    """
+
+    def __init__(self, cache_dir=None, max_entries=MAX_CACHED_FORECASTS, table=None):
+        self.cache_dir = cache_dir
+        self.table = table
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def key(ean, df, models):
+        """Returns the cache key of an EAN, or None if its forecast cannot be cached."""
+        ean = ean_key(ean)
+        if ean is None or not isinstance(df, WeeklyConsumptionStore) or not hasattr(models, "version"):
+            return None
+        if ean not in models:
+            return None
+        dataset_version = df.version(ean)
+        if dataset_version is None:
+            return None
+        return ean, dataset_version, models.version(ean), forecast_horizon(models)
+
+    def predict(self, ean, df, models, scaler):
+        """Returns predict_consumption(ean, df, models, scaler), computing it only on a cache miss."""
+        key = self.key(ean, df, models)
+        if key is None:
+            return predict_consumption(ean, df, models, scaler)
+
+        result = self._get(key)
+        if result is not None:
+            self.hits += 1
+            return result
+
+        self.misses += 1
+        table = self.table
+        result = None if table is None else table.predict_consumption(ean, df, models, scaler)
+        if result is None:
+            result = predict_consumption(ean, df, models, scaler)
+        self._put(key, result)
+        return result
+
+    def invalidate(self):
+        """Forgets the forecasts held in memory and returns the EANs they were for."""
+        with self._lock:
+            eans = [key[0] for key in self._entries]
+            self._entries.clear()
+        return eans
+
+    def refresh(self, df, models, scaler, eans=None):
+        """Recomputes forecasts after a new dataset or retraining.
+
+        By default the EANs that were cached in memory are forecast again with
+        the new dataset and models, so the next lookups of recently viewed
+        EANs are hits. Disk entries of other EANs are dropped when stale.
+        """
+        recent = self.invalidate()
+        if eans is None:
+            eans = recent
+        for ean in eans:
+            self.predict(ean, df, models, scaler)
+        return len(eans)
+
+    def prune(self, df, models):
+        """Deletes the disk entries that no longer match the current dataset and models."""
+        if self.cache_dir is None:
+            return 0
+
+        removed = 0
+        for filename in os.listdir(self.cache_dir):
+            if not filename.endswith(".joblib"):
+                continue
+            path = os.path.join(self.cache_dir, filename)
+            key = self.key(filename[:-len(".joblib")], df, models)
+            try:
+                stored_key, _ = joblib.load(path)
+            except Exception:
+                stored_key = None
+            if key is None or stored_key != key:
+                os.remove(path)
+                removed += 1
+        return removed
+
+    def _path(self, ean):
+        return os.path.join(self.cache_dir, f"{ean}.joblib")
+
+    def _get(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+
+        if self.cache_dir is None or not os.path.exists(self._path(key[0])):
+            return None
+        try:
+            stored_key, result = joblib.load(self._path(key[0]))
+        except Exception:
+            return None  # Unreadable entry: recomputed and overwritten
+        if stored_key != key:
+            return None
+
+        self._remember(key, result)
+        return result
+
+    def _put(self, key, result):
+        self._remember(key, result)
+        if self.cache_dir is not None:
+            # Only the latest forecast of each EAN is kept on disk
+            path = self._path(key[0])
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            joblib.dump((key, result), tmp_path)
+            os.replace(tmp_path, path)
+
+    def _remember(self, key, result):
+        with self._lock:
+            self._entries[key] = result
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
@@ -0,0 +1,153 @@
+import os
+import numpy as np
+import pandas as pd
+from dataset_store import WeeklyConsumptionStore
+from ean_index import EanIndex, ean_key
+from features import LAG_COLUMNS, add_lag_features
+from model_store import MODELS_DIR
+from prediction import forecast_horizon, iter_batch_forecasts, unscale
+from snapshots import current_snapshot
+
+FORECAST_TABLE_FILE = "forecast_table.npz"
+
+# Arrays of the table, sorted by EAN:
+#   eans              EAN keys
+#   week_start        start of the first forecast week (datetime64)
+#   predictions       (n_eans, horizon) forecast consumption
+#   dataset_versions  WeeklyConsumptionStore.version of each EAN when forecast
+#   model_versions    ModelStore.version of each EAN when forecast
+
+
+def build_forecast_table(dataset, models, scaler, horizon=None, model_versions=None, compiled=None, eans=None):
+    """Forecasts the EANs (default: all of them) of a dataset store with a model and returns the table arrays.
+
+    model_versions(ean) gives the version of the saved model of an EAN
+    (ModelStore.version by default). compiled forests of the models, if
+    given, are used to evaluate them. horizon defaults to the one of the
+    models (see prediction.forecast_horizon).
+    """
+    if model_versions is None:
+        model_versions = models.version
+    if horizon is None:
+        horizon = forecast_horizon(models)
+
+    batches = iter_batch_forecasts(dataset, models, scaler, eans=eans, horizon=horizon, compiled=compiled) \
+        if eans is None or len(eans) else []
+    eans, week_start, predictions = [], [], []
+    for batch in batches:
+        eans.append(batch["EAN"].to_numpy()[::horizon])
+        week_start.append(batch["Week_Start"].to_numpy()[::horizon])
+        predictions.append(batch["Predicted_Consumption"].to_numpy().reshape(-1, horizon))
+
+    eans = np.concatenate(eans) if eans else np.empty(0, dtype="int64")
+    order = np.argsort(eans, kind="stable")
+    eans = eans[order].astype("int64")
+
+    return {
+        "eans": eans,
+        "week_start": (np.concatenate(week_start) if week_start else np.empty(0, "datetime64[ns]"))[order],
+        "predictions": (np.concatenate(predictions) if predictions else np.empty((0, horizon), "int64"))[order],
+        "dataset_versions": np.array([dataset.version(ean) for ean in eans], dtype="U16"),
+        "model_versions": np.array([model_versions(ean) for ean in eans], dtype="U32"),
+    }
+
+
+def stale_forecasts(table, dataset):
+    """Returns the EANs of a ForecastTable whose forecast doesn't start the week after their last week any more.
+
+    Their data changed without their model being retrained, e.g. when weeks
+    without sales were appended to the dataset.
+    """
+    expected = dataset.last_weeks(table.eans) + np.timedelta64(7, "D")
+    return table.eans[table.week_start != expected]
+
+
+def merge_forecast_tables(table, update, removed=()):
+    """Returns the arrays of a ForecastTable with the rows of update added or replacing its rows.
+
+    The rows of the removed EANs are dropped.
+    """
+    dropped = np.union1d(update["eans"], np.asarray(list(removed), dtype="int64"))
+    kept = ~np.isin(table.eans, dropped)
+    eans = np.concatenate((table.eans[kept], update["eans"])).astype("int64")
+    order = np.argsort(eans, kind="stable")
+
+    merged = {"eans": eans[order]}
+    for name in ("week_start", "predictions", "dataset_versions", "model_versions"):
+        merged[name] = np.concatenate((getattr(table, name)[kept], update[name]))[order]
+    return merged
+
+
+def save_forecast_table(table, models_dir=MODELS_DIR):
+    """Saves the forecast table next to the models."""
+    path = os.path.join(models_dir, FORECAST_TABLE_FILE)
+    with open(path + ".tmp", "wb") as f:
+        np.savez(f, **table)
+    os.replace(path + ".tmp", path)
+
+
+def load_forecast_table(models_dir=None):
+    """Loads the forecast table saved with the models (default: of the current snapshot), or returns None."""
+    if models_dir is None:
+        models_dir = current_snapshot().models_dir
+    path = os.path.join(models_dir, FORECAST_TABLE_FILE)
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as arrays:
+        return ForecastTable({name: arrays[name] for name in arrays.files})
+
+
+class ForecastTable:
+    """Forecasts precomputed at the end of training, looked up by EAN.
+
+    A forecast is only served while the dataset and the model of its EAN
+    are the ones it was computed with; otherwise lookups return None and the
+    caller falls back to running the model.
+    """
+
+    def __init__(self, table):
+        self.eans = table["eans"]
+        self.index = EanIndex(self.eans, is_sorted=True)
+        self.week_start = table["week_start"]
+        self.predictions = table["predictions"]
+        self.dataset_versions = table["dataset_versions"]
+        self.model_versions = table["model_versions"]
+        self.horizon = self.predictions.shape[1]
+
+    def __len__(self):
+        return len(self.eans)
+
+    def _locate(self, ean, dataset, models):
+        """Returns the row of an EAN if its forecast is still valid, else None."""
+        key = ean_key(ean)
+        if key is None or not isinstance(dataset, WeeklyConsumptionStore) or not hasattr(models, "version"):
+            return None
+        if key not in models or self.horizon != forecast_horizon(models):
+            return None
+
+        position = self.index.find(key)
+        if position is None:
+            return None
+        if (self.dataset_versions[position] != dataset.version(key)
+                or self.model_versions[position] != models.version(key)):
+            return None
+        return position
+
+    def lookup(self, ean, dataset, models):
+        """Returns the forecast week start dates and the predictions of an EAN, or (None, None)."""
+        position = self._locate(ean, dataset, models)
+        if position is None:
+            return None, None
+        return (list(pd.Timestamp(self.week_start[position]) + pd.to_timedelta(np.arange(self.horizon), unit="W")),
+                self.predictions[position])
+
+    def predict_consumption(self, ean, dataset, models, scaler):
+        """Same result as prediction.predict_consumption, served from the table, or None if not valid."""
+        future_dates, future_predictions = self.lookup(ean, dataset, models)
+        if future_dates is None:
+            return None
+
+        ean_data = add_lag_features(dataset.history(ean)).dropna(subset=LAG_COLUMNS)
+        consumption = ean_data["Total_Weekly_Consumption"].to_numpy(dtype=float, copy=True)
+        ean_data["Total_Weekly_Consumption"] = unscale(consumption, dataset, scaler, ean)
+        return future_dates, future_predictions, ean_data
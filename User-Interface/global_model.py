@@ -0,0 +1,119 @@
+import numpy as np
+from sklearn.ensemble import HistGradientBoostingRegressor, RandomForestRegressor
+from sklearn.metrics import mean_squared_error
+from sklearn.multioutput import MultiOutputRegressor
+
+# Estimators available for the model shared by many EANs
+GLOBAL_ESTIMATORS = ("gbm", "forest")
+DEFAULT_GLOBAL_ESTIMATOR = "gbm"
+
+# Hybrid strategy: EANs with fewer weeks with sales than this use the global model
+MIN_SALES_WEEKS = 26
+
+# Features describing an EAN, appended to its lags so that one model can serve many EANs
+EAN_FEATURE_NAMES = ("mean", "std", "sales_rate")
+
+
+def ean_features(y, scaling=None, zero=0.0):
+    """Summarizes the (scaled) training history of an EAN: level, volatility and share of weeks with sales.
+
+    zero is the value of the weeks without sales in y: the scaled zero,
+    (0 - mean) / scale, of the EAN's standardization (0 for an unscaled y).
+    With the EAN's own (mean, scale), for EANs standardized separately, the
+    level and volatility are those of its unscaled consumption, so that they
+    still tell EANs apart.
+    """
+    if len(y) == 0:
+        return np.zeros(len(EAN_FEATURE_NAMES), dtype=np.float32)
+    if np.ndim(y) == 2:
+        y = np.asarray(y)[:, 0]  # Targets of a multi-week model: the first week is the series itself
+    if scaling is not None:
+        y = np.asarray(y) * scaling[1] + scaling[0]
+        zero = zero * scaling[1] + scaling[0]
+    # Any other value, returns included, is a week with sales
+    sales_rate = np.mean(~np.isclose(y, zero))
+    return np.array([np.mean(y), np.std(y), sales_rate], dtype=np.float32)
+
+
+def _make_estimator(estimator, random_state, n_jobs, n_outputs=1):
+    if estimator == "gbm":
+        if n_outputs > 1:
+            # Gradient boosting fits a single target: one model per forecast week
+            return MultiOutputRegressor(HistGradientBoostingRegressor(random_state=random_state))
+        return HistGradientBoostingRegressor(random_state=random_state)
+    if estimator == "forest":
+        return RandomForestRegressor(n_estimators=100, min_samples_leaf=5, random_state=random_state, n_jobs=n_jobs)
+    raise ValueError(f"Unknown global estimator {estimator!r}, expected one of {GLOBAL_ESTIMATORS}")
+
+
+class GlobalEANModel:
+    """One EAN's view of a model shared by many EANs.
+
+    Behaves like a per-EAN model: predict(X) takes the lag vectors of the
+    EAN and appends its features before calling the shared model. Inputs
+    are converted to float32, so single and batched predictions match.
+    """
+
+    def __init__(self, model, features):
+        self.model = model
+        self.features = np.asarray(features, dtype=np.float32)
+
+    @property
+    def n_outputs_(self):
+        """Number of consecutive weeks predicted at once, like RandomForestRegressor.n_outputs_."""
+        if isinstance(self.model, MultiOutputRegressor):
+            return len(self.model.estimators_)
+        return getattr(self.model, "n_outputs_", 1)
+
+    def inputs(self, X):
+        """Returns the inputs of the shared model for lag vectors X of the EAN: the lags and the EAN's features."""
+        X = np.asarray(X, dtype=np.float32)
+        if X.ndim == 1:
+            X = X.reshape(1, -1)
+        return np.hstack([X, np.tile(self.features, (len(X), 1))])
+
+    def predict(self, X):
+        return self.model.predict(self.inputs(X))
+
+
+def train_global_model(tasks, estimator=DEFAULT_GLOBAL_ESTIMATOR, random_state=42, n_jobs=None, scaling_of=None,
+                       zero_of=None):
+    """Trains a single model on the lags and features of many EANs.
+
+    tasks yields (EAN, X, y, random_state, params) like the per-EAN training,
+    y holding one column per week for multi-week models. Each
+    EAN keeps its last 20% of weeks for testing, so the RMSE values are
+    comparable with the per-EAN models. scaling_of(ean) gives the scaling
+    of EANs standardized separately and zero_of(ean) the scaled value of the
+    weeks without sales of an EAN (see ean_features). Returns
+    {EAN: GlobalEANModel} and {EAN: RMSE}.
+    """
+    eans, features, train_parts, test_parts = [], [], [], []
+    for ean, X, y, *_ in tasks:
+        split_idx = int(len(X) * 0.8)
+        ean_feature = ean_features(y[:split_idx], None if scaling_of is None else scaling_of(ean),
+                                   0.0 if zero_of is None else zero_of(ean))
+        eans.append(ean)
+        features.append(ean_feature)
+        train_parts.append((X[:split_idx], y[:split_idx]))
+        test_parts.append((X[split_idx:], y[split_idx:]))
+
+    if not eans:
+        return {}, {}
+
+    def stack(parts):
+        X = np.vstack([np.hstack([X, np.tile(feature, (len(X), 1))]) for (X, _), feature in zip(parts, features)])
+        return X.astype(np.float32), np.concatenate([y for _, y in parts])
+
+    X_train, y_train = stack(train_parts)
+    model = _make_estimator(estimator, random_state, n_jobs, 1 if y_train.ndim == 1 else y_train.shape[1])
+    model.fit(X_train, y_train)
+
+    models, rmse_values = {}, {}
+    for ean, feature, (X_test, y_test) in zip(eans, features, test_parts):
+        models[ean] = GlobalEANModel(model, feature)
+        if len(y_test):
+            rmse_values[ean] = np.sqrt(mean_squared_error(y_test, models[ean].predict(X_test)))
+        else:
+            rmse_values[ean] = np.nan
+    return models, rmse_values
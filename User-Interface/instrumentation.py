@@ -0,0 +1,205 @@
+import cProfile
+import json
+import os
+import threading
+import time
+from contextlib import nullcontext
+
+METRICS_PATH = "../Models/metrics.jsonl"
+PROFILES_DIR = "../Models/profiles"
+
+# Interval between two resident memory samples while stages run (seconds)
+RSS_SAMPLE_INTERVAL = 0.05
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# Disabled by default: stage() then returns a shared no-op context and count() returns at once
+_enabled = False
+_metrics_path = None
+_profiles_dir = None
+_listeners = []
+_write_lock = threading.Lock()
+_local = threading.local()
+_sampler = None
+_NULL_STAGE = nullcontext()
+
+
+def _current_rss():
+    """Returns the resident memory of this process, or None if it can't be read."""
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+class _RSSSampler:
+    """Samples the resident memory in a background thread and tracks the peak of each running stage."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.records = set()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        thread = threading.Thread(target=self._run, daemon=True)
+        thread.start()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            with self.lock:
+                records = list(self.records)
+            if records:
+                rss = _current_rss()
+                for record in records:
+                    record.observe(rss)
+
+
+class _Stage:
+    """An instrumented stage: wall time, counters, peak RSS and an optional cProfile capture."""
+
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = fields
+        self.counters = {}
+        self.peak_rss = None
+        self.profiler = None
+
+    def observe(self, rss):
+        if rss is not None and (self.peak_rss is None or rss > self.peak_rss):
+            self.peak_rss = rss
+
+    def __enter__(self):
+        stack = getattr(_local, "stack", None)
+        if stack is None:
+            stack = _local.stack = []
+        # Only one profiler can run per thread: nested stages are part of the outer stage's profile
+        if _profiles_dir is not None and not any(stage.profiler for stage in stack):
+            self.profiler = cProfile.Profile()
+        stack.append(self)
+
+        self.observe(_current_rss())
+        self.sampler = _sampler
+        with self.sampler.lock:
+            self.sampler.records.add(self)
+        self.start = time.perf_counter()
+        if self.profiler is not None:
+            try:
+                self.profiler.enable()
+            except ValueError:
+                self.profiler = None  # Another thread is already being profiled (Python 3.12+)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        seconds = time.perf_counter() - self.start
+        if self.profiler is not None:
+            self.profiler.disable()
+        with self.sampler.lock:
+            self.sampler.records.discard(self)
+        self.observe(_current_rss())
+        _local.stack.pop()
+
+        record = {"stage": self.name, "time": time.time(), "seconds": seconds, "peak_rss_bytes": self.peak_rss,
+                  "status": "error" if exc_type is not None else "ok", **self.fields}
+        if self.counters:
+            record["counters"] = self.counters
+        if self.profiler is not None:
+            os.makedirs(_profiles_dir, exist_ok=True)
+            record["profile"] = os.path.join(_profiles_dir, f"{self.name}-{int(record['time'] * 1000)}.prof")
+            self.profiler.dump_stats(record["profile"])
+        _emit(record)
+        return False
+
+
+def _emit(record):
+    if _metrics_path is not None:
+        with _write_lock:
+            with open(_metrics_path, "a") as f:
+                f.write(json.dumps(record, default=str) + "\n")
+    for listener in list(_listeners):
+        listener(record)
+
+
+def configure(metrics_path=METRICS_PATH, profile=False, profiles_dir=PROFILES_DIR,
+              rss_interval=RSS_SAMPLE_INTERVAL):
+    """Enables the instrumentation.
+
+    Each finished stage is appended as a JSON line to metrics_path (None:
+    not written) and passed to the listeners. With profile=True the
+    outermost stage of each thread is captured with cProfile into
+    profiles_dir.
+    """
+    global _enabled, _metrics_path, _profiles_dir, _sampler
+    if metrics_path is not None:
+        os.makedirs(os.path.dirname(metrics_path) or ".", exist_ok=True)
+    _metrics_path = metrics_path
+    _profiles_dir = profiles_dir if profile else None
+    if _sampler is None:
+        _sampler = _RSSSampler(rss_interval)
+    _enabled = True
+
+
+def disable():
+    """Disables the instrumentation."""
+    global _enabled, _sampler
+    _enabled = False
+    if _sampler is not None:
+        _sampler.stopped.set()
+        _sampler = None
+
+
+def is_enabled():
+    return _enabled
+
+
+def add_listener(listener):
+    """Calls listener(record) for each finished stage, from the thread that ran it."""
+    _listeners.append(listener)
+
+
+def remove_listener(listener):
+    _listeners.remove(listener)
+
+
+def stage(name, **fields):
+    """Context manager timing a named stage; fields are added to its record.
+
+    Returns a shared no-op context while the instrumentation is disabled.
+    """
+    if not _enabled:
+        return _NULL_STAGE
+    return _Stage(name, fields)
+
+
+def record_timing(name, seconds, **fields):
+    """Records a measurement taken outside of a stage, e.g. a latency spanning several callbacks."""
+    if not _enabled:
+        return
+    _emit({"stage": name, "time": time.time(), "seconds": seconds, "peak_rss_bytes": _current_rss(), "status": "ok",
+           **fields})
+
+
+def count(name, n=1):
+    """Adds n to a counter of the stages running in this thread."""
+    if not _enabled:
+        return
+    for running_stage in getattr(_local, "stack", ()):
+        running_stage.counters[name] = running_stage.counters.get(name, 0) + n
+
+
+def add_instrumentation_arguments(parser):
+    """Adds the --metrics and --profile options to a command line parser."""
+    parser.add_argument("--metrics", nargs="?", const=METRICS_PATH, default=None,
+                        help=f"Append stage timings to a JSON lines file (default: {METRICS_PATH})")
+    parser.add_argument("--profile", action="store_true",
+                        help=f"Capture a cProfile of each top-level stage in {PROFILES_DIR} (implies --metrics)")
+
+
+def configure_from_args(args):
+    """Enables the instrumentation if --metrics or --profile was given."""
+    if args.metrics is not None or args.profile:
+        configure(args.metrics or METRICS_PATH, profile=args.profile)
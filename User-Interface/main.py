@@ -1,17 +1,63 @@
 import tkinter as tk
 from tkinter import messagebox, filedialog
 import threading
-import pandas as pd
 import os
 import shutil
-import subprocess
 import datetime
-from ui import setup_ui, show_processing_panel, hide_processing_panel, show_plot_window, show_help_window
-from prediction import predict_consumption
-from utils import load_models, load_dataset
-
-# Load models and scaler
-models, scaler = load_models()
+import argparse
+import time
+from ui import (setup_ui, show_processing_panel, hide_processing_panel, show_plot_window, show_help_window,
+                show_suggestions, hide_suggestions)
+from instrumentation import add_instrumentation_arguments, add_listener, configure_from_args, is_enabled, record_timing
+from tasks import TaskRunner
+
+# Only lightweight modules are imported above: pandas, sklearn (through the models) and matplotlib are
+# imported on first use or by the background warm-up, so that the window shows up at once.
+# Reference time of the startup measurements:
+STARTED = time.perf_counter()
+
+# Number of EANs suggested while an EAN is typed
+MAX_SUGGESTIONS = 10
+
+
+def ean_index_of(models):
+    """Returns the index of the EANs with a model, used by the EAN autocomplete."""
+    from ean_index import EanIndex
+
+    if hasattr(models, "index"):
+        return models.index
+    return EanIndex.from_eans(models)  # Models loaded as a dict (legacy pickle)
+
+
+def warm_up():
+    """Imports the prediction stack and opens the forecast cache, the models and the dataset.
+
+    Runs on a worker thread once the window is shown. Returns the forecast
+    cache, the (models, scaler, dataset, snapshot) artifacts, the lease
+    pinning their snapshot and the index of their EANs (all None if no
+    models were trained yet) and the error that prevented loading them.
+    """
+    from forecast_cache import FORECAST_CACHE_DIR, ForecastCache
+    from forecast_table import load_forecast_table
+    from snapshots import SnapshotLease, current_snapshot
+    from utils import load_models, load_dataset
+    import prediction  # noqa: F401 - pandas and sklearn, needed by the first prediction
+
+    # Everything from the same snapshot, even if a new one is published meanwhile
+    snapshot = current_snapshot()
+    forecast_cache = ForecastCache(FORECAST_CACHE_DIR, table=load_forecast_table(snapshot.models_dir))
+    lease = SnapshotLease(snapshot)
+    try:
+        models, scaler = load_models(snapshot=snapshot)
+    except FileNotFoundError as e:
+        lease.release()
+        return forecast_cache, None, None, None, e
+
+    try:
+        dataset = load_dataset(snapshot)
+    except FileNotFoundError:
+        dataset = None  # Reported by the first prediction
+    return forecast_cache, (models, scaler, dataset, snapshot), lease, ean_index_of(models), None
 
 
 class App:
@@ -22,10 +68,32 @@ class App:
         self.root.grid_rowconfigure(0, weight=1)
         self.root.grid_columnconfigure(0, weight=1)
 
+        # (models, scaler, dataset, snapshot) used by predictions, replaced as a whole after each retrain.
+        # None until the background warm-up has loaded them.
+        self.artifacts = None
+        self.artifacts_lock = threading.Lock()
+        # Pins the snapshot of the artifacts, whose models are loaded lazily, against the garbage collection
+        self.snapshot_lease = None
+        # Sorted EANs of the current models, searched by the EAN autocomplete
+        self.ean_index = None
+
+        # Forecasts only change with a new dataset or retrained models: repeated lookups are served from here
+        # and misses are looked up in the forecast table precomputed at the end of training (opened by the
+        # warm-up, or by the first retrain if the warm-up failed)
+        self.forecast_cache = None
+        self.first_prediction_shown = False
+        # Window showing the plot of the last prediction, reused by the next ones
+        self.plot_panel = None
+
+        # Background work: predictions and the preprocessing/training pipeline never run on the UI thread
+        self.runner = TaskRunner(root)
+        self.cancel_requested = threading.Event()
+
         # Setup UI components (panels, buttons, entry fields)
         (self.processing_label, self.upload_button, self.ean_entry,
          self.predict_button, self.result_frame, self.help_button,
-         self.last_update_label) = setup_ui(root, self)
+         self.last_update_label, self.cancel_button, self.status_label,
+         self.suggestion_list) = setup_ui(root, self)
 
         # Initialize last update display
         self.update_last_update_display()
@@ -33,6 +101,45 @@ class App:
         # Hide the processing panel at the beginning
         hide_processing_panel(self.processing_label)
 
+        # Started with --metrics or --profile: also show each finished stage in the processing panel
+        if is_enabled():
+            add_listener(lambda record: self.runner.call_soon(self.show_stage_metrics, record))
+
+        # Load everything else once the window is on screen
+        self.root.after_idle(self.on_window_shown)
+
+    def on_window_shown(self):
+        record_timing("startup.first_window", time.perf_counter() - STARTED)
+        self.runner.submit(warm_up, on_success=self.on_warm_up_done, on_error=self.on_warm_up_error)
+
+    def on_warm_up_done(self, result):
+        forecast_cache, artifacts, lease, ean_index, error = result
+        if self.forecast_cache is None:
+            self.forecast_cache = forecast_cache
+        record_timing("startup.models_ready", time.perf_counter() - STARTED, loaded=artifacts is not None)
+
+        if artifacts is None:
+            # Nothing trained yet: uploading a dataset trains the models and enables predictions
+            self.status_label.config(text="No trained models: upload a dataset")
+            return
+        with self.artifacts_lock:
+            # A retrain that finished during the warm-up already brought newer models
+            if self.artifacts is None:
+                self.artifacts = artifacts
+                self.ean_index = ean_index
+                self.snapshot_lease, lease = lease, None
+        if lease is not None:
+            lease.release()
+        self.set_ready()
+
+    def on_warm_up_error(self, error):
+        self.status_label.config(text="Models could not be loaded")
+        messagebox.showerror("Error", f"Loading the models failed: {str(error)}")
+
+    def set_ready(self):
+        self.status_label.config(text="Ready")
+        self.predict_button.config(state=tk.NORMAL)
+
     def update_last_update_display(self):
         """Update the last update label with current dataset info"""
         dataset_folder = "../Dataset"
@@ -67,9 +174,12 @@ class App:
         if not ready:
             return
 
+        # Only the previous raw files are removed: the preprocessed dataset and the models in use are in the
+        # current snapshot, which predictions keep reading until the new one is published
         dataset_folder = "../Dataset"
         for filename in os.listdir(dataset_folder):
-            os.remove(os.path.join(dataset_folder, filename))
+            if filename.endswith(".csv"):
+                os.remove(os.path.join(dataset_folder, filename))
 
         # Save with current date format
         today = datetime.datetime.now().strftime("%d_%m_%Y")
@@ -80,43 +190,166 @@ class App:
         shutil.copy(file_path, os.path.join(dataset_folder, new_dataset_name))
 
         show_processing_panel(self.processing_label, "Preprocessing dataset...")
+        self.cancel_requested.clear()
+        self.cancel_button.grid()
+        self.upload_button.config(state=tk.DISABLED)
 
         def run_preprocessing_and_training():
+            from forecast_cache import FORECAST_CACHE_DIR, ForecastCache
+            from pipeline import run_pipeline
+            from snapshots import SnapshotLease
+
             try:
-                # Run preprocessing
-                subprocess.run(["python", "preprocessing.py", new_dataset_name], check=True)
+                # Preprocess (keeping the current scale, so unchanged models stay valid), then retrain the
+                # models of the EANs whose series changed, all in this process
+                artifacts = run_pipeline(new_dataset_name, keep_scaler=True, incremental=True,
+                                         status=lambda message: self.runner.call_soon(
+                                             show_processing_panel, self.processing_label, message),
+                                         progress=lambda *args: self.runner.call_soon(
+                                             self.show_training_progress, *args),
+                                         cancel_event=self.cancel_requested)
+                # The forecast cache is opened here too, in case the warm-up failed before opening it
+                return (artifacts, SnapshotLease(artifacts[3]), ean_index_of(artifacts[0]),
+                        ForecastCache(FORECAST_CACHE_DIR))
+            finally:
+                # Clean up - remove the temporary original file
+                original_path = os.path.join(dataset_folder, new_dataset_name)
+                if os.path.exists(original_path):
+                    os.remove(original_path)
+
+        self.runner.submit(run_preprocessing_and_training,
+                           on_success=self.on_pipeline_done, on_error=self.on_pipeline_error)
+
+    def show_training_progress(self, done, total, elapsed):
+        remaining = elapsed / done * (total - done) if done else 0
+        minutes, seconds = divmod(int(remaining), 60)
+        show_processing_panel(self.processing_label,
+                              f"Training models... {done}/{total} EANs (ETA {minutes} min {seconds:02d} s)")
+
+    def show_stage_metrics(self, record):
+        # Only while the panel shows a running operation
+        if not self.processing_label.winfo_ismapped():
+            return
+        message = f"{record['stage']}: {record['seconds']:.2f} s"
+        if record["peak_rss_bytes"] is not None:
+            message += f", peak {record['peak_rss_bytes'] / 1e6:.0f} MB"
+        show_processing_panel(self.processing_label, message)
+
+    def cancel_processing(self):
+        if not messagebox.askyesno("Cancel", "Stop the preprocessing and training?"):
+            return
+
+        self.cancel_requested.set()
+        show_processing_panel(self.processing_label, "Cancelling...")
 
-                # After preprocessing, train models
-                show_processing_panel(self.processing_label, "Training models...")
-                subprocess.run(["python", "model_training.py"], check=True)
+    def end_pipeline(self):
+        self.cancel_button.grid_remove()
+        self.upload_button.config(state=tk.NORMAL)
+        hide_processing_panel(self.processing_label)
 
-                # Reload the new models
-                global models, scaler
-                models, scaler = load_models()
+    def on_pipeline_done(self, result):
+        artifacts, lease, ean_index, forecast_cache = result
+        if self.forecast_cache is None:
+            # The warm-up failed before opening the forecast cache
+            self.forecast_cache = forecast_cache
+        forecast_cache = self.forecast_cache
 
-                # Update last update display
-                self.update_last_update_display()
+        # Swap in the new models, scaler and dataset at once: running predictions keep the previous ones
+        with self.artifacts_lock:
+            self.artifacts = artifacts
+            self.ean_index = ean_index
+            previous_lease, self.snapshot_lease = self.snapshot_lease, lease
+        # The previous snapshot stays among the kept ones for the predictions still running on it
+        if previous_lease is not None:
+            previous_lease.release()
 
-                hide_processing_panel(self.processing_label)
-                messagebox.showinfo("Success", "Dataset processed and models retrained successfully!")
+        self.set_ready()
 
-                # Clean up - remove the temporary original file
-                os.remove(os.path.join(dataset_folder, new_dataset_name))
-            except subprocess.CalledProcessError as e:
-                hide_processing_panel(self.processing_label)
-                messagebox.showerror("Error", f"Processing failed: {str(e)}")
+        # Forecast the recently viewed EANs again with the new dataset and models, and drop stale disk entries
+        models, scaler, dataset, snapshot = artifacts
 
-        threading.Thread(target=run_preprocessing_and_training, daemon=True).start()
+        def refresh_forecasts():
+            from forecast_table import load_forecast_table
+
+            forecast_cache.table = load_forecast_table(snapshot.models_dir)
+            forecast_cache.refresh(dataset, models, scaler)
+            forecast_cache.prune(dataset, models)
+
+        self.runner.submit(refresh_forecasts)
+
+        # Update last update display
+        self.update_last_update_display()
+
+        self.end_pipeline()
+        messagebox.showinfo("Success", "Dataset processed and models retrained successfully!")
+
+    def on_pipeline_error(self, error):
+        from pipeline import PipelineCancelled
+
+        self.end_pipeline()
+        if isinstance(error, PipelineCancelled):
+            messagebox.showinfo("Cancelled", "Processing cancelled.")
+        else:
+            messagebox.showerror("Error", f"Processing failed: {str(error)}")
+
+    def update_suggestions(self, event=None):
+        # EANs with a model starting with the digits typed so far
+        text = self.ean_entry.get().strip()
+        suggestions = []
+        if self.ean_index is not None and text:
+            from ean_index import format_ean
+            suggestions = [format_ean(key) for key in self.ean_index.search_prefix(text, MAX_SUGGESTIONS)]
+        if not suggestions or suggestions == [text]:
+            hide_suggestions(self.suggestion_list)
+        else:
+            show_suggestions(self.suggestion_list, self.ean_entry, suggestions)
+
+    def select_suggestion(self, event=None):
+        selection = self.suggestion_list.curselection()
+        if not selection:
+            return
+        self.ean_entry.delete(0, tk.END)
+        self.ean_entry.insert(0, self.suggestion_list.get(selection[0]))
+        hide_suggestions(self.suggestion_list)
+        self.ean_entry.focus_set()
 
     def predict(self):
-        try:
-            ean = float(self.ean_entry.get())
-        except ValueError:
+        from ean_index import ean_key
+
+        hide_suggestions(self.suggestion_list)
+        ean = ean_key(self.ean_entry.get().strip())
+        if ean is None:
             messagebox.showerror("Error", "Please enter a valid EAN!")
             return
 
-        df = load_dataset()
-        future_dates, future_predictions, ean_data = predict_consumption(ean, df, models, scaler)
+        self.predict_button.config(state=tk.DISABLED)
+        show_processing_panel(self.processing_label, "Predicting...")
+
+        def run_prediction():
+            from utils import load_dataset
+
+            artifacts = self.artifacts
+            models, scaler, dataset, snapshot = artifacts
+            if dataset is None:
+                dataset = load_dataset(snapshot)
+                with self.artifacts_lock:
+                    if self.artifacts is artifacts:
+                        self.artifacts = (models, scaler, dataset, snapshot)
+            # The plot of the same forecast is cached under the same key
+            return (self.forecast_cache.predict(ean, dataset, models, scaler),
+                    self.forecast_cache.key(ean, dataset, models))
+
+        self.runner.submit(run_prediction, on_success=self.show_prediction, on_error=self.on_prediction_error)
+
+    def on_prediction_error(self, error):
+        self.predict_button.config(state=tk.NORMAL)
+        hide_processing_panel(self.processing_label)
+        messagebox.showerror("Error", f"Prediction failed: {str(error)}")
+
+    def show_prediction(self, result):
+        self.predict_button.config(state=tk.NORMAL)
+        hide_processing_panel(self.processing_label)
+        (future_dates, future_predictions, ean_data), plot_key = result
 
         if future_dates is None:
             messagebox.showerror("Error", "EAN not found!")
@@ -137,11 +370,21 @@ class App:
                                   font=("Arial", 12))
             week_label.pack(pady=2)
 
-        # Show plot in a new window
-        show_plot_window(ean_data, future_dates, future_predictions)
+        # Show plot in the plot window
+        show_plot_window(self, ean_data, future_dates, future_predictions, plot_key)
+
+        if not self.first_prediction_shown:
+            self.first_prediction_shown = True
+            record_timing("startup.first_prediction", time.perf_counter() - STARTED)
+
 
+# Guarded: the training process pool re-imports this module in its workers on Windows
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stock Consumption Predictor")
+    add_instrumentation_arguments(parser)
+    configure_from_args(parser.parse_args())
 
-# Run the application
-root = tk.Tk()
-app = App(root)
-root.mainloop()
\ No newline at end of file
+    # Run the application: the models are loaded in the background once the window is shown
+    root = tk.Tk()
+    app = App(root)
+    root.mainloop()
\ No newline at end of file
@@ -0,0 +1,219 @@
+import json
+import os
+import threading
+from collections import OrderedDict
+import joblib
+import numpy as np
+from ean_index import EanIndex, ean_key
+from global_model import GlobalEANModel
+from instrumentation import count
+
+MODELS_DIR = "../Models/randomforest_models"
+MANIFEST_FILE = "manifest.json"
+RMSE_FILE = "random_forest_rmse_values_improved.pkl"
+
+# Default bounds of the in-memory model cache
+MAX_CACHED_MODELS = 256
+MAX_CACHED_BYTES = None
+
+
+def read_manifest(models_dir=MODELS_DIR):
+    """Returns the manifest of a model store, or None if the folder holds no model store."""
+    manifest_path = os.path.join(models_dir, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def _dump(model, file_path):
+    # Uncompressed, so that loading skips decompression, and swapped in so readers never see a partial file
+    joblib.dump(model, file_path + ".tmp")
+    os.replace(file_path + ".tmp", file_path)
+
+
+def save_models(models, rmse_values, models_dir=MODELS_DIR, fingerprints=None, scaler_params=None,
+                merge=False, removed=(), strategy=None, training_config=None, horizon=None, forecast_horizon=None):
+    """Saves one joblib artifact per EAN, the RMSE values and a manifest listing the artifacts.
+
+    A model shared by many EANs (GlobalEANModel) is saved once, the entry of
+    each of its EANs recording the EAN features instead of a copy of it.
+    fingerprints maps EANs to the dataset fingerprint their model was trained
+    on, scaler_params records the scaler of that dataset, strategy the
+    training strategy, training_config the forest parameters, horizon
+    the number of weeks each model predicts at once and forecast_horizon
+    the number of weeks forecast with the models. With merge=True
+    the models are added to (or replace) the ones already saved, the other
+    models and their RMSE values are kept, and the `removed` EANs are deleted.
+    """
+    os.makedirs(models_dir, exist_ok=True)
+    if not merge:
+        # Remove the models of the previous training
+        for filename in os.listdir(models_dir):
+            file_path = os.path.join(models_dir, filename)
+            try:
+                if os.path.isfile(file_path):
+                    os.unlink(file_path)
+            except Exception as e:
+                print(f"Error deleting {file_path}: {e}")
+
+    manifest = read_manifest(models_dir) if merge else None
+    if manifest is None:
+        manifest = {"models": {}}
+        all_rmse_values = {}
+    else:
+        all_rmse_values = {ean_key(ean): rmse for ean, rmse in
+                           joblib.load(os.path.join(models_dir, RMSE_FILE)).items()}
+    entries = manifest["models"]
+
+    for ean in removed:
+        entry = entries.pop(str(ean_key(ean)), None)
+        all_rmse_values.pop(ean_key(ean), None)
+        if entry is None or any(other["file"] == entry["file"] for other in entries.values()):
+            continue  # The artifact of a shared model is still used by other EANs
+        if os.path.exists(os.path.join(models_dir, entry["file"])):
+            os.remove(os.path.join(models_dir, entry["file"]))
+
+    shared_files = {}
+    for ean, model in models.items():
+        if isinstance(model, GlobalEANModel):
+            filename = shared_files.get(id(model.model))
+            if filename is None:
+                filename = f"global_{len(shared_files)}.joblib"
+                _dump(model.model, os.path.join(models_dir, filename))
+                shared_files[id(model.model)] = filename
+        else:
+            filename = f"{ean_key(ean)}.joblib"
+            _dump(model, os.path.join(models_dir, filename))
+        stat = os.stat(os.path.join(models_dir, filename))
+        entry = {"file": filename, "size": stat.st_size, "version": format(stat.st_mtime_ns, "x")}
+        if isinstance(model, GlobalEANModel):
+            entry["features"] = model.features.tolist()
+        if fingerprints is not None:
+            entry["fingerprint"] = format(int(fingerprints[ean]), "016x")
+        entries[str(ean_key(ean))] = entry
+
+    all_rmse_values.update({ean_key(ean): rmse for ean, rmse in rmse_values.items()})
+    _dump(all_rmse_values, os.path.join(models_dir, RMSE_FILE))
+
+    if scaler_params is not None:
+        manifest["scaler"] = scaler_params
+    if strategy is not None:
+        manifest["strategy"] = strategy
+    if training_config is not None:
+        manifest["training_config"] = training_config
+    else:
+        manifest.pop("training_config", None)
+    if horizon is not None:
+        manifest["horizon"] = horizon
+    if forecast_horizon is not None:
+        manifest["forecast_horizon"] = forecast_horizon
+
+    # The manifest is written last: a store is only complete once it exists
+    manifest_path = os.path.join(models_dir, MANIFEST_FILE)
+    with open(manifest_path + ".tmp", "w") as f:
+        json.dump(manifest, f)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+
+class ModelStore:
+    """Per-EAN models loaded on first access and kept in a bounded LRU cache.
+
+    Behaves like the read-only {EAN: model} dict returned by the previous
+    single-pickle format (`ean in store`, `store[ean]`, iteration over EANs).
+    Models shared by many EANs are loaded once and kept loaded. Models are
+    read fully into memory: sklearn trees copy their node arrays when
+    unpickled, so memory-mapping the artifacts would save nothing (the
+    compiled forests of compiled_forest.py are the memory-mapped layout).
+    """
+
+    def __init__(self, models_dir=MODELS_DIR, max_models=MAX_CACHED_MODELS, max_bytes=MAX_CACHED_BYTES):
+        self.models_dir = models_dir
+        self.max_models = max_models
+        self.max_bytes = max_bytes
+
+        with open(os.path.join(models_dir, MANIFEST_FILE)) as f:
+            manifest = json.load(f)
+        self._entries = {int(ean): entry for ean, entry in manifest["models"].items()}
+        # Number of weeks forecast with these models, None if the training didn't set it
+        self.forecast_horizon = manifest.get("forecast_horizon")
+
+        self._index = None
+        self._cache = OrderedDict()
+        self._cache_bytes = 0
+        self._shared = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def __contains__(self, ean):
+        return ean_key(ean) in self._entries
+
+    def __getitem__(self, ean):
+        key = ean_key(ean)
+        if key not in self._entries:
+            raise KeyError(ean)
+
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+
+        entry = self._entries[key]
+        if "features" in entry:
+            return GlobalEANModel(self._load_shared(entry["file"]), entry["features"])
+
+        # Load outside the lock so that slow reads don't block lookups of cached models
+        model = joblib.load(os.path.join(self.models_dir, entry["file"]))
+        count("models_loaded")
+
+        with self._lock:
+            if key not in self._cache:
+                self._cache[key] = model
+                self._cache_bytes += entry["size"]
+                self._evict()
+        return model
+
+    def _load_shared(self, filename):
+        """Returns a model shared by many EANs, loading it on first use."""
+        with self._lock:
+            if filename not in self._shared:
+                self._shared[filename] = joblib.load(os.path.join(self.models_dir, filename))
+            return self._shared[filename]
+
+    def get(self, ean, default=None):
+        return self[ean] if ean in self else default
+
+    def version(self, ean):
+        """Returns an identifier that changes whenever the saved model of an EAN is replaced."""
+        entry = self._entries[ean_key(ean)]
+        if "version" in entry:
+            return entry["version"]
+        # Stores saved before versions were recorded
+        return format(os.stat(os.path.join(self.models_dir, entry["file"])).st_mtime_ns, "x")
+
+    def keys(self):
+        return self._entries.keys()
+
+    @property
+    def index(self):
+        """Sorted index of the EANs with a saved model, built on first use."""
+        if self._index is None:
+            self._index = EanIndex(np.fromiter(self._entries, dtype="int64", count=len(self._entries)))
+        return self._index
+
+    def _evict(self):
+        """Drops the least recently used models until the cache fits its limits."""
+        while len(self._cache) > 1 and (
+                (self.max_models is not None and len(self._cache) > self.max_models)
+                or (self.max_bytes is not None and self._cache_bytes > self.max_bytes)):
+            key, _ = self._cache.popitem(last=False)
+            self._cache_bytes -= self._entries[key]["size"]
+
+    def load_rmse_values(self):
+        """Loads the RMSE of every model."""
+        return joblib.load(os.path.join(self.models_dir, RMSE_FILE))
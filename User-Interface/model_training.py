@@ -1,73 +1,628 @@
+from collections import ChainMap, deque
+from concurrent.futures import ProcessPoolExecutor
 from sklearn.ensemble import RandomForestRegressor
 from sklearn.metrics import mean_squared_error
+import argparse
+import hashlib
+import json
 import numpy as np
-import pandas as pd
-import joblib
 import os
+import time
+from dataset_store import WeeklyConsumptionStore
+from features import LAG_COLUMNS, add_lag_features, lag_windows
+from compiled_forest import CompiledForests, compile_models, load_compiled_forests, merge_compiled_forests, \
+    save_compiled_forests
+from instrumentation import add_instrumentation_arguments, configure_from_args, count, stage
+from global_model import DEFAULT_GLOBAL_ESTIMATOR, GLOBAL_ESTIMATORS, MIN_SALES_WEEKS, train_global_model
+from forecast_table import build_forecast_table, load_forecast_table, merge_forecast_tables, save_forecast_table, \
+    stale_forecasts
+from model_store import MODELS_DIR, ModelStore, read_manifest, save_models
+from prediction import FORECAST_HORIZON
+from snapshots import new_snapshot
+from training_config import DEFAULT_MODEL_PARAMS, TRAINING_CONFIG_PATH, load_training_config, model_params
+from training_job import PARTITION_SIZE, POLL_INTERVAL, TRAINING_JOBS_DIR, TrainingJob, list_jobs
+from utils import load_dataset, load_scaler
 
 
-def train_models(df):
+# Ways of assigning a model to every EAN:
+#   per_ean  one Random Forest per EAN
+#   global   a single model shared by every EAN, with EAN-level features (see global_model.py)
+#   hybrid   a forest per EAN with enough history, the global model for the sparse ones
+STRATEGIES = ("per_ean", "global", "hybrid")
+DEFAULT_STRATEGY = "per_ean"
+
+
+class TrainingCancelled(Exception):
+    """Raised when a training run is cancelled before every EAN is trained."""
+
+
+def _train_ean_model(ean, X, y, random_state, params=None):
+    """Trains and evaluates the Random Forest model of a single EAN."""
+    # Train-test split (keep last 20% for testing)
+    split_idx = int(len(X) * 0.8)
+    X_train, X_test = X[:split_idx], X[split_idx:]
+    y_train, y_test = y[:split_idx], y[split_idx:]
+
+    # Train Random Forest model
+    model = RandomForestRegressor(**(params or DEFAULT_MODEL_PARAMS), random_state=random_state)
+    model.fit(X_train, y_train)
+
+    # Predict and evaluate
+    y_pred = model.predict(X_test)
+    rmse = np.sqrt(mean_squared_error(y_test, y_pred))
+
+    return ean, model, rmse
+
+
+def _train_ean_chunk(tasks):
+    """Trains a chunk of EANs inside a worker process."""
+    return [_train_ean_model(*task) for task in tasks]
+
+
+def _chunks(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def iter_training_tasks(data, eans, random_state, config=None, horizon=1):
+    """Yields the (EAN, X, y, random_state, params) training task of each EAN (all of them for eans=None).
+
+    X holds the lag windows of the EAN and y their targets, as the models
+    are trained on them; params are the forest parameters of the EAN from
+    the training config. With horizon > 1, y holds the next `horizon` weeks of each lag vector.
+    """
+    if isinstance(data, WeeklyConsumptionStore):
+        # Zero-fill and build the lags of one EAN at a time, straight from the sparse store
+        for ean in (data.eans if eans is None else eans):
+            series = data.series(ean)
+            if series is not None:
+                X, y = lag_windows(series[1], horizon)
+                yield ean, X, y, random_state, model_params(y, config, data.scaling_of(ean), data.scaled_zero(ean))
+        return
+
+    if eans is not None:
+        data = data[data["EAN"].isin(eans)]
+
+    if horizon > 1:
+        # Windows of several target weeks, one EAN at a time
+        data = data.sort_values(["EAN", "Week_Start"], kind="stable")
+        for ean, ean_data in data.groupby("EAN", sort=False):
+            X, y = lag_windows(ean_data["Total_Weekly_Consumption"].to_numpy(), horizon)
+            yield ean, X, y, random_state, model_params(y, config)
+        return
+
+    # Build the lagged features of every EAN at once and drop the first weeks without full history
+    features = add_lag_features(data).dropna(subset=LAG_COLUMNS)
+
+    # Slice the features once per EAN: lagged values as X, current consumption as y
+    for ean, ean_data in features.groupby("EAN", sort=False):
+        y = ean_data["Total_Weekly_Consumption"].to_numpy()
+        yield ean, ean_data[LAG_COLUMNS].to_numpy(), y, random_state, model_params(y, config)
+
+
+def _train_tagged_chunks(tagged_chunks, executor, n_jobs):
+    """Trains the chunks of (tag, chunk) items in a process pool (None: in this process).
+
+    Yields the (tag, results) of each item in order. Items with a None chunk
+    are markers, yielded as (tag, None) once the chunks before them are
+    trained. At most two chunks per worker are in flight, so the features of
+    the whole catalogue are never held in memory at once.
+    """
+    if executor is None:
+        for tag, chunk in tagged_chunks:
+            yield tag, None if chunk is None else _train_ean_chunk(chunk)
+        return
+
+    pending = deque()
+    try:
+        for tag, chunk in tagged_chunks:
+            pending.append((tag, None if chunk is None else executor.submit(_train_ean_chunk, chunk)))
+            if len(pending) >= 2 * n_jobs:
+                tag, future = pending.popleft()
+                yield tag, None if future is None else future.result()
+        while pending:
+            tag, future = pending.popleft()
+            yield tag, None if future is None else future.result()
+    finally:
+        # Don't start the queued chunks when the caller stops early (e.g. cancellation)
+        for _, future in pending:
+            if future is not None:
+                future.cancel()
+
+
+def _train_in_pool(chunks, n_jobs):
+    """Trains the chunks in a process pool, yielding the results in order."""
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        results = _train_tagged_chunks(((None, chunk) for chunk in chunks), executor, n_jobs)
+        try:
+            for _, chunk_results in results:
+                yield from chunk_results
+        finally:
+            results.close()
+
+
+def _train_results(df, eans, random_state, config, horizon, n_jobs, chunksize, n_eans):
+    """Trains the forests of the EANs (default: all of them) in this process or a process pool.
+
+    Returns an iterator of the (EAN, model, RMSE) results, in order.
+    """
+    tasks = iter_training_tasks(df, eans, random_state, config, horizon)
+    if n_jobs == 1 or n_eans <= chunksize:
+        return (_train_ean_model(*task) for task in tasks)
+    # Ship each EAN slice once, grouped in chunks to limit inter-process overhead
+    return _train_in_pool(_chunks(tasks, chunksize), n_jobs)
+
+
+def _training_job_key(dataset, eans, random_state, config, horizon):
+    """Identifies the training of these EANs on their current data, so that a rerun resumes the same job."""
+    fingerprints = model_fingerprints(dataset)
+    digest = hashlib.blake2b(digest_size=8)
+    digest.update(json.dumps([random_state, config, horizon]).encode())
+    digest.update(np.asarray(dataset.scaling).tobytes())
+    for ean in eans:
+        content = dataset.version(ean) if fingerprints is None else fingerprints.get(ean)
+        digest.update(f"{ean}:{content};".encode())
+    return digest.hexdigest()
+
+
+def _iter_job_results(dataset, job, n_jobs, chunksize, collect=True, cancel_event=None):
+    """Trains the partitions of a training job that no other worker is training, checkpointing each one.
+
+    The partitions are claimed one after the other as the workers of a
+    single process pool need more EANs, and each one is checkpointed as soon
+    as its last results come back. With collect=True yields the (EAN, model,
+    RMSE) results of every partition, including the ones checkpointed by
+    earlier runs or other workers, and waits for the partitions other
+    workers are training (taking over the ones of dead workers); setting
+    cancel_event stops the wait with TrainingCancelled. With collect=False
+    yields only the results trained here and returns once no partition is
+    left to claim. Stopping the iteration early loses the partitions being
+    trained only.
+    """
+    random_state, config, horizon = job.spec["random_state"], job.spec["config"], job.spec["horizon"]
+    n_eans = sum(len(eans) for eans in job.partitions)
+    use_pool = n_jobs > 1 and n_eans > chunksize
+    claimed = []  # Partitions being trained here, until checkpointed
+
+    def claimed_chunks():
+        while True:
+            partition = job.claim_next()
+            if partition is None:
+                return
+            claimed.append(partition)
+            tasks = iter_training_tasks(dataset, job.partitions[partition], random_state, config, horizon)
+            # Serial training yields every EAN as it is trained
+            for chunk in _chunks(tasks, chunksize if use_pool else 1):
+                yield partition, chunk
+            yield partition, None  # Every result of the partition is in
+
+    collected = set()
+    executor = ProcessPoolExecutor(max_workers=n_jobs) if use_pool else None
+    try:
+        while True:
+            if collect:
+                for partition in job.completed():
+                    if partition not in collected:
+                        collected.add(partition)
+                        yield from job.load_checkpoint(partition)
+                if len(collected) == len(job.partitions):
+                    return
+
+            n_collected = len(collected)
+            trained = {}
+            results = _train_tagged_chunks(claimed_chunks(), executor, n_jobs)
+            try:
+                for partition, chunk_results in results:
+                    if chunk_results is None:
+                        job.save_checkpoint(partition, trained.pop(partition, []))
+                        job.release(partition)
+                        claimed.remove(partition)
+                        collected.add(partition)
+                        continue
+                    trained.setdefault(partition, []).extend(chunk_results)
+                    for claimed_partition in claimed:
+                        job.heartbeat(claimed_partition)
+                    yield from chunk_results
+            finally:
+                results.close()
+                for partition in claimed:
+                    job.release(partition)
+                claimed.clear()
+
+            if not collect:
+                return
+            if len(collected) == n_collected and set(job.completed()) <= collected:
+                # Nothing left to claim: the remaining partitions are being trained by other workers
+                if cancel_event is None:
+                    time.sleep(POLL_INTERVAL)
+                elif cancel_event.wait(POLL_INTERVAL):
+                    raise TrainingCancelled("Training cancelled while waiting for the partitions of other workers")
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+
+def join_training_jobs(jobs_dir=TRAINING_JOBS_DIR, n_jobs=None, chunksize=16):
+    """Helps the running training jobs of jobs_dir: trains their unclaimed partitions until none is left.
+
+    The results are left in the job checkpoints, collected by the run that
+    started the job. Jobs trained from a dataset held in memory (e.g. by the
+    GUI pipeline) can't be joined. Returns the number of EANs trained.
+    """
+    if n_jobs is None:
+        n_jobs = os.cpu_count() or 1
+
+    trained = 0
+    for job_dir in list_jobs(jobs_dir):
+        try:
+            job = TrainingJob(job_dir)
+        except FileNotFoundError:
+            continue  # Finished and removed meanwhile
+        store_dir = job.spec.get("store_dir")
+        if store_dir is None or not os.path.isdir(store_dir) or job.is_complete():
+            continue
+
+        with stage("train.join", job=os.path.basename(job_dir)):
+            for ean, _, rmse in _iter_job_results(WeeklyConsumptionStore(store_dir), job, n_jobs, chunksize,
+                                                  collect=False):
+                trained += 1
+                count("eans")
+                print(f"EAN {ean} - RMSE: {rmse:.4f}")
+    return trained
+
+
+def _sales_weeks(data, eans):
+    """Returns the number of weeks with sales of each EAN (weeks of history for a DataFrame)."""
+    if isinstance(data, WeeklyConsumptionStore):
+        counts = dict(zip(np.asarray(data.eans).tolist(), np.asarray(data.lengths).tolist()))
+    else:
+        counts = data.groupby("EAN").size().to_dict()
+    return {ean: counts.get(ean, 0) for ean in eans}
+
+
+def _split_strategy(data, eans, strategy, min_sales_weeks):
+    """Returns the EANs getting their own forest and the EANs served by the global model."""
+    if strategy == "per_ean":
+        return eans, []
+    if strategy == "global":
+        return [], eans
+
+    # Hybrid: the EANs with too little history to fit a forest of their own share the global model
+    sales_weeks = _sales_weeks(data, eans)
+    forest_eans = [ean for ean in eans if sales_weeks[ean] >= min_sales_weeks]
+    global_eans = [ean for ean in eans if sales_weeks[ean] < min_sales_weeks]
+    return forest_eans, global_eans
+
+
+def train_models(df, n_jobs=None, chunksize=16, random_state=42, eans=None, progress=None, cancel_event=None,
+                 strategy=DEFAULT_STRATEGY, global_estimator=DEFAULT_GLOBAL_ESTIMATOR, min_sales_weeks=MIN_SALES_WEEKS,
+                 config=None, horizon=1, checkpoint_dir=None, partition_size=PARTITION_SIZE):
+    """Trains the model of every EAN with the given strategy (see STRATEGIES).
+
+    df is the weekly consumption, as a DataFrame or a WeeklyConsumptionStore.
+    eans restricts the training to some EANs (default: all of them).
+    Per-EAN forests are spread across a process pool: n_jobs=None uses every
+    CPU, n_jobs=1 trains serially in this process. Results do not depend on
+    n_jobs or chunksize for a given random_state. config is the training
+    config giving the forest parameters (see training_config.py).
+
+    horizon is the number of weeks each model predicts at once: 1 trains
+    one-week models, forecast recursively; with horizon > 1 each model
+    learns the weeks t+1..t+horizon together (multi-output), so a single
+    evaluation forecasts the whole horizon and errors don't compound.
+
+    With a checkpoint_dir (df must then be a WeeklyConsumptionStore) the
+    per-EAN forests are trained as a training job of partitions of
+    partition_size EANs (see training_job.py): each completed partition is
+    checkpointed there, a rerun of the same training resumes from the
+    checkpoints, and other processes can help with join_training_jobs.
+
+    progress(done, total) is called after each trained EAN. Setting
+    cancel_event (a threading.Event) stops the run with TrainingCancelled.
+    """
+    if strategy not in STRATEGIES:
+        raise ValueError(f"Unknown training strategy {strategy!r}, expected one of {STRATEGIES}")
+
     # Dictionary to store models for each EAN
     models = {}
     rmse_values = {}  # Dictionary to store RMSE per EAN
 
-    # Train a model for each EAN
-    for ean in df["EAN"].unique():
-        ean_data = df[df["EAN"] == ean]  # Filter data for specific EAN
+    if n_jobs is None:
+        n_jobs = os.cpu_count() or 1
 
-        # Create lagged features
-        ean_data["Lag_1"] = ean_data["Total_Weekly_Consumption"].shift(1)
-        ean_data["Lag_2"] = ean_data["Total_Weekly_Consumption"].shift(2)
-        ean_data["Lag_3"] = ean_data["Total_Weekly_Consumption"].shift(3)
-        ean_data["Lag_4"] = ean_data["Total_Weekly_Consumption"].shift(4)
+    forest_eans, global_eans = eans, []
+    if strategy != "per_ean":
+        if eans is None:
+            eans = df.eans.tolist() if isinstance(df, WeeklyConsumptionStore) else df["EAN"].unique().tolist()
+        forest_eans, global_eans = _split_strategy(df, eans, strategy, min_sales_weeks)
 
-        ean_data = ean_data.dropna()  # Drop rows with NaN values
+    if forest_eans is not None:
+        n_eans = len(forest_eans) + len(global_eans)
+    elif isinstance(df, WeeklyConsumptionStore):
+        n_eans = len(df)
+    else:
+        n_eans = df["EAN"].nunique()
 
-        # Split into features (X) and target (y)
-        X = ean_data[["Lag_1", "Lag_2", "Lag_3", "Lag_4"]]  # Use lagged values as features
-        y = ean_data["Total_Weekly_Consumption"]
+    done = 0
+    if forest_eans is None or len(forest_eans):
+        with stage("train.forests", strategy=strategy, jobs=n_jobs):
+            job = None
+            if checkpoint_dir is None:
+                results = _train_results(df, forest_eans, random_state, config, horizon, n_jobs, chunksize, n_eans)
+            elif not isinstance(df, WeeklyConsumptionStore):
+                raise ValueError("Checkpointed training needs a WeeklyConsumptionStore")
+            else:
+                job_eans = df.eans.tolist() if forest_eans is None else forest_eans
+                spec = {"store_dir": df.store_dir and os.path.abspath(df.store_dir), "random_state": random_state,
+                        "config": config, "horizon": horizon}
+                job = TrainingJob.open(_training_job_key(df, job_eans, random_state, config, horizon), job_eans, spec,
+                                       checkpoint_dir, partition_size)
+                print(f"Training job {job.job_dir}: {len(job.completed())} of {len(job.partitions)} partitions "
+                      f"already trained")
+                results = _iter_job_results(df, job, n_jobs, chunksize, cancel_event=cancel_event)
 
-        # Train-test split (keep last 20% for testing)
-        split_idx = int(len(X) * 0.8)
-        X_train, X_test = X.iloc[:split_idx], X.iloc[split_idx:]
-        y_train, y_test = y.iloc[:split_idx], y.iloc[split_idx:]
+            for done, (ean, model, rmse) in enumerate(results, start=1):
+                # Store model and RMSE for this EAN
+                count("eans")
+                models[ean] = model
+                rmse_values[ean] = rmse
 
-        # Train Random Forest model
-        model = RandomForestRegressor(n_estimators=100, random_state=42)
-        model.fit(X_train, y_train)
+                print(f"EAN {ean} - RMSE: {rmse:.4f}")
 
-        # Store model
-        models[ean] = model
+                if progress is not None:
+                    progress(done, n_eans)
+                if cancel_event is not None and cancel_event.is_set():
+                    results.close()
+                    raise TrainingCancelled(f"Training cancelled after {done} of {n_eans} EANs")
 
-        # Predict and evaluate
-        y_pred = model.predict(X_test)
-        rmse = np.sqrt(mean_squared_error(y_test, y_pred))
+            if job is not None:
+                # Every result is in memory now
+                job.remove()
 
-        # Store RMSE for this EAN
-        rmse_values[ean] = rmse
-
-        print(f"EAN {ean} - RMSE: {rmse:.4f}")
+    if global_eans:
+        with stage("train.global", estimator=global_estimator, eans=len(global_eans)):
+            print(f"Training the global {global_estimator} model of {len(global_eans)} EANs")
+            scaling_of, zero_of = (df.scaling_of, df.scaled_zero) if isinstance(df, WeeklyConsumptionStore) \
+                else (None, None)
+            tasks = iter_training_tasks(df, global_eans, random_state, horizon=horizon)
+            global_models, global_rmse_values = train_global_model(tasks, global_estimator, random_state, n_jobs,
+                                                                   scaling_of, zero_of)
+            for ean in global_models:
+                models[ean] = global_models[ean]
+                rmse_values[ean] = global_rmse_values[ean]
+                print(f"EAN {ean} - RMSE: {rmse_values[ean]:.4f} (global model)")
 
+    if progress is not None:
+        # EANs left without a model (e.g. unknown to the store) count as done too
+        progress(n_eans, n_eans)
     return models, rmse_values
 
 
+def scaler_params(scaler, dataset=None):
+    """Returns the parameters of the scale the models are trained on."""
+    if dataset is not None and dataset.ean_scaling is not None:
+        # Each EAN has its own scaling, which is part of its fingerprint (see model_fingerprints)
+        return {"per_ean": True}
+    return {"mean": float(scaler.mean_[0]), "scale": float(scaler.scale_[0])}
+
+
+def model_fingerprints(dataset):
+    """Returns {EAN: fingerprint} of what each model is trained on, or None if the store has no fingerprints.
+
+    The fingerprint of the EAN's sales, combined with the first and last
+    week of its series, so that zero-filled weeks added to the calendar
+    change it too, and with its own scaling when the store scales each EAN
+    separately.
+    """
+    if dataset.fingerprints is None:
+        return None
+    weeks = np.asarray(dataset.weeks)
+    week_range = np.asarray(dataset.week_range)
+    ean_scaling = None if dataset.ean_scaling is None else np.asarray(dataset.ean_scaling)
+
+    fingerprints = {}
+    for position, (ean, fingerprint) in enumerate(zip(np.asarray(dataset.eans).tolist(),
+                                                      np.asarray(dataset.fingerprints).tolist())):
+        digest = hashlib.blake2b(fingerprint.to_bytes(8, "little"), digest_size=8)
+        digest.update(weeks[[week_range[position, 0], week_range[position, 1] - 1]].tobytes())
+        if ean_scaling is not None:
+            digest.update(ean_scaling[position].tobytes())
+        fingerprints[ean] = int.from_bytes(digest.digest(), "little")
+    return fingerprints
+
+
+def find_changed_eans(dataset, manifest, scaler):
+    """Compares the dataset fingerprints with the ones the saved models were trained on.
+
+    Returns the EANs to (re)train and the EANs whose models must be removed,
+    or None when every model has to be retrained (no saved models, no
+    fingerprints or a different scaler).
+    """
+    fingerprints = model_fingerprints(dataset)
+    if manifest is None or fingerprints is None or manifest.get("scaler") != scaler_params(scaler, dataset):
+        return None
+
+    trained = {int(ean): entry.get("fingerprint") for ean, entry in manifest["models"].items()}
+    current = {ean: format(fingerprint, "016x") for ean, fingerprint in fingerprints.items()}
+
+    changed = [ean for ean, fingerprint in current.items() if trained.get(ean) != fingerprint]
+    removed = [ean for ean in trained if ean not in current]
+    return changed, removed
+
+
+def retrain_models(dataset, scaler, models_dir=MODELS_DIR, incremental=False, n_jobs=None, chunksize=16,
+                   progress=None, cancel_event=None, compile_forests=False, forecast_table=False,
+                   strategy=DEFAULT_STRATEGY, global_estimator=DEFAULT_GLOBAL_ESTIMATOR, min_sales_weeks=MIN_SALES_WEEKS,
+                   config_path=TRAINING_CONFIG_PATH, horizon=None, forecast_horizon=None,
+                   checkpoint_dir=TRAINING_JOBS_DIR, partition_size=PARTITION_SIZE):
+    """Trains the models of a dataset store and publishes them to the model store.
+
+    strategy picks how models are assigned to EANs (see STRATEGIES) and the
+    forests use the parameters of the training config at config_path, if
+    any (see tuning.py), predicting `horizon` weeks at once (see
+    train_models). With incremental=True and per-EAN models only the
+    EANs whose series changed are retrained (see find_changed_eans), the
+    other saved models are kept; the global model of the other strategies,
+    and every model after a change of training config or horizon, are always
+    retrained. The forests are trained in checkpointed partitions under
+    checkpoint_dir (None: not checkpointed), so that a crashed or cancelled
+    run resumes where it stopped (see train_models).
+    horizon defaults to the one of the saved models (1 without any), and
+    forecast_horizon, the number of weeks forecast with the models, to the
+    one of the saved models, else horizon if above 1, else FORECAST_HORIZON;
+    both are recorded in the manifest, which the forecasts read them from.
+    With compile_forests=True every model is then flattened into the arrays
+    of the vectorized evaluator (see compiled_forest.py), and with
+    forecast_table=True every EAN is forecast and the forecasts are saved
+    next to the models (see forecast_table.py). Incremental runs only compile
+    and forecast the retrained EANs (and the EANs whose forecast is stale)
+    and merge them into the compiled forests and forecast table already saved.
+    """
+    fingerprints = model_fingerprints(dataset)
+
+    config = load_training_config(config_path)
+    manifest = read_manifest(models_dir)
+    if horizon is None:
+        horizon = manifest.get("horizon", 1) if manifest is not None else 1
+    if forecast_horizon is None:
+        forecast_horizon = (manifest or {}).get("forecast_horizon") or (horizon if horizon > 1 else FORECAST_HORIZON)
+    changes = None
+    if incremental and strategy == "per_ean" and manifest is not None \
+            and manifest.get("strategy", "per_ean") == "per_ean" and manifest.get("training_config") == config \
+            and manifest.get("horizon", 1) == horizon:
+        changes = find_changed_eans(dataset, manifest, scaler)
+
+    if changes is None:
+        # Train models
+        models, rmse_values = train_models(dataset, n_jobs=n_jobs, chunksize=chunksize, progress=progress,
+                                           cancel_event=cancel_event, strategy=strategy,
+                                           global_estimator=global_estimator, min_sales_weeks=min_sales_weeks,
+                                           config=config, horizon=horizon, checkpoint_dir=checkpoint_dir,
+                                           partition_size=partition_size)
+
+        # Replace the saved models with one artifact per EAN, the metrics and the manifest
+        with stage("train.save_models", models=len(models)):
+            save_models(models, rmse_values, models_dir, fingerprints, scaler_params(scaler, dataset),
+                        strategy=strategy, training_config=config, horizon=horizon,
+                        forecast_horizon=forecast_horizon)
+    else:
+        changed, removed = changes
+        print(f"Incremental training: {len(changed)} EANs to retrain, {len(removed)} to remove")
+
+        # Train the changed EANs only and merge them with the untouched models
+        models, rmse_values = {}, {}
+        if changed:
+            models, rmse_values = train_models(dataset, n_jobs=n_jobs, chunksize=chunksize, eans=changed,
+                                               progress=progress, cancel_event=cancel_event, config=config,
+                                               horizon=horizon, checkpoint_dir=checkpoint_dir,
+                                               partition_size=partition_size)
+        with stage("train.save_models", models=len(models), removed=len(removed)):
+            save_models(models, rmse_values, models_dir, fingerprints, scaler_params(scaler, dataset), merge=True,
+                        removed=removed, strategy=strategy, training_config=config, horizon=horizon,
+                        forecast_horizon=forecast_horizon)
+
+    if not compile_forests and not forecast_table:
+        return
+
+    # The freshly trained models are still in memory, the untouched ones are read from the store
+    store = ModelStore(models_dir)
+    all_models = ChainMap(models, store)
+
+    compiled = None
+    if compile_forests:
+        with stage("train.compile"):
+            # Incremental runs keep the compiled forests of the untouched models
+            base = load_compiled_forests(models_dir) if changes is not None else None
+            if base is None:
+                arrays = compile_models(all_models, store.keys(), store.version)
+                n_compiled = len(arrays["eans"])
+            else:
+                update = CompiledForests(compile_models(models, models, store.version))
+                arrays = merge_compiled_forests(base, update, removed)
+                n_compiled = len(update)
+            save_compiled_forests(arrays, models_dir)
+            compiled = CompiledForests(arrays)
+        print(f"Compiled forests saved: {len(compiled)} EANs ({n_compiled} compiled), {compiled.nbytes / 1e6:.1f} MB")
+
+    if forecast_table:
+        with stage("train.forecast_table"):
+            # Incremental runs keep the forecasts of the untouched models that are still valid
+            base = load_forecast_table(models_dir) if changes is not None else None
+            if base is None or base.horizon != forecast_horizon:
+                table = build_forecast_table(dataset, all_models, scaler, forecast_horizon,
+                                             model_versions=store.version, compiled=compiled)
+                n_forecast = len(table["eans"])
+            else:
+                eans = np.union1d(np.asarray(list(models), dtype="int64"), stale_forecasts(base, dataset))
+                update = build_forecast_table(dataset, all_models, scaler, forecast_horizon,
+                                              model_versions=store.version, compiled=compiled, eans=eans)
+                table = merge_forecast_tables(base, update, removed)
+                n_forecast = len(update["eans"])
+            save_forecast_table(table, models_dir)
+        print(f"Forecast table saved: {len(table['eans'])} EANs ({n_forecast} forecast)")
+
+
 if __name__ == "__main__":
-    # Load the preprocessed data
-    df = pd.read_csv("../Dataset/weekly_consumption.csv")
+    parser = argparse.ArgumentParser(description="Train the consumption models of every EAN.")
+    parser.add_argument("--jobs", type=int, default=None,
+                        help="Number of worker processes (default: all CPUs, 1 = serial)")
+    parser.add_argument("--chunksize", type=int, default=16,
+                        help="Number of EANs sent to a worker at once")
+    parser.add_argument("--strategy", choices=STRATEGIES, default=DEFAULT_STRATEGY,
+                        help="per_ean: a forest per EAN, global: one model for every EAN, "
+                             "hybrid: the global model for the EANs with little history")
+    parser.add_argument("--global-estimator", choices=GLOBAL_ESTIMATORS, default=DEFAULT_GLOBAL_ESTIMATOR,
+                        help="Model shared by the EANs of the global and hybrid strategies")
+    parser.add_argument("--min-sales-weeks", type=int, default=MIN_SALES_WEEKS,
+                        help="Hybrid strategy: EANs with fewer weeks with sales use the global model")
+    parser.add_argument("--horizon", type=int, default=None,
+                        help="Weeks predicted at once by each model: 1 = recursive forecasts, "
+                             "more = direct multi-week models (default: the one of the current models, else 1)")
+    parser.add_argument("--forecast-weeks", type=int, default=None,
+                        help=f"Weeks forecast with the models (default: the current setting, else the horizon "
+                             f"if above 1, else {FORECAST_HORIZON})")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Only retrain the EANs whose series (sales or weeks of the calendar) changed since the "
+                             "last training")
+    parser.add_argument("--compile", action="store_true",
+                        help="Flatten the models into compact arrays for the vectorized evaluator")
+    parser.add_argument("--forecast-table", action="store_true",
+                        help="Forecast every EAN after training and save the forecasts next to the models")
+    parser.add_argument("--progress", action="store_true",
+                        help="Print 'PROGRESS <done> <total>' lines for the GUI")
+    parser.add_argument("--partition-size", type=int, default=PARTITION_SIZE,
+                        help="Number of EANs trained and checkpointed together")
+    parser.add_argument("--no-checkpoint", action="store_true",
+                        help="Don't checkpoint the training (a crashed run then starts over)")
+    parser.add_argument("--join", action="store_true",
+                        help=f"Only help the running training jobs of {TRAINING_JOBS_DIR} (e.g. from another "
+                             f"machine sharing the folder), then exit")
+    add_instrumentation_arguments(parser)
+    args = parser.parse_args()
+    configure_from_args(args)
 
-    # Train models
-    models, rmse_values = train_models(df)
+    def report_progress(done, total):
+        print(f"PROGRESS {done} {total}", flush=True)
 
-    # Clean the models directory
-    models_dir = "../Models/randomforest_models"
-    for filename in os.listdir(models_dir):
-        file_path = os.path.join(models_dir, filename)
-        try:
-            if os.path.isfile(file_path):
-                os.unlink(file_path)
-        except Exception as e:
-            print(f"Error deleting {file_path}: {e}")
-
-    # Save the models and metrics
-    joblib.dump(models, os.path.join(models_dir, "random_forest_models_improved.pkl"))
-    joblib.dump(rmse_values, os.path.join(models_dir, "random_forest_rmse_values_improved.pkl"))
+    progress = report_progress if args.progress else None
+
+    if args.join:
+        print(f"{join_training_jobs(n_jobs=args.jobs, chunksize=args.chunksize)} EANs trained")
+    else:
+        # Train on the preprocessed data of the current snapshot and publish the models as a new snapshot
+        with new_snapshot() as snapshot:
+            retrain_models(load_dataset(snapshot), load_scaler(snapshot), snapshot.models_dir,
+                           incremental=args.incremental, n_jobs=args.jobs, chunksize=args.chunksize,
+                           progress=progress, compile_forests=args.compile, forecast_table=args.forecast_table,
+                           strategy=args.strategy, global_estimator=args.global_estimator,
+                           min_sales_weeks=args.min_sales_weeks, horizon=args.horizon,
+                           forecast_horizon=args.forecast_weeks,
+                           checkpoint_dir=None if args.no_checkpoint else TRAINING_JOBS_DIR,
+                           partition_size=args.partition_size)
+        print(f"Models published as snapshot {snapshot.version}")
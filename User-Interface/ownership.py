@@ -0,0 +1,37 @@
+import os
+import socket
+import time
+
+
+def process_owner():
+    """Returns the "host:pid" tag of this process, written in the claim and lease files it owns."""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def pid_alive(pid):
+    """Returns whether a process of this machine is running."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass  # Running under another user
+    return True
+
+
+def is_stale(owner_path, timeout):
+    """Returns whether a file holding a process_owner tag belongs to a process that stopped without removing it.
+
+    Files not refreshed (touched) for timeout seconds are stale; the ones of
+    stopped processes of this machine are known stale at once.
+    """
+    try:
+        with open(owner_path) as f:
+            host, pid = f.read().rsplit(":", 1)
+        age = time.time() - os.path.getmtime(owner_path)
+    except (OSError, ValueError):
+        return False  # Being written, or just removed
+    if age > timeout:
+        return True
+    # os.kill(pid, 0) would kill the process on Windows
+    return os.name == "posix" and host == socket.gethostname() and not pid_alive(int(pid))
@@ -0,0 +1,83 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from dataset_store import WeeklyConsumptionStore
+from instrumentation import stage
+from model_training import DEFAULT_STRATEGY, TrainingCancelled, retrain_models
+from preprocessing import CHUNK_SIZE, prepare_dataset, save_dataset
+from snapshots import new_snapshot
+from utils import load_models, load_dataset
+
+
+class PipelineCancelled(Exception):
+    """Raised when a pipeline run is cancelled through its cancel_event."""
+
+
+def run_pipeline(filename, keep_scaler=True, incremental=True, append=False, n_jobs=None, chunksize=CHUNK_SIZE,
+                 strategy=DEFAULT_STRATEGY, compile_forests=True, forecast_table=True, status=None, progress=None,
+                 cancel_event=None, horizon=None):
+    """Runs preprocessing -> training -> snapshot publish in this process.
+
+    Everything is written to a new snapshot of the artifacts (see
+    snapshots.py), published at the end: until then, and if the run fails
+    or is cancelled, readers keep using the current snapshot. The
+    preprocessed dataset is handed to the training in memory while its files
+    are written by a background thread. Returns the (models, scaler,
+    dataset, snapshot) of the published snapshot, ready to be swapped in by
+    the caller.
+
+    strategy picks how models are assigned to EANs (see model_training.STRATEGIES)
+    and horizon the number of weeks each model predicts at once (see
+    model_training.train_models; default: the one of the current models).
+    With compile_forests=True the models are then compiled for the vectorized
+    evaluator (see compiled_forest.py) and with forecast_table=True every EAN
+    is forecast (see forecast_table.py), so predictions can be served by lookup.
+
+    status(message) reports the current stage, progress(done, total, elapsed)
+    the trained EANs. Setting cancel_event stops the run with PipelineCancelled.
+    """
+    def report(message):
+        if status is not None:
+            status(message)
+
+    def check_cancelled(*args):
+        if cancel_event is not None and cancel_event.is_set():
+            raise PipelineCancelled()
+
+    # Starts with the artifacts of the current snapshot, so that incremental runs keep the unchanged models
+    with new_snapshot() as snapshot:
+        report("Preprocessing dataset...")
+        with stage("pipeline.prepare", append=append):
+            sales, arrays, scaler = prepare_dataset(filename, keep_scaler, append, chunksize, on_chunk=check_cancelled,
+                                                    snapshot=snapshot)
+        check_cancelled()
+
+        with ThreadPoolExecutor(max_workers=1) as writer:
+            # Write the dataset files while the models train on the in-memory copy
+            written = writer.submit(save_dataset, sales, arrays, scaler, snapshot)
+
+            report("Training models...")
+            start = time.monotonic()
+
+            def report_progress(done, total):
+                if progress is not None:
+                    progress(done, total, time.monotonic() - start)
+
+            try:
+                with stage("pipeline.train", strategy=strategy, incremental=incremental):
+                    retrain_models(WeeklyConsumptionStore(arrays=arrays), scaler, snapshot.models_dir,
+                                   incremental=incremental, n_jobs=n_jobs, progress=report_progress,
+                                   cancel_event=cancel_event, compile_forests=compile_forests,
+                                   forecast_table=forecast_table, strategy=strategy, horizon=horizon)
+            except TrainingCancelled:
+                raise PipelineCancelled()
+            finally:
+                # Never discard the snapshot while the dataset is being written to it
+                wait([written])
+            # Only raised once training succeeded: a training error is the cause to report
+            written.result()
+        report("Publishing...")
+
+    # Reopen everything from the published snapshot (memory-mapped) for the caller to swap in
+    with stage("pipeline.reload"):
+        models, scaler = load_models(snapshot=snapshot)
+        return models, scaler, load_dataset(snapshot), snapshot
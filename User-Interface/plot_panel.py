@@ -0,0 +1,133 @@
+import time
+import tkinter as tk
+from collections import OrderedDict
+import numpy as np
+from matplotlib.artist import setp
+from matplotlib.dates import date2num
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+from instrumentation import stage
+
+# Rendered plots kept for instant redisplay (about 2 MB each at the default window size)
+MAX_CACHED_IMAGES = 16
+
+# Histories up to this many weeks are drawn with a marker on each week
+MAX_MARKED_POINTS = 104
+
+
+def minmax_indices(values, n_buckets):
+    """Returns the sorted indices of the points kept to draw values over n_buckets pixel columns.
+
+    The series is cut into n_buckets contiguous buckets and the minimum and
+    maximum of each are kept, with the first and last points, so the drawn
+    line shows the same peaks as the full series. Short series are kept whole.
+    """
+    n = len(values)
+    if n <= 2 * n_buckets or n_buckets < 1:
+        return np.arange(n)
+
+    buckets = np.arange(n) * n_buckets // n
+    # Sorted by bucket then value: the first and last point of each bucket are its minimum and maximum
+    order = np.lexsort((values, buckets))
+    ends = np.flatnonzero(np.diff(buckets[order])) + 1
+    firsts = order[np.concatenate(([0], ends))]
+    lasts = order[np.concatenate((ends - 1, [n - 1]))]
+    return np.unique(np.concatenate((firsts, lasts, [0, n - 1])))
+
+
+class PlotPanel:
+    """Window plotting the consumption history and forecast of an EAN, reused by every prediction.
+
+    The figure, canvas and lines are created once; each prediction only
+    replaces the line data. Long histories are downsampled to the width of
+    the axes in pixels, and the rendered image of the last plots is cached
+    by key (EAN, dataset version, model version) so showing one of them
+    again skips the drawing.
+    """
+
+    def __init__(self, max_cached_images=MAX_CACHED_IMAGES):
+        self.max_cached_images = max_cached_images
+        self._images = OrderedDict()
+        self.window = None
+
+    def _create_window(self):
+        self.window = tk.Toplevel()
+        self.window.title("Consumption Prediction Plot")
+        self.window.geometry("800x600")
+        # Closing only hides the window, which the next prediction shows again
+        self.window.protocol("WM_DELETE_WINDOW", self.window.withdraw)
+
+        self.figure = Figure(figsize=(8, 6), dpi=100)
+        self.figure.subplots_adjust(bottom=0.18)
+        self.ax = self.figure.add_subplot(111)
+        self.ax.xaxis_date()
+
+        self.history_line, = self.ax.plot([], [], marker='o', label="Past Consumption", color="blue")
+        self.forecast_line, = self.ax.plot([], [], marker='x', linestyle='dashed',
+                                           label="Predicted Consumption", color="red")
+
+        self.ax.set_title("Stock Consumption Prediction", fontsize=14)
+        self.ax.set_xlabel("Week Start", fontsize=12)
+        self.ax.set_ylabel("Consumption (units)", fontsize=12)
+        self.ax.legend(fontsize=12)
+        self.ax.grid(True)
+
+        # Rotate x-axis labels for better readability (the ticks created later copy these properties)
+        setp(self.ax.get_xticklabels(), rotation=45, ha="right")
+
+        self.canvas = FigureCanvasTkAgg(self.figure, master=self.window)
+        self.canvas.get_tk_widget().pack(fill=tk.BOTH, expand=True)
+
+    def show(self, ean_data, future_dates, future_predictions, key=None):
+        """Plots the history and forecast of an EAN and brings the window to the front.
+
+        key identifies the plotted data (None: not cached). Returns the
+        redraw time in seconds.
+        """
+        if self.window is None or not self.window.winfo_exists():
+            self._create_window()
+            self._images.clear()
+        self.window.deiconify()
+        self.window.lift()
+
+        size = tuple(self.figure.bbox.size)
+        cached = self._images.get(key) if key is not None else None
+        if cached is not None and cached[0] != size:
+            cached = None  # Rendered at another window size
+
+        start = time.perf_counter()
+        with stage("plot.redraw", points=len(ean_data), cached=cached is not None):
+            self._set_data(ean_data, future_dates, future_predictions)
+            if cached is None:
+                self.canvas.draw()
+                if key is not None:
+                    self._cache_image(key, size)
+            else:
+                # The lines hold the same data, so later redraws (e.g. on resize) show the same plot
+                self._images.move_to_end(key)
+                self.canvas.restore_region(cached[1])
+                self.canvas.blit(self.figure.bbox)
+        return time.perf_counter() - start
+
+    def _set_data(self, ean_data, future_dates, future_predictions):
+        weeks = date2num(ean_data["Week_Start"].to_numpy())
+        consumption = ean_data["Total_Weekly_Consumption"].to_numpy()
+
+        # At most a minimum and a maximum per pixel column of the axes
+        kept = minmax_indices(consumption, int(self.ax.bbox.width))
+        self.history_line.set_data(weeks[kept], consumption[kept])
+        marker = 'o' if len(kept) <= MAX_MARKED_POINTS else ''
+        if marker != self.history_line.get_marker():
+            self.history_line.set_marker(marker)
+            self.ax.legend(fontsize=12)  # The legend keeps a copy of the line style
+        self.forecast_line.set_data(date2num(np.asarray(future_dates, dtype="datetime64[ns]")),
+                                    np.asarray(future_predictions))
+
+        self.ax.relim()
+        self.ax.autoscale_view()
+
+    def _cache_image(self, key, size):
+        self._images[key] = (size, self.canvas.copy_from_bbox(self.figure.bbox))
+        self._images.move_to_end(key)
+        while len(self._images) > self.max_cached_images:
+            self._images.popitem(last=False)
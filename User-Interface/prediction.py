@@ -1,57 +1,98 @@
 import numpy as np
 import pandas as pd
+from sklearn.ensemble import RandomForestRegressor
+from dataset_store import WeeklyConsumptionStore
+from global_model import GlobalEANModel
+from instrumentation import count, stage
+from features import N_LAGS, LAG_COLUMNS, add_lag_features, model_outputs, next_lag_features, roll_lag_features
 
+# Number of future weeks forecast for each EAN, unless the training of the models set another one
+FORECAST_HORIZON = 4
 
-def predict_consumption(ean, df, models, scaler):
+
+def forecast_horizon(models):
+    """Returns the number of weeks forecast with models: the one set by their training, else FORECAST_HORIZON."""
+    return getattr(models, "forecast_horizon", None) or FORECAST_HORIZON
+
+
+def _ean_history(ean, df):
+    """Returns the weekly history of an EAN from the indexed store or from a DataFrame."""
+    if isinstance(df, WeeklyConsumptionStore):
+        # Only this EAN's rows are read, with dates already parsed
+        return df.history(ean)
+
+    # Filter data for the specific EAN
+    ean_data = df[df["EAN"] == ean].copy()
+    if ean_data.empty:
+        return None
+
+    # Ensure 'Week_Start' is in datetime format
+    ean_data["Week_Start"] = pd.to_datetime(ean_data["Week_Start"])
+    return ean_data
+
+
+def unscale(values, df, scaler, eans):
+    """Inverse-transforms scaled consumption in place and returns it.
+
+    values holds one row per EAN of eans, or the 1-D series of a single EAN.
+    A store applies the scaling of each EAN if it has one; a DataFrame is
+    unscaled with the global scaler.
+    """
+    if isinstance(df, WeeklyConsumptionStore):
+        return df.unscale(values, eans)
+
+    # Same operations as StandardScaler.inverse_transform, without the reshaped copies
+    values *= scaler.scale_[0]
+    values += scaler.mean_[0]
+    return values
+
+
+def predict_consumption(ean, df, models, scaler, horizon=None):
+    """Forecasts the next `horizon` weeks of an EAN (default: see forecast_horizon).
+
+    Returns the forecast week start dates, the predicted consumption and the
+    EAN's history (unscaled), or (None, None, None) if the EAN is unknown.
+    """
+    if horizon is None:
+        horizon = forecast_horizon(models)
+    with stage("predict.ean", horizon=horizon):
+        return _predict_consumption(ean, df, models, scaler, horizon)
+
+
+def _predict_consumption(ean, df, models, scaler, horizon):
     if ean in models:
-        # Filter data for the specific EAN
-        ean_data = df[df["EAN"] == ean].copy()
-
-        # Ensure 'Week_Start' is in datetime format
-        ean_data["Week_Start"] = pd.to_datetime(ean_data["Week_Start"])
-
-        # Inverse transform past consumption values (if they are scaled)
-        past_consumption_scaled = ean_data["Total_Weekly_Consumption"].values.reshape(-1, 1)
-        ean_data["Total_Weekly_Consumption"] = scaler.inverse_transform(past_consumption_scaled).flatten()
-
-        # Create lagged features
-        ean_data["Lag_1"] = ean_data["Total_Weekly_Consumption"].shift(1)
-        ean_data["Lag_2"] = ean_data["Total_Weekly_Consumption"].shift(2)
-        ean_data["Lag_3"] = ean_data["Total_Weekly_Consumption"].shift(1)
-        ean_data["Lag_4"] = ean_data["Total_Weekly_Consumption"].shift(2)
-        ean_data = ean_data.dropna()  # Drop rows with NaN values
-
-        # Get the last known values for Lag_1 and Lag_2
-        last_lag_1 = ean_data["Lag_1"].iloc[-1]
-        last_lag_2 = ean_data["Lag_2"].iloc[-1]
-        last_lag_3 = ean_data["Lag_3"].iloc[-1]
-        last_lag_4 = ean_data["Lag_4"].iloc[-1]
+        ean_data = _ean_history(ean, df)
+        if ean_data is None:
+            return None, None, None
+
+        # Create lagged features on the scaled values, exactly as during training
+        ean_data = add_lag_features(ean_data)
+        past_consumption_scaled = ean_data["Total_Weekly_Consumption"].to_numpy()
+
+        # The last known weeks become the lags of the first future week
+        lags = next_lag_features(past_consumption_scaled)
         last_week_start = ean_data["Week_Start"].iloc[-1]  # Get last recorded date
 
-        # Create future features for the next 4 weeks
+        # Forecast the next weeks: one model evaluation gives as many weeks as the model has outputs
+        # (one for recursive models, the whole horizon for direct multi-week models)
+        model = models[ean]
         future_predictions_scaled = []
-        future_dates = []  # To store the corresponding future weeks
-
-        for i in range(1, 5):
-            # Predict the next week's consumption (scaled)
-            future_features = np.array([[last_lag_1, last_lag_2, last_lag_3, last_lag_4]])
-            future_prediction_scaled = models[ean].predict(future_features)[0]
-            future_predictions_scaled.append(future_prediction_scaled)
+        while len(future_predictions_scaled) < horizon:
+            predicted_weeks = np.atleast_1d(model.predict(lags.reshape(1, -1))[0])
+            for future_prediction_scaled in predicted_weeks[:horizon - len(future_predictions_scaled)]:
+                future_predictions_scaled.append(future_prediction_scaled)
 
-            # Compute next week's start date
-            next_week_start = last_week_start + pd.Timedelta(weeks=i)
-            future_dates.append(next_week_start)
+                # Update lagged values for the next prediction
+                lags = roll_lag_features(lags, future_prediction_scaled)
 
-            # Update lagged values for the next prediction
-            last_lag_4 = last_lag_3
-            last_lag_3 = last_lag_3
-            last_lag_2 = last_lag_1
-            last_lag_1 = future_prediction_scaled
+        # Start dates of the forecast weeks
+        future_dates = [last_week_start + pd.Timedelta(weeks=i) for i in range(1, horizon + 1)]
 
-        # Inverse transform the predictions to get actual values
-        future_predictions = scaler.inverse_transform(
-            np.array(future_predictions_scaled).reshape(-1, 1)
-        ).flatten()
+        # Inverse transform past consumption and predictions at once, in place, to get actual values
+        actual_values = unscale(np.concatenate((past_consumption_scaled, future_predictions_scaled)), df, scaler, ean)
+        ean_data["Total_Weekly_Consumption"] = actual_values[:len(past_consumption_scaled)]
+        future_predictions = actual_values[len(past_consumption_scaled):]
+        ean_data = ean_data.dropna(subset=LAG_COLUMNS)  # Keep the weeks with a full lag history
 
         # Convert to integer values
         future_predictions = np.round(future_predictions).astype(int)
@@ -59,3 +100,142 @@ def predict_consumption(ean, df, models, scaler):
         return future_dates, future_predictions, ean_data
     else:
         return None, None, None
+
+
+def _predict_row(model, X):
+    """Predicts a single input row, skipping the per-call overhead of RandomForestRegressor.predict.
+
+    Returns a scalar, or one value per week for multi-week models.
+    """
+    if not isinstance(model, RandomForestRegressor):
+        return model.predict(X)[0]
+
+    # Same accumulation order as RandomForestRegressor.predict, without input validation and thread dispatch
+    prediction = 0.0
+    for estimator in model.estimators_:
+        prediction += estimator.predict(X, check_input=False)[0]
+    return prediction / len(model.estimators_)
+
+
+def _predict_rows(row_models, lags):
+    """Predicts one lag vector per model with a single evaluation per distinct model.
+
+    The rows of the EANs sharing a model (the global model of the global
+    and hybrid strategies) are stacked and predicted at once. Yields the
+    positions of the rows of each model and their predictions, one row each
+    (one column per week for multi-week models).
+    """
+    groups = {}
+    for i, model in enumerate(row_models):
+        if isinstance(model, GlobalEANModel):
+            model, X = model.model, model.inputs(lags[i])
+        else:
+            X = np.asarray(lags[i], dtype=np.float32).reshape(1, -1)
+        groups.setdefault(id(model), (model, [], []))
+        groups[id(model)][1].append(i)
+        groups[id(model)][2].append(X)
+
+    for model, rows, inputs in groups.values():
+        if len(rows) == 1:
+            predicted = np.atleast_1d(_predict_row(model, inputs[0]))
+        else:
+            predicted = model.predict(np.vstack(inputs))
+        yield np.array(rows), np.asarray(predicted).reshape(len(rows), -1)
+
+
+def latest_lag_matrix(df, eans=None):
+    """Gathers the last lag vector of every EAN into one matrix.
+
+    Returns the EANs, the start date of their last recorded week and a
+    (n_eans, N_LAGS) matrix with the most recent week in the first column.
+    EANs with fewer than N_LAGS weeks of history are left out.
+    """
+    if isinstance(df, WeeklyConsumptionStore):
+        return df.tail_matrix(N_LAGS, eans)
+
+    if eans is not None:
+        df = df[df["EAN"].isin(eans)]
+    df = df.sort_values(["EAN", "Week_Start"], kind="stable")
+
+    # Keep the EANs with enough history and their last N_LAGS weeks
+    counts = df.groupby("EAN", sort=False).size()
+    df = df[df["EAN"].isin(counts.index[counts >= N_LAGS])]
+    last_weeks = df.groupby("EAN", sort=False).tail(N_LAGS)
+
+    keys = last_weeks["EAN"].to_numpy()[N_LAGS - 1::N_LAGS]
+    last_week_start = pd.to_datetime(last_weeks["Week_Start"].to_numpy()[N_LAGS - 1::N_LAGS])
+    lags = last_weeks["Total_Weekly_Consumption"].to_numpy(dtype=float).reshape(-1, N_LAGS)[:, ::-1]
+
+    return keys, last_week_start, np.ascontiguousarray(lags)
+
+
+def iter_batch_forecasts(df, models, scaler, eans=None, horizon=None, batch_size=1000, compiled=None):
+    """Forecasts the next `horizon` weeks of many EANs (all of them by default), one DataFrame per batch of EANs.
+
+    With compiled forests (see compiled_forest.py), the EANs they cover are
+    evaluated all at once instead of model by model; the others are
+    evaluated once per distinct model, so the EANs sharing the global model
+    are predicted in a single call. Multi-week models are
+    only evaluated once every n_outputs weeks. horizon defaults to the one
+    of the models (see forecast_horizon).
+    """
+    if horizon is None:
+        horizon = forecast_horizon(models)
+    keys, last_week_start, lags = latest_lag_matrix(df, eans)
+
+    # Only EANs with a trained model can be forecast
+    known = np.array([ean in models for ean in keys], dtype=bool)
+    keys, last_week_start, lags = keys[known], last_week_start[known], lags[known]
+    is_compiled = compiled.covers(keys, models) if compiled is not None else np.zeros(len(keys), dtype=bool)
+    week_offsets = pd.to_timedelta(np.arange(1, horizon + 1), unit="W")
+
+    for start in range(0, len(keys), batch_size):
+        batch_keys = keys[start:start + batch_size]
+        count("eans", len(batch_keys))
+        count("compiled_eans", int(is_compiled[start:start + batch_size].sum()))
+        batch_lags = lags[start:start + batch_size].copy()
+        batch_compiled = is_compiled[start:start + batch_size]
+        predictions_scaled = np.empty((len(batch_keys), horizon))
+
+        # Number of weeks each EAN's model predicts per evaluation
+        outputs = np.array([compiled.n_outputs if is_compiled_ean else model_outputs(models[ean])
+                            for ean, is_compiled_ean in zip(batch_keys, batch_compiled)], dtype=int)
+
+        for step in range(horizon):
+            # Evaluate the models whose previous predictions are used up, for every EAN of the batch at once
+            due = step % outputs == 0
+            weeks = horizon - step
+            rows = due & batch_compiled
+            if rows.any():
+                predicted = compiled.predict(batch_keys[rows], batch_lags[rows]).reshape(rows.sum(), -1)[:, :weeks]
+                predictions_scaled[rows, step:step + predicted.shape[1]] = predicted
+            rows = np.flatnonzero(due & ~batch_compiled)
+            for model_rows, predicted in _predict_rows([models[ean] for ean in batch_keys[rows]], batch_lags[rows]):
+                predicted = predicted[:, :weeks]
+                predictions_scaled[rows[model_rows], step:step + predicted.shape[1]] = predicted
+
+            # Roll all the lag vectors at once for the next step
+            batch_lags[:, 1:] = batch_lags[:, :-1]
+            batch_lags[:, 0] = predictions_scaled[:, step]
+
+        # A single in-place inverse transform for the whole batch, broadcasting the scaling of each EAN
+        predictions = unscale(predictions_scaled, df, scaler, batch_keys)
+
+        yield pd.DataFrame({
+            "EAN": np.repeat(batch_keys, horizon),
+            "Week": np.tile(np.arange(1, horizon + 1), len(batch_keys)),
+            "Week_Start": np.repeat(last_week_start[start:start + batch_size], horizon) + np.tile(week_offsets,
+                                                                                                len(batch_keys)),
+            "Predicted_Consumption": np.round(predictions).astype(int).ravel(),
+        })
+
+
+def predict_batch(df, models, scaler, eans=None, horizon=None, compiled=None):
+    """Forecasts the next weeks of many EANs and returns a single DataFrame."""
+    if horizon is None:
+        horizon = forecast_horizon(models)
+    with stage("predict.batch", horizon=horizon, compiled=compiled is not None):
+        batches = list(iter_batch_forecasts(df, models, scaler, eans, horizon, compiled=compiled))
+    if not batches:
+        return pd.DataFrame(columns=["EAN", "Week", "Week_Start", "Predicted_Consumption"])
+    return pd.concat(batches, ignore_index=True)
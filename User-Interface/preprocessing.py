@@ -1,92 +1,203 @@
-import sys
+import argparse
 import os
 import pandas as pd
 import numpy as np
 from sklearn.preprocessing import StandardScaler
 import joblib
+from dataset_store import (WeeklyConsumptionStore, build_store_arrays, fit_ean_scaling, save_store_arrays,
+                           series_fingerprints)
+from instrumentation import add_instrumentation_arguments, configure_from_args, count, stage
+from snapshots import current_snapshot, new_snapshot
+from utils import load_scaler
 
+# Number of raw transactions read at once
+CHUNK_SIZE = 500_000
 
-def preprocess_data(filename):
-    dataset_folder = "../Dataset"
-    input_path = os.path.join(dataset_folder, filename)
 
-    # Load dataset
-    df = pd.read_csv(input_path)
+def _take(values, codes):
+    """Maps factorized codes back to values, code -1 (missing) giving NaT."""
+    return np.append(values.astype("datetime64[ns]"), np.datetime64("NaT"))[codes]
 
-    ### Convert Date Column to Datetime Format and Extract Week-Based Features
-    # Remove the time part (anything after the year)
-    df["Creation Date"] = df["Creation Date"].str.extract(r"([A-Za-z]+ \d{1,2}, \d{4})")
 
-    # Convert to datetime with the correct format
-    df["Creation Date"] = pd.to_datetime(df["Creation Date"], format="%b %d, %Y")
+def parse_week_start(creation_dates):
+    """Converts raw 'Creation Date' strings to the Monday of their week.
 
-    # Since we predict on a per-week basis, we extract week-related features
+    Each distinct string is parsed once and each distinct week computed once,
+    then mapped back to the rows, instead of parsing row by row.
+    """
+    codes, unique_dates = pd.factorize(creation_dates.astype(object))
 
-    # Get the year-week format (e.g., "2024-03" for the 3rd week of 2024)
-    df["Creation_Week"] = df["Creation Date"].dt.strftime('%Y-%U')
+    # Remove the time part (anything after the year) and convert to datetime with the correct format
+    dates = pd.to_datetime(pd.Series(unique_dates, dtype=object).str.extract(r"([A-Za-z]+ \d{1,2}, \d{4})")[0],
+                           format="%b %d, %Y")
 
-    # Extract the week number separately (useful for tracking seasonal patterns)
-    df["Week_Number"] = df["Creation Date"].dt.isocalendar().week
+    # Get the year-week format (e.g., "2024-03" for the 3rd week of 2024), then the Monday of that week
+    week_codes, unique_weeks = pd.factorize(dates.dt.strftime('%Y-%U'))
+    week_starts = pd.to_datetime(pd.Series(unique_weeks, dtype=object) + '-1', format='%Y-%U-%w')
 
-    # Extract the year for further grouping if needed
-    df["Year"] = df["Creation Date"].dt.year
+    return _take(_take(week_starts.to_numpy(), week_codes), codes)
 
-    ### Aggregate Weekly Consumption Per Product
-    # Group by EAN and week, summing up the Quantite
-    weekly_consumption = df.groupby(["EAN", "Creation_Week"])["Quantite"].sum().reset_index()
 
-    # Rename columns for clarity
-    weekly_consumption.rename(columns={"Quantite": "Total_Weekly_Consumption"}, inplace=True)
+def aggregate_transactions(input_path, chunksize=CHUNK_SIZE, sales=None, on_chunk=None):
+    """Streams a raw transaction CSV and accumulates the quantity sold per EAN and week.
+
+    Only one chunk of transactions and the weekly sums are held in memory.
+    `sales` holds previously aggregated weeks to which the new file is added.
+    Rows without EAN or date are kept as (EAN, NaT) / (NaN, week) entries so
+    that their products and weeks still appear in the zero-filled grid.
+    on_chunk(rows_read) is called after each chunk.
+    """
+    rows_read = 0
+    reader = pd.read_csv(input_path, usecols=["EAN", "Quantite", "Creation Date"], chunksize=chunksize)
+    for chunk in reader:
+        count("rows", len(chunk))
+        with stage("preprocess.parse_dates", rows=len(chunk)):
+            week_start = parse_week_start(chunk["Creation Date"])
+        weekly = pd.DataFrame({
+            "EAN": chunk["EAN"],
+            "Week_Start": week_start,
+            "Quantite": chunk["Quantite"],
+        })
+        if sales is not None:
+            weekly = pd.concat([sales, weekly], ignore_index=True)
+
+        # Group by EAN and week, summing up the Quantite
+        with stage("preprocess.group_weeks", rows=len(weekly)):
+            sales = weekly.groupby(["EAN", "Week_Start"], dropna=False)["Quantite"].sum().reset_index()
+
+        rows_read += len(chunk)
+        if on_chunk is not None:
+            on_chunk(rows_read)
+
+    return sales
+
 
+def build_weekly_consumption(sales):
+    """Splits the aggregated sales into the weeks with sales, the week calendar and the products."""
     ### Handle Missing Weeks
     # Some products might not be sold every week, leading to missing data
-    # To ensure a continuous time series, we fill missing weeks with 0
+    # The store keeps only the weeks with sales; the missing weeks are filled with 0 when the data is read
 
-    # Get all unique weeks in the dataset
-    all_weeks = df["Creation_Week"].unique()
+    # Get all unique weeks and all unique products (EANs) in the dataset
+    all_weeks = np.sort(sales["Week_Start"].dropna().unique())
+    products = sales["EAN"].dropna().unique()
 
-    # Get all unique products (EANs)
-    products = df["EAN"].unique()
+    ### 1. Remove records where EAN or week is null, and the weeks without sales
+    weekly_sales = sales.dropna(subset=["EAN", "Week_Start"])
+    weekly_sales = weekly_sales[weekly_sales["Quantite"] != 0]
 
-    # Create a full index of all possible (EAN, Week) combinations
-    complete_index = pd.MultiIndex.from_product([products, all_weeks], names=["EAN", "Creation_Week"])
+    # Rename columns for clarity
+    weekly_sales = weekly_sales.rename(columns={"Quantite": "Total_Weekly_Consumption"})
 
-    # Reindex the DataFrame to fill in missing weeks with 0
-    weekly_consumption = weekly_consumption.set_index(["EAN", "Creation_Week"]).reindex(complete_index,
-                                                                                        fill_value=0).reset_index()
+    return weekly_sales, all_weeks, products
 
-    ### 1. Remove records where EAN is null
-    weekly_consumption = weekly_consumption.dropna(subset=["EAN"])
 
-    ### 3. Convert Creation_Week to a Proper Datetime Object
-    weekly_consumption['Week_Start'] = weekly_consumption['Creation_Week'].apply(
-        lambda x: pd.to_datetime(x + '-1', format='%Y-%U-%w')
-    )
+def fit_scaler(weekly_sales, n_weeks, n_products):
+    """Fits the StandardScaler of the zero-filled EAN x week grid without building the grid."""
+    quantities = weekly_sales["Total_Weekly_Consumption"].to_numpy(dtype=float)
+    n_samples = n_weeks * n_products
+    n_zeros = n_samples - len(quantities)
 
-    ### 4. Encode EAN as a Categorical Variable
-    weekly_consumption['EAN'] = weekly_consumption['EAN'].astype(str)
+    # Mean and variance over every cell of the grid, the zero-filled ones included
+    mean = quantities.sum() / n_samples
+    var = (((quantities - mean) ** 2).sum() + n_zeros * mean ** 2) / n_samples
 
-    ### 5. Normalize Numerical Features
     scaler = StandardScaler()
-    weekly_consumption[['Total_Weekly_Consumption']] = scaler.fit_transform(
-        weekly_consumption[['Total_Weekly_Consumption']]
-    )
-
-    # Save the scaler
-    joblib.dump(scaler, "../scaler.pkl")
+    scaler.n_features_in_ = 1
+    scaler.n_samples_seen_ = n_samples
+    scaler.mean_ = np.array([mean])
+    scaler.var_ = np.array([var])
+    scaler.scale_ = np.array([np.sqrt(var) if var > 0 else 1.0])
+    return scaler
+
+
+def prepare_dataset(filename, keep_scaler=False, append=False, chunksize=CHUNK_SIZE, on_chunk=None,
+                    per_ean_scaling=True, snapshot=None):
+    """Runs the preprocessing in memory, without writing anything to disk.
+
+    With per_ean_scaling the store standardizes each EAN with its own mean
+    and scale, so that high-volume EANs don't squash the others; the global
+    scaler is still fitted for the DataFrame-based tools. The previous
+    sales, scaler and store (append and keep_scaler) are read from snapshot
+    (default: the current one).
+    Returns the aggregated weekly sales, the dataset store arrays and the scaler.
+    """
+    dataset_folder = "../Dataset"
+    input_path = os.path.join(dataset_folder, filename)
+    snapshot = snapshot or current_snapshot()
 
-    ### 6. Sort the Data by Product and Week
-    weekly_consumption.sort_values(["EAN", "Week_Start"], inplace=True)
+    ### Aggregate Weekly Consumption Per Product
+    # In append mode the new transactions are added to the weeks aggregated from previous files
+    previous_sales = None
+    if append and os.path.exists(snapshot.sales_path):
+        previous_sales = pd.read_pickle(snapshot.sales_path)
+    with stage("preprocess.aggregate", file=filename):
+        sales = aggregate_transactions(input_path, chunksize, previous_sales, on_chunk)
+
+    with stage("preprocess.weekly_consumption"):
+        weekly_sales, all_weeks, products = build_weekly_consumption(sales)
+        count("products", len(products))
+        count("weeks", len(all_weeks))
+
+    # Hash each product's sales before scaling, to detect which products changed since the last training
+    with stage("preprocess.fingerprints"):
+        fingerprints = series_fingerprints(weekly_sales)
 
-    ### Export the cleaned data to CSV
-    weekly_consumption.to_csv("../Dataset/weekly_consumption.csv", index=False)
-    print(f"Preprocessing complete! Saved as weekly_consumption in Dataset folder")
+    ### 5. Normalize Numerical Features
+    # The quantities stay unscaled in the store; the scaler is applied when the data is read
+    if keep_scaler and os.path.exists(snapshot.scaler_path):
+        # Incremental updates keep the previous scale so that unchanged models stay valid
+        scaler = load_scaler(snapshot)
+    else:
+        scaler = fit_scaler(weekly_sales, len(all_weeks), len(products))
+
+    with stage("preprocess.store_arrays"):
+        arrays = build_store_arrays(weekly_sales, all_weeks, products, scaler, fingerprints)
+        if per_ean_scaling:
+            # Keeping the scale also keeps the scaling of the unchanged EANs
+            previous = None
+            if keep_scaler and os.path.exists(os.path.join(snapshot.store_dir, "ean_scaling.npy")):
+                previous = WeeklyConsumptionStore(snapshot.store_dir)
+            arrays["ean_scaling"] = fit_ean_scaling(arrays, previous)
+    return sales, arrays, scaler
+
+
+def save_dataset(sales, arrays, scaler, snapshot):
+    """Writes the outputs of prepare_dataset to an unpublished snapshot: weekly sales, scaler and indexed store."""
+    with stage("preprocess.save"):
+        # Every file is written aside and swapped in, leaving the files shared with the previous snapshot intact
+        sales.to_pickle(snapshot.sales_path + ".tmp")
+        os.replace(snapshot.sales_path + ".tmp", snapshot.sales_path)
+
+        # Save the scaler
+        joblib.dump(scaler, snapshot.scaler_path + ".tmp")
+        os.replace(snapshot.scaler_path + ".tmp", snapshot.scaler_path)
+
+        ### Export the cleaned data to the indexed store (memory-mapped when loaded)
+        save_store_arrays(arrays, snapshot.store_dir)
+
+
+def preprocess_data(filename, keep_scaler=False, append=False, chunksize=CHUNK_SIZE, per_ean_scaling=True):
+    # Published as a new snapshot with the current models: readers switch to it once it is complete
+    with stage("preprocess", file=filename), new_snapshot() as snapshot:
+        save_dataset(*prepare_dataset(filename, keep_scaler, append, chunksize, per_ean_scaling=per_ean_scaling,
+                                      snapshot=snapshot), snapshot)
+    print(f"Preprocessing complete! Published as snapshot {snapshot.version}")
 
 
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print("Error: No filename provided!")
-        sys.exit(1)
-
-    filename = sys.argv[1]
-    preprocess_data(filename)
+    parser = argparse.ArgumentParser(description="Preprocess a transaction file into the weekly consumption store.")
+    parser.add_argument("filename", help="Transaction CSV file of the ../Dataset folder")
+    parser.add_argument("--keep-scaler", action="store_true",
+                        help="Keep the scaling of the current snapshot, so that the unchanged models stay valid")
+    parser.add_argument("--append", action="store_true",
+                        help="Add the transactions to the weekly sales of the current snapshot")
+    parser.add_argument("--global-scaling", action="store_true",
+                        help="Standardize every EAN with the global scaler instead of its own mean and scale")
+    parser.add_argument("--chunksize", type=int, default=CHUNK_SIZE, help="Number of transactions read at once")
+    add_instrumentation_arguments(parser)
+    args = parser.parse_args()
+    configure_from_args(args)
+
+    preprocess_data(args.filename, args.keep_scaler, args.append, args.chunksize,
+                    per_ean_scaling=not args.global_scaling)
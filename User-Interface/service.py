@@ -0,0 +1,325 @@
+import argparse
+import json
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from compiled_forest import load_compiled_forests
+from ean_index import ean_key
+from forecast_table import load_forecast_table
+from model_store import MAX_CACHED_MODELS
+from prediction import forecast_horizon, predict_batch
+from snapshots import SnapshotLease, current_snapshot
+from utils import load_models, load_dataset
+
+# How long the batcher waits for more requests before evaluating the ones it holds (seconds)
+BATCH_WINDOW = 0.005
+# Most EANs evaluated in a single batch
+MAX_BATCH_EANS = 1000
+# How often the service checks whether a new snapshot was published (seconds)
+RELOAD_INTERVAL = 5.0
+
+
+class ForecastBatcher:
+    """Coalesces concurrent forecast requests into batched model evaluations.
+
+    Requests are queued from any thread. A single worker thread takes the
+    first waiting request, gathers the ones arriving within BATCH_WINDOW,
+    forecasts all their EANs with one predict_batch call and resolves each
+    request's Future with its own EANs. EANs with a valid entry in the
+    forecast table (see forecast_table.py) are looked up instead, and
+    compiled forests (see compiled_forest.py) evaluate the others.
+    swap() replaces the artifacts between two batches. horizon defaults to
+    the one of the models being served (see prediction.forecast_horizon).
+    """
+
+    def __init__(self, df, models, scaler, horizon=None, window=BATCH_WINDOW,
+                 max_batch_eans=MAX_BATCH_EANS, table=None, compiled=None):
+        self.df = df
+        self.models = models
+        self.scaler = scaler
+        self.compiled = compiled
+        self.horizon = horizon
+        self.table = table if table is not None and table.horizon == self.weeks else None
+        self.window = window
+        self.max_batch_eans = max_batch_eans
+        self.batches = 0
+        self.requests = 0
+        self._artifacts_lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    @property
+    def weeks(self):
+        """Number of weeks forecast with the current artifacts."""
+        return self.horizon or forecast_horizon(self.models)
+
+    def submit(self, eans):
+        """Queues a forecast of eans and returns a Future of {ean: list of forecast weeks}."""
+        future = Future()
+        self._queue.put((list(eans), future))
+        return future
+
+    def forecast(self, eans, timeout=None):
+        """Forecasts eans, waiting for the batch they are evaluated in."""
+        return self.submit(eans).result(timeout)
+
+    def swap(self, df, models, scaler, table=None, compiled=None):
+        """Serves the next batches from other artifacts, e.g. the ones of a newly published snapshot."""
+        with self._artifacts_lock:
+            self.df = df
+            self.models = models
+            self.scaler = scaler
+            self.compiled = compiled
+            self.table = table if table is not None and table.horizon == self.weeks else None
+
+    def close(self):
+        """Stops the worker thread once the queued requests are served."""
+        self._queue.put(None)
+        self._thread.join()
+
+    def _collect(self):
+        """Waits for a request, then gathers the ones arriving within the batch window."""
+        first = self._queue.get()
+        if first is None:
+            return None
+
+        pending = [first]
+        n_eans = len(first[0])
+        while n_eans < self.max_batch_eans:
+            try:
+                item = self._queue.get(timeout=self.window)
+            except queue.Empty:
+                break
+            if item is None:
+                # Serve what was gathered, then stop
+                self._queue.put(None)
+                break
+            pending.append(item)
+            n_eans += len(item[0])
+        return pending
+
+    def _run(self):
+        while True:
+            pending = self._collect()
+            if pending is None:
+                break
+
+            eans = {ean for request_eans, _ in pending for ean in request_eans}
+            try:
+                with self._artifacts_lock:
+                    by_ean = self._forecast(eans)
+            except Exception:
+                # Forecast each request on its own, so that a failure only reaches the request causing it
+                self._run_separately(pending)
+                continue
+
+            self.batches += 1
+            self.requests += len(pending)
+            for request_eans, future in pending:
+                future.set_result({ean: by_ean[ean] for ean in request_eans if ean in by_ean})
+
+    def _run_separately(self, pending):
+        for request_eans, future in pending:
+            try:
+                with self._artifacts_lock:
+                    by_ean = self._forecast(set(request_eans))
+            except Exception as e:
+                future.set_exception(e)
+                continue
+            self.batches += 1
+            self.requests += 1
+            future.set_result({ean: by_ean[ean] for ean in request_eans if ean in by_ean})
+
+    def _forecast(self, eans):
+        """Returns {ean: list of forecast weeks}, from the forecast table or with one batched evaluation."""
+        by_ean = {}
+        if self.table is not None:
+            for ean in eans:
+                future_dates, future_predictions = self.table.lookup(ean, self.df, self.models)
+                if future_dates is not None:
+                    by_ean[ean] = [{"week_start": date.strftime("%Y-%m-%d"), "predicted_consumption": int(quantity)}
+                                   for date, quantity in zip(future_dates, future_predictions)]
+
+        remaining = [ean for ean in eans if ean not in by_ean]
+        if remaining:
+            forecasts = predict_batch(self.df, self.models, self.scaler, remaining, self.weeks, self.compiled)
+            for ean, week_start, quantity in zip(forecasts["EAN"].to_numpy(), forecasts["Week_Start"],
+                                                 forecasts["Predicted_Consumption"].to_numpy()):
+                by_ean.setdefault(int(ean), []).append({"week_start": week_start.strftime("%Y-%m-%d"),
+                                                        "predicted_consumption": int(quantity)})
+        return by_ean
+
+
+class ForecastRequestHandler(BaseHTTPRequestHandler):
+    """Serves GET /forecast?ean=<ean>, POST /forecast with {"eans": [...]} and GET /health."""
+
+    # Keep-alive connections, so clients do not reconnect for every request
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately: send them right away instead of waiting for an ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _forecast(self, eans):
+        """Forecasts eans, or answers 500 and returns None if the forecast fails (e.g. unreadable artifacts)."""
+        try:
+            return self.server.batcher.forecast(eans)
+        except Exception as e:
+            self.log_error("Forecast of %d EANs failed: %r", len(eans), e)
+            self._send_json(500, {"error": f"Forecast failed: {e}"})
+            return None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == "/health":
+            batcher = self.server.batcher
+            self._send_json(200, {"status": "ok", "eans": len(batcher.models),
+                                  "batches": batcher.batches, "requests": batcher.requests})
+            return
+        if url.path != "/forecast":
+            self._send_json(404, {"error": "Not found"})
+            return
+
+        try:
+            ean = ean_key(parse_qs(url.query)["ean"][0])
+        except KeyError:
+            ean = None
+        if ean is None:
+            self._send_json(400, {"error": "Expected a numeric 'ean' query parameter"})
+            return
+
+        forecasts = self._forecast([ean])
+        if forecasts is None:
+            return
+        if ean not in forecasts:
+            self._send_json(404, {"error": f"No trained model found for EAN {ean}"})
+            return
+        self._send_json(200, {"ean": ean, "forecast": forecasts[ean]})
+
+    def do_POST(self):
+        if urlparse(self.path).path != "/forecast":
+            self._send_json(404, {"error": "Not found"})
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            # JSON true/false would otherwise pass as EANs 1 and 0
+            eans = [None if isinstance(ean, bool) else ean_key(ean)
+                    for ean in json.loads(self.rfile.read(length))["eans"]]
+        except (KeyError, TypeError, ValueError):
+            eans = [None]
+        if None in eans:
+            self._send_json(400, {"error": "Expected a JSON body like {\"eans\": [...]} of valid EANs"})
+            return
+
+        forecasts = self._forecast(eans)
+        if forecasts is None:
+            return
+        self._send_json(200, {
+            "forecasts": [{"ean": ean, "forecast": forecasts[ean]} for ean in eans if ean in forecasts],
+            "missing": [ean for ean in eans if ean not in forecasts],
+        })
+
+
+def warm_models(df, models, max_models=MAX_CACHED_MODELS):
+    """Loads up to max_models models into the model cache ahead of the first requests."""
+    if not hasattr(models, "get"):
+        return 0
+    warmed = 0
+    for ean in df.eans:
+        if warmed >= max_models:
+            break
+        if ean in models:
+            models.get(ean)
+            warmed += 1
+    return warmed
+
+
+def load_artifacts(snapshot, max_models=MAX_CACHED_MODELS):
+    """Loads the (dataset, models, scaler, forecast table, compiled forests) of a snapshot, warming the models."""
+    models, scaler = load_models(max_models=max_models, snapshot=snapshot)
+    df = load_dataset(snapshot)
+    print(f"Warmed {warm_models(df, models, max_models)} models of snapshot {snapshot.version}")
+    return df, models, scaler, load_forecast_table(snapshot.models_dir), load_compiled_forests(snapshot.models_dir)
+
+
+def follow_snapshots(batcher, lease, max_models=MAX_CACHED_MODELS, interval=RELOAD_INTERVAL):
+    """Switches the batcher to each newly published snapshot, never returns.
+
+    lease pins the snapshot in use, so that its files stay on disk while
+    models are loaded from it; it is moved to each new snapshot.
+    """
+    while True:
+        time.sleep(interval)
+        lease.refresh()
+        snapshot = current_snapshot()
+        if snapshot.version == lease.snapshot.version:
+            continue
+
+        new_lease = SnapshotLease(snapshot)
+        try:
+            artifacts = load_artifacts(snapshot, max_models)
+        except Exception as e:
+            new_lease.release()
+            print(f"Could not load snapshot {snapshot.version}, still serving {lease.snapshot.version}: {e}")
+            continue
+        batcher.swap(*artifacts)
+        lease.release()
+        lease = new_lease
+        print(f"Serving snapshot {snapshot.version}")
+
+
+def create_server(df, models, scaler, host="127.0.0.1", port=8000, horizon=None,
+                  window=BATCH_WINDOW, verbose=False, table=None, compiled=None):
+    """Creates the forecast HTTP server around already loaded models, scaler, dataset, forecast table
+    and compiled forests."""
+    server = ThreadingHTTPServer((host, port), ForecastRequestHandler)
+    server.daemon_threads = True
+    server.batcher = ForecastBatcher(df, models, scaler, horizon, window, table=table, compiled=compiled)
+    server.verbose = verbose
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve weekly consumption forecasts over HTTP.")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on")
+    parser.add_argument("--port", type=int, default=8000, help="Port to listen on")
+    parser.add_argument("--horizon", type=int, default=None,
+                        help="Number of weeks to forecast (default: the one set by the training of the models)")
+    parser.add_argument("--window", type=float, default=BATCH_WINDOW * 1000,
+                        help="Milliseconds to wait for concurrent requests to batch together")
+    parser.add_argument("--max-models", type=int, default=MAX_CACHED_MODELS,
+                        help="Number of models kept loaded in memory")
+    parser.add_argument("--verbose", action="store_true", help="Log every request")
+    args = parser.parse_args()
+
+    # Everything from the same snapshot, even if a new one is published meanwhile, then from each new one
+    snapshot = current_snapshot()
+    lease = SnapshotLease(snapshot)
+    df, models, scaler, table, compiled = load_artifacts(snapshot, args.max_models)
+
+    server = create_server(df, models, scaler, args.host, args.port, args.horizon, args.window / 1000, args.verbose,
+                           table=table, compiled=compiled)
+    threading.Thread(target=follow_snapshots, args=(server.batcher, lease, args.max_models), daemon=True).start()
+    print(f"Serving forecasts on http://{args.host}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.batcher.close()
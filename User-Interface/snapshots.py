@@ -0,0 +1,293 @@
+import argparse
+import datetime
+import os
+import shutil
+import time
+from contextlib import contextmanager
+from dataset_store import STORE_DIR
+from instrumentation import stage
+from model_store import MODELS_DIR
+from ownership import is_stale, process_owner
+
+SNAPSHOTS_DIR = "../Snapshots"
+CURRENT_FILE = "CURRENT"
+
+# Locations of the artifacts before snapshots, still read while no snapshot was published
+SCALER_PATH = "../scaler.pkl"
+SALES_PATH = "../Dataset/weekly_sales.pkl"
+
+# Published snapshots kept by the garbage collection, the current one aside
+KEEP_SNAPSHOTS = 3
+
+# Snapshots still being written after this long were left by a crashed run (seconds)
+STALE_STAGING_SECONDS = 24 * 3600
+
+# Leases of processes of another machine not refreshed for this long belong to a process that died (seconds)
+LEASE_TIMEOUT = 24 * 3600
+
+_STAGING_PREFIX = ".staging-"
+_LEASES_DIR_NAME = ".leases"
+
+
+class Snapshot:
+    """The artifacts of one version: dataset store, weekly sales, scaler and model store.
+
+    A published snapshot is never modified: writers build a new one next to
+    it and publish it by swapping the CURRENT pointer file, so readers keep
+    using the files of the snapshot they opened without any locking. A
+    snapshot with no path stands for the artifacts of the layout used before
+    snapshots (../Dataset, ../Models and ../scaler.pkl).
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+
+    @property
+    def version(self):
+        return None if self.path is None else os.path.basename(self.path)
+
+    @property
+    def store_dir(self):
+        return STORE_DIR if self.path is None else os.path.join(self.path, "dataset")
+
+    @property
+    def sales_path(self):
+        return SALES_PATH if self.path is None else os.path.join(self.path, "weekly_sales.pkl")
+
+    @property
+    def scaler_path(self):
+        return SCALER_PATH if self.path is None else os.path.join(self.path, "scaler.pkl")
+
+    @property
+    def models_dir(self):
+        return MODELS_DIR if self.path is None else os.path.join(self.path, "models")
+
+
+def list_snapshots(root=SNAPSHOTS_DIR):
+    """Returns the versions of the published snapshots, oldest first."""
+    if not os.path.isdir(root):
+        return []
+    return sorted(name for name in os.listdir(root)
+                  if not name.startswith(".") and os.path.isdir(os.path.join(root, name)))
+
+
+def current_snapshot(root=SNAPSHOTS_DIR):
+    """Returns the snapshot the CURRENT pointer designates, or the pre-snapshot layout if none was published."""
+    try:
+        with open(os.path.join(root, CURRENT_FILE)) as f:
+            version = f.read().strip()
+    except FileNotFoundError:
+        return Snapshot()
+    return Snapshot(os.path.join(root, version))
+
+
+class SnapshotLease:
+    """Pins a published snapshot while a process reads it, so that the garbage collection keeps it.
+
+    The lease is a file of the .leases folder of the snapshots, named after
+    the version and holding the host and PID of the process. Leases of
+    stopped processes of this machine, and leases of other machines not
+    refreshed for LEASE_TIMEOUT, are ignored. Leasing the pre-snapshot
+    layout (no path) does nothing.
+    """
+
+    def __init__(self, snapshot, root=SNAPSHOTS_DIR):
+        self.snapshot = snapshot
+        self.path = None
+        if snapshot.version is None:
+            return
+        leases_dir = os.path.join(root, _LEASES_DIR_NAME)
+        os.makedirs(leases_dir, exist_ok=True)
+        self.path = os.path.join(leases_dir, f"{snapshot.version}.{os.getpid()}-{time.time_ns()}")
+        with open(self.path, "w") as f:
+            f.write(process_owner())
+
+    def refresh(self):
+        """Keeps the lease of a long-running process valid on the other machines."""
+        if self.path is not None:
+            try:
+                os.utime(self.path)
+            except OSError:
+                pass
+
+    def release(self):
+        if self.path is not None:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+            self.path = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+def leased_versions(root=SNAPSHOTS_DIR):
+    """Returns the versions pinned by a live lease, removing the stale leases."""
+    leases_dir = os.path.join(root, _LEASES_DIR_NAME)
+    if not os.path.isdir(leases_dir):
+        return set()
+    versions = set()
+    for name in os.listdir(leases_dir):
+        if is_stale(os.path.join(leases_dir, name), LEASE_TIMEOUT):
+            try:
+                os.remove(os.path.join(leases_dir, name))
+            except FileNotFoundError:
+                pass
+        else:
+            versions.add(name.rsplit(".", 1)[0])
+    return versions
+
+
+def _link(source, destination):
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)  # File system without hard links
+
+
+def _link_tree(source, destination):
+    """Hard-links a file, or every file of a folder, to destination (copies where links are not supported)."""
+    if os.path.isfile(source):
+        _link(source, destination)
+        return
+    for folder, _, filenames in os.walk(source):
+        target = os.path.join(destination, os.path.relpath(folder, source))
+        os.makedirs(target, exist_ok=True)
+        for filename in filenames:
+            if not filename.endswith(".tmp"):
+                _link(os.path.join(folder, filename), os.path.join(target, filename))
+
+
+def create_snapshot(root=SNAPSHOTS_DIR, base=None):
+    """Creates an unpublished snapshot holding the artifacts of base (default: the current snapshot).
+
+    The files are hard links to the ones of base: writers must replace files
+    (write a new file, then os.replace it) and never rewrite them in place.
+    """
+    if base is None:
+        base = current_snapshot(root)
+    os.makedirs(root, exist_ok=True)
+    staging = Snapshot(os.path.join(root, f"{_STAGING_PREFIX}{time.time_ns()}-{os.getpid()}"))
+    os.makedirs(staging.path)
+    for name in ("store_dir", "sales_path", "scaler_path", "models_dir"):
+        source = getattr(base, name)
+        if os.path.exists(source):
+            _link_tree(source, getattr(staging, name))
+    return staging
+
+
+def _set_current(root, version):
+    pointer_path = os.path.join(root, CURRENT_FILE)
+    with open(pointer_path + ".tmp", "w") as f:
+        f.write(version + "\n")
+    os.replace(pointer_path + ".tmp", pointer_path)
+
+
+def publish_snapshot(snapshot, root=SNAPSHOTS_DIR, keep=KEEP_SNAPSHOTS):
+    """Publishes a snapshot made by create_snapshot as the current one, then removes the old ones.
+
+    The snapshot is renamed to a new version, named after the publishing
+    time so that versions sort in publishing order, and snapshot.path is
+    updated to it.
+    """
+    with stage("snapshot.publish"):
+        version = datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+        path = os.path.join(root, version)
+        os.rename(snapshot.path, path)
+        snapshot.path = path
+        # The pointer is swapped last: readers see the previous snapshot or the complete new one
+        _set_current(root, version)
+        collect_garbage(root, keep)
+    return snapshot
+
+
+def discard_snapshot(snapshot):
+    """Deletes an unpublished snapshot."""
+    shutil.rmtree(snapshot.path, ignore_errors=True)
+
+
+@contextmanager
+def new_snapshot(root=SNAPSHOTS_DIR, keep=KEEP_SNAPSHOTS):
+    """Creates a snapshot from the current one for writing, and publishes it if the block completes.
+
+    The snapshot is discarded if the block raises. After the block, the
+    snapshot designates the published version.
+    """
+    snapshot = create_snapshot(root)
+    try:
+        yield snapshot
+    except BaseException:
+        discard_snapshot(snapshot)
+        raise
+    publish_snapshot(snapshot, root, keep)
+
+
+def rollback(root=SNAPSHOTS_DIR, version=None):
+    """Makes a published snapshot the current one (default: the one published before the current one).
+
+    Returns the version now current.
+    """
+    versions = list_snapshots(root)
+    if version is None:
+        current = current_snapshot(root).version
+        previous = [other for other in versions if current is None or other < current]
+        if not previous:
+            raise ValueError("No snapshot older than the current one")
+        version = previous[-1]
+    elif version not in versions:
+        raise ValueError(f"Unknown snapshot: {version}")
+
+    _set_current(root, version)
+    return version
+
+
+def collect_garbage(root=SNAPSHOTS_DIR, keep=KEEP_SNAPSHOTS):
+    """Removes the published snapshots but the `keep` newest, the current one and the leased ones,
+    and the stale unpublished ones.
+
+    Returns the removed versions. Kept snapshots leave time to the readers
+    of the previous versions to switch to the new one; readers that keep a
+    snapshot open for long hold a SnapshotLease on it.
+    """
+    if not os.path.isdir(root):
+        return []
+    current = current_snapshot(root).version
+    leased = leased_versions(root)
+    versions = list_snapshots(root)
+    removed = [version for version in versions[:max(len(versions) - keep, 0)]
+               if version != current and version not in leased]
+    for version in removed:
+        shutil.rmtree(os.path.join(root, version), ignore_errors=True)
+
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        if name.startswith(_STAGING_PREFIX) and time.time() - os.path.getmtime(path) > STALE_STAGING_SECONDS:
+            shutil.rmtree(path, ignore_errors=True)
+    return removed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="List, roll back or clean up the artifact snapshots.")
+    parser.add_argument("--rollback", nargs="?", const="", default=None, metavar="VERSION",
+                        help="Make a snapshot current (default: the one before the current one)")
+    parser.add_argument("--gc", action="store_true", help="Remove the old snapshots")
+    parser.add_argument("--keep", type=int, default=KEEP_SNAPSHOTS, help="Snapshots kept by --gc")
+    args = parser.parse_args()
+
+    if args.rollback is not None:
+        try:
+            print(f"Current snapshot: {rollback(version=args.rollback or None)}")
+        except ValueError as e:
+            parser.error(str(e))
+    if args.gc:
+        removed = collect_garbage(keep=args.keep)
+        print(f"Removed {len(removed)} snapshots")
+
+    current = current_snapshot().version
+    leased = leased_versions()
+    for version in list_snapshots():
+        print(f"{'*' if version == current else ' '} {version}{' (leased)' if version in leased else ''}")
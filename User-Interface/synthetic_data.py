@@ -0,0 +1,78 @@
+import argparse
+import os
+import numpy as np
+import pandas as pd
+
+MONTHS = np.array(["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"])
+
+# Number of SKUs generated and written at once
+SKU_BLOCK = 500
+
+
+def _format_creation_dates(timestamps):
+    """Formats timestamps like the raw exports, e.g. 'Apr 17, 2024 12:50 pm'."""
+    index = pd.DatetimeIndex(timestamps)
+    hours = index.hour.to_numpy()
+    return (pd.Series(MONTHS[index.month.to_numpy() - 1]) + " " + pd.Series(index.day.astype(str))
+            + ", " + pd.Series(index.year.astype(str)) + " " + pd.Series(((hours + 11) % 12 + 1).astype(str))
+            + ":" + pd.Series(index.minute.to_numpy()).map("{:02d}".format)
+            + " " + pd.Series(np.where(hours < 12, "am", "pm")))
+
+
+def generate_transactions(output_path, n_skus=100, n_weeks=52, sparsity=0.5, seed=0, start="2023-01-02",
+                          transactions_per_week=3.0):
+    """Writes a deterministic raw transaction CSV with the EAN / Quantite / Creation Date columns.
+
+    Each SKU gets its own level, yearly seasonality and probability of
+    selling in a given week (1 - sparsity on average). Weeks with sales hold
+    a Poisson number of transactions at random times of the week. The same
+    arguments always produce the same file. Returns the number of rows written.
+    """
+    rng = np.random.default_rng(seed)
+    eans = 3_000_000_000_000 + np.sort(rng.choice(999_999_999_999, n_skus, replace=False))
+    levels = rng.lognormal(mean=1.0, sigma=0.8, size=n_skus)
+    amplitudes = rng.uniform(0.0, 0.6, size=n_skus)
+    phases = rng.uniform(0.0, 2 * np.pi, size=n_skus)
+    sale_probabilities = np.clip(rng.beta(2, 2, size=n_skus) * 2 * (1 - sparsity), 0.02, 1.0)
+
+    week_starts = pd.Timestamp(start) + pd.to_timedelta(np.arange(n_weeks), unit="W")
+    season = 2 * np.pi * np.arange(n_weeks) / 52
+
+    n_rows = 0
+    for block_start in range(0, n_skus, SKU_BLOCK):
+        block = slice(block_start, min(block_start + SKU_BLOCK, n_skus))
+        n_block = block.stop - block.start
+
+        # Weeks with sales of each SKU of the block, then the transactions of each of these weeks
+        sells = rng.random((n_block, n_weeks)) < sale_probabilities[block, None]
+        demand = levels[block, None] * (1 + amplitudes[block, None] * np.sin(season + phases[block, None]))
+        counts = np.where(sells, 1 + rng.poisson(transactions_per_week - 1, (n_block, n_weeks)), 0)
+
+        sku_index, week_index = np.nonzero(counts)
+        repeats = counts[sku_index, week_index]
+        sku_index, week_index = np.repeat(sku_index, repeats), np.repeat(week_index, repeats)
+        quantities = 1 + rng.poisson(demand[sku_index, week_index])
+        offsets = pd.to_timedelta(rng.integers(0, 7 * 24 * 60, len(sku_index)), unit="min")
+
+        rows = pd.DataFrame({
+            "EAN": eans[block][sku_index],
+            "Quantite": quantities,
+            "Creation Date": _format_creation_dates(week_starts[week_index] + offsets),
+        })
+        rows.to_csv(output_path, mode="w" if block_start == 0 else "a", header=(block_start == 0), index=False)
+        n_rows += len(rows)
+
+    return n_rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic raw transaction CSV.")
+    parser.add_argument("output", help="CSV file to write")
+    parser.add_argument("--skus", type=int, default=100, help="Number of SKUs (EANs)")
+    parser.add_argument("--weeks", type=int, default=52, help="Number of weeks")
+    parser.add_argument("--sparsity", type=float, default=0.5, help="Average share of weeks without sales")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    args = parser.parse_args()
+
+    n_rows = generate_transactions(args.output, args.skus, args.weeks, args.sparsity, args.seed)
+    print(f"{n_rows} transactions written to {os.path.abspath(args.output)}")
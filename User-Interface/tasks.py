@@ -0,0 +1,49 @@
+import queue
+import threading
+
+
+class TaskRunner:
+    """Runs work off the Tk main thread and hands the results back to it.
+
+    Tk widgets must only be touched from the main thread: worker threads
+    never call them directly but queue callbacks, which the main thread
+    runs from a root.after polling loop.
+    """
+
+    def __init__(self, root, poll_interval=50):
+        self.root = root
+        self.poll_interval = poll_interval
+        self._callbacks = queue.Queue()
+        self.root.after(self.poll_interval, self._poll)
+
+    def call_soon(self, callback, *args):
+        """Schedules callback(*args) on the main thread. Safe to call from any thread."""
+        self._callbacks.put((callback, args))
+
+    def submit(self, function, *args, on_success=None, on_error=None):
+        """Runs function(*args) on a worker thread.
+
+        on_success(result) or on_error(exception) is then called on the main thread.
+        """
+        def run():
+            try:
+                result = function(*args)
+            except Exception as e:
+                if on_error is not None:
+                    self.call_soon(on_error, e)
+            else:
+                if on_success is not None:
+                    self.call_soon(on_success, result)
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+    def _poll(self):
+        while True:
+            try:
+                callback, args = self._callbacks.get_nowait()
+            except queue.Empty:
+                break
+            callback(*args)
+        self.root.after(self.poll_interval, self._poll)
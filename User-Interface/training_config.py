@@ -0,0 +1,51 @@
+import json
+import os
+import numpy as np
+from global_model import ean_features
+
+TRAINING_CONFIG_PATH = "../Models/training_config.json"
+
+# Forest parameters used when no tuned configuration applies
+DEFAULT_MODEL_PARAMS = {"n_estimators": 100}
+
+# The training config (written by tuning.py) groups EANs into clusters of similar history:
+#   volume_edges      bin edges of the mean weekly consumption of an EAN: unscaled when the store scales each
+#                     EAN separately (per-EAN scaled means are all 0), else scaled with the global scaler
+#   sales_rate_edges  bin edges of the share of weeks with sales
+#   clusters          {"<volume bin>-<sales rate bin>": forest parameters}
+# EANs are assigned to a cluster from their own history, so new EANs get tuned parameters too.
+
+
+def load_training_config(path=TRAINING_CONFIG_PATH):
+    """Loads the training config, or returns None if none was written."""
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_training_config(config, path=TRAINING_CONFIG_PATH):
+    """Writes the training config."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        json.dump(config, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def cluster_of(y, volume_edges, sales_rate_edges, scaling=None, zero=0.0):
+    """Returns the cluster key of an EAN from its scaled weekly consumption (and its own scaling, if any).
+
+    zero is the scaled value of the weeks without sales (see ean_features).
+    """
+    mean, _, sales_rate = ean_features(y, scaling, zero)
+    volume_bin = int(np.searchsorted(volume_edges, mean, side="right"))
+    sales_rate_bin = int(np.searchsorted(sales_rate_edges, sales_rate, side="right"))
+    return f"{volume_bin}-{sales_rate_bin}"
+
+
+def model_params(y, config=None, scaling=None, zero=0.0):
+    """Returns the forest parameters of an EAN: the ones tuned for its cluster, else the defaults."""
+    if config is None:
+        return dict(DEFAULT_MODEL_PARAMS)
+    cluster = cluster_of(y, config["volume_edges"], config["sales_rate_edges"], scaling, zero)
+    return {**DEFAULT_MODEL_PARAMS, **config["clusters"].get(cluster, {})}
@@ -0,0 +1,162 @@
+import json
+import os
+import shutil
+import time
+import joblib
+from ownership import is_stale, process_owner
+
+TRAINING_JOBS_DIR = "../Models/training_jobs"
+JOB_FILE = "job.json"
+
+# Number of EANs trained and checkpointed together
+PARTITION_SIZE = 500
+
+# A claim not refreshed for this long belongs to a worker that died (seconds)
+CLAIM_TIMEOUT = 600
+
+# Interval between two checks for the partitions trained by other workers (seconds)
+POLL_INTERVAL = 1.0
+
+# Jobs left unfinished for this long (e.g. for a dataset since replaced) are removed (seconds)
+JOB_EXPIRY = 7 * 24 * 3600
+
+
+class TrainingJob:
+    """A training run split into partitions of EANs, checkpointed in a folder that any number of workers drain.
+
+    Layout of the job folder:
+      job.json                what to train: the EANs of each partition and the training parameters
+      partition-<i>.claim     created with O_CREAT | O_EXCL by the worker training partition i,
+                              refreshed after each EAN and removed when the worker stops
+      partition-<i>.joblib    checkpoint of partition i: its (EAN, model, RMSE) results, written
+                              aside and swapped in, so it exists only once complete
+
+    The claims only avoid duplicate work: a partition trained twice (e.g.
+    after its claim was taken over from a worker wrongly thought dead) gives
+    the same checkpoint, as training is deterministic.
+    """
+
+    def __init__(self, job_dir):
+        self.job_dir = job_dir
+        with open(os.path.join(job_dir, JOB_FILE)) as f:
+            job = json.load(f)
+        self.partitions = job["partitions"]
+        self.spec = job["spec"]
+        self.owner = process_owner()
+
+    @classmethod
+    def open(cls, key, eans, spec, jobs_dir=TRAINING_JOBS_DIR, partition_size=PARTITION_SIZE):
+        """Opens the job `key`, creating it with the EANs cut into partitions if it doesn't exist yet.
+
+        key must identify what is trained (EANs, data and parameters), so
+        that a rerun of the same training resumes its job. A resumed job
+        gets the given spec, e.g. the dataset folder of the run resuming it,
+        which the joining workers read from.
+        """
+        job_dir = os.path.join(jobs_dir, key)
+        if not os.path.exists(os.path.join(job_dir, JOB_FILE)):
+            remove_expired_jobs(jobs_dir)
+            os.makedirs(job_dir, exist_ok=True)
+            eans = [int(ean) for ean in eans]
+            _write_job(job_dir, [eans[start:start + partition_size] for start in range(0, len(eans), partition_size)],
+                       spec)
+        job = cls(job_dir)
+        if job.spec != spec:
+            _write_job(job_dir, job.partitions, spec)
+            job.spec = spec
+        return job
+
+    def _path(self, partition, suffix):
+        return os.path.join(self.job_dir, f"partition-{partition:05d}.{suffix}")
+
+    def is_done(self, partition):
+        return os.path.exists(self._path(partition, "joblib"))
+
+    def completed(self):
+        """Returns the checkpointed partitions."""
+        return [partition for partition in range(len(self.partitions)) if self.is_done(partition)]
+
+    def is_complete(self):
+        return all(self.is_done(partition) for partition in range(len(self.partitions)))
+
+    def claim(self, partition):
+        """Claims a partition for this process. Returns False if it is done or claimed by a live worker."""
+        if self.is_done(partition):
+            return False
+        claim_path = self._path(partition, "claim")
+        if is_stale(claim_path, CLAIM_TIMEOUT):
+            try:
+                os.remove(claim_path)
+            except FileNotFoundError:
+                pass  # Taken over by another worker at the same time
+
+        try:
+            fd = os.open(claim_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "w") as f:
+            f.write(self.owner)
+        # Checkpointed between the check above and the claim
+        if self.is_done(partition):
+            self.release(partition)
+            return False
+        return True
+
+    def claim_next(self):
+        """Claims the first partition neither done nor claimed by a live worker, or returns None."""
+        for partition in range(len(self.partitions)):
+            if self.claim(partition):
+                return partition
+        return None
+
+    def heartbeat(self, partition):
+        """Refreshes the claim of a partition, so that other workers don't take it over."""
+        try:
+            os.utime(self._path(partition, "claim"))
+        except OSError:
+            pass
+
+    def release(self, partition):
+        """Removes the claim of a partition if this process still holds it."""
+        claim_path = self._path(partition, "claim")
+        try:
+            with open(claim_path) as f:
+                if f.read() != self.owner:
+                    return
+            os.remove(claim_path)
+        except OSError:
+            pass
+
+    def save_checkpoint(self, partition, results):
+        """Saves the (EAN, model, RMSE) results of a partition, marking it done."""
+        path = self._path(partition, "joblib")
+        joblib.dump(results, f"{path}.{os.getpid()}.tmp")
+        os.replace(f"{path}.{os.getpid()}.tmp", path)
+
+    def load_checkpoint(self, partition):
+        return joblib.load(self._path(partition, "joblib"))
+
+    def remove(self):
+        shutil.rmtree(self.job_dir, ignore_errors=True)
+
+
+def _write_job(job_dir, partitions, spec):
+    job_path = os.path.join(job_dir, JOB_FILE)
+    with open(f"{job_path}.{os.getpid()}.tmp", "w") as f:
+        json.dump({"partitions": partitions, "spec": spec}, f)
+    os.replace(f"{job_path}.{os.getpid()}.tmp", job_path)
+
+
+def list_jobs(jobs_dir=TRAINING_JOBS_DIR):
+    """Returns the folders of the training jobs in jobs_dir."""
+    if not os.path.isdir(jobs_dir):
+        return []
+    return [os.path.join(jobs_dir, name) for name in sorted(os.listdir(jobs_dir))
+            if os.path.exists(os.path.join(jobs_dir, name, JOB_FILE))]
+
+
+def remove_expired_jobs(jobs_dir=TRAINING_JOBS_DIR):
+    """Removes the jobs nothing was written to for JOB_EXPIRY, which no rerun is going to resume."""
+    for job_dir in list_jobs(jobs_dir):
+        if time.time() - os.path.getmtime(job_dir) > JOB_EXPIRY:
+            shutil.rmtree(job_dir, ignore_errors=True)
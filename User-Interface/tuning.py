@@ -0,0 +1,160 @@
+import argparse
+import itertools
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from sklearn.ensemble import RandomForestRegressor
+from sklearn.metrics import mean_squared_error
+from global_model import ean_features
+from model_training import iter_training_tasks
+from training_config import DEFAULT_MODEL_PARAMS, TRAINING_CONFIG_PATH, cluster_of, save_training_config
+from utils import load_dataset
+
+# Forest parameters searched for each cluster (the untuned defaults are part of the grid)
+PARAM_GRID = {
+    "n_estimators": [25, 50, 100],
+    "max_depth": [4, 8, None],
+    "min_samples_leaf": [1, 3],
+}
+
+# Number of rolling-origin folds, and EANs evaluated per cluster
+N_FOLDS = 3
+MAX_EANS_PER_CLUSTER = 20
+# Bins of the share of weeks with sales: intermittent vs regular sellers
+SALES_RATE_EDGES = [0.5]
+# A smaller forest is chosen if its RMSE is within this fraction of the best one (and not worse than the defaults)
+RMSE_TOLERANCE = 0.01
+
+
+def rolling_origin_splits(n, n_folds=N_FOLDS):
+    """Yields (train_end, test_end) pairs: each fold trains on the weeks before train_end and tests on the next ones.
+
+    The origin moves forward by one test window per fold, so the model is
+    always evaluated on weeks that follow its training weeks.
+    """
+    test_size = max(1, n // (n_folds + 2))
+    for fold in range(n_folds, 0, -1):
+        train_end = n - fold * test_size
+        if train_end >= 2:
+            yield train_end, train_end + test_size
+
+
+def _evaluate(cluster, params, series, n_folds, random_state):
+    """Cross-validates one set of forest parameters on the (X, y) series of a cluster."""
+    errors, n_nodes, fit_seconds = [], [], 0.0
+    for X, y in series:
+        for train_end, test_end in rolling_origin_splits(len(X), n_folds):
+            model = RandomForestRegressor(**params, random_state=random_state)
+            start = time.perf_counter()
+            model.fit(X[:train_end], y[:train_end])
+            fit_seconds += time.perf_counter() - start
+            errors.append(np.sqrt(mean_squared_error(y[train_end:test_end], model.predict(X[train_end:test_end]))))
+            n_nodes.append(sum(estimator.tree_.node_count for estimator in model.estimators_))
+
+    return {
+        "cluster": cluster,
+        "params": params,
+        "rmse": float(np.mean(errors)) if errors else np.nan,
+        "nodes": float(np.mean(n_nodes)) if n_nodes else np.nan,
+        "fit_seconds": fit_seconds,
+    }
+
+
+def _param_sets(grid):
+    names = list(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+
+
+def _choose(results, tolerance):
+    """Picks the smallest forest (fewest nodes) whose RMSE is close to the best and not worse than the defaults."""
+    results = [result for result in results if not np.isnan(result["rmse"])]
+    best = min(result["rmse"] for result in results)
+    baseline = [result for result in results if result["params"] == _with_defaults({})]
+    limit = best * (1 + tolerance)
+    if baseline:
+        limit = min(limit, baseline[0]["rmse"])
+    candidates = [result for result in results if result["rmse"] <= limit]
+    return min(candidates, key=lambda result: (result["nodes"], result["rmse"])), baseline[0] if baseline else None
+
+
+def _with_defaults(params):
+    """Fills in the parameters the grid leaves out, as RandomForestRegressor would."""
+    defaults = {"n_estimators": DEFAULT_MODEL_PARAMS["n_estimators"], "max_depth": None, "min_samples_leaf": 1}
+    return {**defaults, **params}
+
+
+def tune(dataset, grid=PARAM_GRID, n_folds=N_FOLDS, max_eans_per_cluster=MAX_EANS_PER_CLUSTER,
+         tolerance=RMSE_TOLERANCE, n_jobs=None, random_state=42):
+    """Searches the forest parameters of each cluster of EANs with rolling-origin cross-validation.
+
+    EANs are grouped by volume (tertiles of their mean weekly consumption)
+    and by share of weeks with sales, and every (cluster, parameters) pair
+    is evaluated on a sample of the cluster's EANs in a process pool.
+    Returns the training config and the cross-validation results.
+    """
+    series, scalings, zeros = {}, {}, {}
+    for ean, X, y, *_ in iter_training_tasks(dataset, None, random_state):
+        if len(X) >= n_folds + 2:
+            series[ean] = (X, y)
+            scalings[ean] = dataset.scaling_of(ean)
+            zeros[ean] = dataset.scaled_zero(ean)
+
+    volumes = np.array([ean_features(y, scalings[ean], zeros[ean])[0] for ean, (_, y) in series.items()])
+    volume_edges = np.quantile(volumes, [1 / 3, 2 / 3]).tolist() if len(volumes) else []
+
+    # Group the EANs, then sample each group so the search cost does not grow with the catalogue
+    clusters = {}
+    for ean, (X, y) in series.items():
+        clusters.setdefault(cluster_of(y, volume_edges, SALES_RATE_EDGES, scalings[ean], zeros[ean]), []).append(ean)
+    rng = np.random.default_rng(random_state)
+    samples = {cluster: rng.choice(eans, min(len(eans), max_eans_per_cluster), replace=False)
+               for cluster, eans in clusters.items()}
+
+    param_sets = [_with_defaults(params) for params in _param_sets(grid)]
+    if _with_defaults({}) not in param_sets:
+        param_sets.append(_with_defaults({}))
+
+    with ProcessPoolExecutor(max_workers=n_jobs or os.cpu_count() or 1) as executor:
+        futures = [executor.submit(_evaluate, cluster, params, [series[ean] for ean in samples[cluster]], n_folds,
+                                   random_state)
+                   for cluster in sorted(samples) for params in param_sets]
+        results = [future.result() for future in futures]
+
+    config = {"volume_edges": volume_edges, "sales_rate_edges": SALES_RATE_EDGES, "clusters": {}, "report": {}}
+    for cluster in sorted(samples):
+        chosen, baseline = _choose([result for result in results if result["cluster"] == cluster], tolerance)
+        config["clusters"][cluster] = chosen["params"]
+        config["report"][cluster] = {
+            "eans": len(clusters[cluster]),
+            "evaluated_eans": len(samples[cluster]),
+            "rmse": chosen["rmse"],
+            "nodes": chosen["nodes"],
+            "default_rmse": baseline["rmse"] if baseline else None,
+            "default_nodes": baseline["nodes"] if baseline else None,
+        }
+    return config, results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Tune the forest parameters per cluster of EANs and write them to the training config.")
+    parser.add_argument("--folds", type=int, default=N_FOLDS, help="Number of rolling-origin folds")
+    parser.add_argument("--max-eans", type=int, default=MAX_EANS_PER_CLUSTER,
+                        help="EANs evaluated per cluster")
+    parser.add_argument("--tolerance", type=float, default=RMSE_TOLERANCE,
+                        help="RMSE margin accepted for a smaller forest (fraction of the best RMSE)")
+    parser.add_argument("--jobs", type=int, default=None, help="Number of worker processes")
+    parser.add_argument("--output", default=TRAINING_CONFIG_PATH, help="Training config to write")
+    args = parser.parse_args()
+
+    config, _ = tune(load_dataset(), n_folds=args.folds, max_eans_per_cluster=args.max_eans,
+                     tolerance=args.tolerance, n_jobs=args.jobs)
+    save_training_config(config, args.output)
+
+    for cluster, report in config["report"].items():
+        print(f"Cluster {cluster} ({report['eans']} EANs): {config['clusters'][cluster]} - "
+              f"RMSE {report['rmse']:.4f} vs {report['default_rmse']:.4f} by default, "
+              f"{report['nodes']:.0f} vs {report['default_nodes']:.0f} nodes")
+    print(f"Training config saved to {os.path.abspath(args.output)}; "
+          f"retrain the models to apply it")
@@ -1,8 +1,5 @@
 import tkinter as tk
 from tkinter import ttk
-from matplotlib.figure import Figure
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-import matplotlib.pyplot as plt
 import os
 import datetime
 
@@ -18,11 +15,21 @@ def setup_ui(root, app):
                               bg="#F5A623", fg="black", padx=10, pady=5)
     processing_label.grid(row=0, column=0, sticky="ew", pady=5)
 
+    # Cancel button shown on top of the processing panel while a retrain runs
+    cancel_button = tk.Button(main_frame, text="Cancel", command=app.cancel_processing,
+                              bg="#FFFFFF", fg="black", font=("Arial", 10), padx=5)
+    cancel_button.grid(row=0, column=0, sticky="e", padx=5)
+    cancel_button.grid_remove()
+
     # Last update label
     last_update_label = tk.Label(main_frame, text="Dernière mise à jour: Chargement...",
                                font=("Arial", 10), bg="#E3E3E3", fg="#555555")
     last_update_label.grid(row=1, column=0, sticky="w", pady=(0, 10))
 
+    # Readiness of the models, loaded in the background after the window is shown
+    status_label = tk.Label(main_frame, text="Loading models...", font=("Arial", 10), bg="#E3E3E3", fg="#555555")
+    status_label.grid(row=1, column=0, sticky="e", pady=(0, 10))
+
     # Upload button
     upload_button = tk.Button(main_frame, text="Upload Dataset", bg="#3A7CA5", fg="white",
                             command=app.upload_dataset, padx=10, pady=5, font=("Arial", 12))
@@ -37,9 +44,15 @@ def setup_ui(root, app):
 
     ean_entry = tk.Entry(ean_frame, font=("Arial", 12), width=20)
     ean_entry.pack(side=tk.LEFT, padx=5)
+    ean_entry.bind("<KeyRelease>", app.update_suggestions)
+
+    # Autocomplete list of the EANs starting with the typed digits, shown under the entry (hidden by default)
+    suggestion_list = tk.Listbox(main_frame, font=("Arial", 12), height=0, activestyle="none", exportselection=False)
+    suggestion_list.bind("<<ListboxSelect>>", app.select_suggestion)
+    ean_entry.bind("<Escape>", lambda event: hide_suggestions(suggestion_list))
 
     # Predict button
-    predict_button = tk.Button(main_frame, text="Predict", command=app.predict,
+    predict_button = tk.Button(main_frame, text="Predict", command=app.predict, state=tk.DISABLED,
                              bg="#F25C54", fg="white", padx=10, pady=5, font=("Arial", 12))
     predict_button.grid(row=4, column=0, pady=10)
 
@@ -53,8 +66,8 @@ def setup_ui(root, app):
                           width=3, height=1, bd=2, relief=tk.RAISED)
     help_button.place(relx=1.0, rely=0.0, anchor='ne', x=-10, y=10)
 
-    return (processing_label, upload_button, ean_entry, predict_button,
-            result_frame, help_button, last_update_label)
+    return (processing_label, upload_button, ean_entry, predict_button, result_frame, help_button,
+            last_update_label, cancel_button, status_label, suggestion_list)
 
 
 def show_processing_panel(processing_label, message):
@@ -69,35 +82,27 @@ def hide_processing_panel(processing_label):
     processing_label.grid_remove()  # Hide it completely
 
 
-def show_plot_window(ean_data, future_dates, future_predictions):
-    """Shows the plot in a new window."""
-    plot_window = tk.Toplevel()
-    plot_window.title("Consumption Prediction Plot")
-    plot_window.geometry("800x600")
-
-    fig = Figure(figsize=(8, 6), dpi=100)
-    ax = fig.add_subplot(111)
-
-    # Plot past data
-    ax.plot(ean_data["Week_Start"], ean_data["Total_Weekly_Consumption"],
-           marker='o', label="Past Consumption", color="blue")
+def show_suggestions(suggestion_list, ean_entry, suggestions):
+    """Lists the suggested EANs right under the EAN entry."""
+    suggestion_list.delete(0, tk.END)
+    for suggestion in suggestions:
+        suggestion_list.insert(tk.END, suggestion)
+    suggestion_list.place(in_=ean_entry, relx=0, rely=1, relwidth=1)
+    suggestion_list.lift()
 
-    # Plot future predictions
-    ax.plot(future_dates, future_predictions, marker='x', linestyle='dashed',
-           label="Predicted Consumption", color="red")
 
-    ax.set_title("Stock Consumption Prediction", fontsize=14)
-    ax.set_xlabel("Week Start", fontsize=12)
-    ax.set_ylabel("Consumption (units)", fontsize=12)
-    ax.legend(fontsize=12)
-    ax.grid(True)
+def hide_suggestions(suggestion_list):
+    """Hides the suggested EANs."""
+    suggestion_list.place_forget()
 
-    # Rotate x-axis labels for better readability
-    plt.setp(ax.get_xticklabels(), rotation=45, ha="right")
 
-    canvas = FigureCanvasTkAgg(fig, master=plot_window)
-    canvas.draw()
-    canvas.get_tk_widget().pack(fill=tk.BOTH, expand=True)
+def show_plot_window(app, ean_data, future_dates, future_predictions, key=None):
+    """Shows the plot in the plot window of the app, created on first use. Returns the redraw time."""
+    if app.plot_panel is None:
+        # Imported on first use: matplotlib is the slowest import of the UI
+        from plot_panel import PlotPanel
+        app.plot_panel = PlotPanel()
+    return app.plot_panel.show(ean_data, future_dates, future_predictions, key)
 
 
 def show_help_window():
@@ -1,27 +1,51 @@
-import pandas as pd
 import joblib
 import os
+from dataset_store import WeeklyConsumptionStore
+from instrumentation import stage
+from model_store import MANIFEST_FILE, MAX_CACHED_MODELS, MAX_CACHED_BYTES, ModelStore
+from snapshots import current_snapshot
 
+# The loaders read the current snapshot unless given one (see snapshots.py): load the artifacts used
+# together from the same snapshot, as a new one may be published between two calls
 
-def load_models():
-    """Loads the pre-trained models and scaler."""
-    models_path = "../Models/randomforest_models/random_forest_models_improved.pkl"
-    scaler_path = "../scaler.pkl"
 
-    if not os.path.exists(models_path) or not os.path.exists(scaler_path):
+def load_models(max_models=MAX_CACHED_MODELS, max_bytes=MAX_CACHED_BYTES, snapshot=None):
+    """Opens the pre-trained model store (models are loaded on first use) and loads the scaler."""
+    snapshot = snapshot or current_snapshot()
+    manifest_path = os.path.join(snapshot.models_dir, MANIFEST_FILE)
+    legacy_models_path = os.path.join(snapshot.models_dir, "random_forest_models_improved.pkl")
+
+    if not os.path.exists(snapshot.scaler_path):
         raise FileNotFoundError("Model or scaler file is missing!")
 
-    models = joblib.load(models_path)
-    scaler = joblib.load(scaler_path)
+    with stage("load.models", snapshot=snapshot.version):
+        if os.path.exists(manifest_path):
+            models = ModelStore(snapshot.models_dir, max_models=max_models, max_bytes=max_bytes)
+        elif os.path.exists(legacy_models_path):
+            # Models trained before the per-EAN store: a single pickle holding every model
+            models = joblib.load(legacy_models_path)
+        else:
+            raise FileNotFoundError("Model or scaler file is missing!")
+
+        scaler = load_scaler(snapshot)
 
     return models, scaler
 
 
-def load_dataset():
-    """Loads the preprocessed dataset."""
-    dataset_path = "../Dataset/weekly_consumption.csv"
+def load_scaler(snapshot=None):
+    """Loads the scaler fitted on the weekly consumption during preprocessing."""
+    snapshot = snapshot or current_snapshot()
+    if not os.path.exists(snapshot.scaler_path):
+        raise FileNotFoundError("Scaler file is missing!")
+
+    return joblib.load(snapshot.scaler_path)
+
 
-    if not os.path.exists(dataset_path):
+def load_dataset(snapshot=None):
+    """Opens the preprocessed dataset store (memory-mapped, indexed by EAN)."""
+    snapshot = snapshot or current_snapshot()
+    if not os.path.exists(snapshot.store_dir):
         raise FileNotFoundError("Dataset not found! Please upload and preprocess a dataset.")
 
-    return pd.read_csv(dataset_path)
+    with stage("load.dataset", snapshot=snapshot.version):
+        return WeeklyConsumptionStore(snapshot.store_dir)